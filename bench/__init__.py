@@ -0,0 +1,6 @@
+""" Benchmarks for the app, run them from the repository root, e.g. `py -m bench.connection` """
+
+import os.path, sys
+
+# the app modules import each other as top level modules, same as when running src/prachy.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
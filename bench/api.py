@@ -0,0 +1,135 @@
+""" Load test of the HTTP API (src/api.py). Clients on keep-alive connections look up balances and post orders for a while,
+then the requests per second and the latencies are printed. Fails on an error answer or when the saved orders
+don't match the answered ones.
+
+    py -m bench.api --connections 20 --seconds 10                     # against its own server on a generated database
+    py -m bench.api --url 127.0.0.1:8765 --token secret --customers 500    # against a running one, only the lookups and orders are checked """
+
+import argparse, asyncio, json, multiprocessing, os, random, tempfile, time
+import bench
+import dbutils
+from bench.generate import generate, load_items
+
+def serve(path, items, ready, stop):
+    """The server process, started by run"""
+    from dbworker import DBWorker
+    from api import ApiServer
+    dbutils.use_database(path)
+    dbutils.prepare_db()
+    worker = DBWorker()
+    worker.submit("warm_cache")
+    server = ApiServer(worker, items, port=0)
+    ready.put(server.port)
+    stop.wait()
+    server.close()
+    worker.close()
+    dbutils.close_connections()
+
+async def request(reader, writer, method, path, body=None, token=None):
+    """(status, answer) of one request on an open connection"""
+    data = b"" if body is None else json.dumps(body).encode("utf-8")
+    head = f"{method} {path} HTTP/1.1\r\nHost: api\r\nContent-Length: {len(data)}\r\n"
+    if token:
+        head += f"Authorization: Bearer {token}\r\n"
+    writer.write((head + "\r\n").encode("latin-1") + data)
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b"\r\n":
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+async def client(host, port, token, customers, items, order_share, until, seed, times, statuses):
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < until:
+            customer_id = rng.randint(1, customers)
+            start = time.perf_counter()
+            if rng.random() < order_share:
+                name, price = rng.choice(items)
+                status, answer = await request(reader, writer, "POST", f"/customers/{customer_id}/orders",
+                                               {"items": [{"name": name, "price": price, "count": rng.randint(1, 3)}]}, token)
+                kind = "order"
+            else:
+                status, answer = await request(reader, writer, "GET", f"/customers/{customer_id}", token=token)
+                kind = "lookup"
+            times.setdefault(kind, []).append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status >= 500 or status in (400, 401, 404):
+                raise RuntimeError(f"{kind} of {customer_id} answered {status} {answer}")
+    finally:
+        writer.close()
+
+async def load(host, port, token, connections, seconds, customers, items, order_share):
+    times, statuses = {}, {}
+    until = time.perf_counter() + seconds
+    await asyncio.gather(*(client(host, port, token, customers, items, order_share, until, seed, times, statuses)
+                           for seed in range(connections)))
+    return times, statuses
+
+def report(times, statuses, seconds):
+    total = sum(len(taken) for taken in times.values())
+    print(f"{total} requests in {seconds:.1f}s, {total / seconds:.0f} requests/s, answers {dict(sorted(statuses.items()))}")
+    for kind, taken in sorted(times.items()):
+        taken.sort()
+        print(f"{kind:<8}{len(taken) / seconds:>8.0f}/s{taken[len(taken) // 2] * 1000:>10.2f} ms p50"
+              f"{taken[int(len(taken) * 0.95)] * 1000:>10.2f} ms p95{taken[-1] * 1000:>10.2f} ms max")
+
+def count_orders():
+    cur = dbutils._cursor()
+    cur.execute("SELECT count(*) FROM payments WHERE description = 'ORDER_PAYMENT'")
+    return cur.fetchone()[0]
+
+def run(directory, customers, payments, connections, seconds, order_share, config_path):
+    path = os.path.join(directory, "api.db")
+    generate(path, customers, payments, config_path=config_path)
+    dbutils.use_database(path)
+    dbutils.prepare_db()
+    orders_before = count_orders()
+    dbutils.close_connections()
+
+    items = load_items(config_path)
+    ready, stop = multiprocessing.Queue(), multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(path, items, ready, stop))
+    server.start()
+    try:
+        port = ready.get(timeout=60)
+        start = time.perf_counter()
+        times, statuses = asyncio.run(load("127.0.0.1", port, None, connections, seconds, customers, items, order_share))
+        report(times, statuses, time.perf_counter() - start)
+    finally:
+        stop.set()
+        server.join()
+
+    saved = count_orders() - orders_before
+    dbutils.close_connections()
+    if saved != statuses.get(201, 0):
+        raise SystemExit(f"{statuses.get(201, 0)} orders answered as saved, {saved} in the database")
+    print(f"OK, {saved} orders saved")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", help="host:port of a running server, one is started on a generated database otherwise")
+    parser.add_argument("--token", help="api.token of the running server")
+    parser.add_argument("--customers", type=int, default=2000, help="numbers the requests go to")
+    parser.add_argument("--payments", type=int, default=100000, help="size of the generated database")
+    parser.add_argument("--connections", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--orders", type=float, default=0.1, help="share of the requests that are orders")
+    parser.add_argument("--config", default="config_default.json", help="the items that are ordered")
+    args = parser.parse_args()
+
+    if args.url:
+        host, _, port = args.url.rpartition(":")
+        start = time.perf_counter()
+        times, statuses = asyncio.run(load(host, int(port), args.token, args.connections, args.seconds, args.customers,
+                                           load_items(args.config), args.orders))
+        report(times, statuses, time.perf_counter() - start)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            run(directory, args.customers, args.payments, args.connections, args.seconds, args.orders, args.config)
@@ -0,0 +1,67 @@
+""" How much slower orders get while a backup is running. Times save_order on a generated database first alone,
+then while backup.make_backup copies it over and over on another thread.
+
+    py -m bench.backup --payments 1000000 --orders 500 """
+
+import argparse, os, random, statistics, tempfile, threading, time
+import bench
+import dbutils
+import backup
+from bench.generate import generate, load_items
+
+def order_latencies(orders, rng, items, customers):
+    times = []
+    for _ in range(orders):
+        order = {rng.choice(items): rng.randint(1, 3)}
+        start = time.perf_counter()
+        dbutils.save_order(rng.randint(1, customers), order)
+        times.append(time.perf_counter() - start)
+        # a till doesn't take orders back to back
+        time.sleep(0.005)
+    return sorted(times)
+
+def report(name, times):
+    print(f"{name:<22}p50 {times[len(times) // 2] * 1000:8.2f} ms   p95 {times[int(len(times) * 0.95)] * 1000:8.2f} ms"
+          f"   max {times[-1] * 1000:8.2f} ms   mean {statistics.fmean(times) * 1000:8.2f} ms")
+
+def run(directory, customers, payments, orders, pages, sleep, config_path):
+    path = os.path.join(directory, "backup.db")
+    start = time.perf_counter()
+    generate(path, customers, payments, config_path=config_path)
+    dbutils.use_database(path)
+    dbutils.prepare_db()
+    print(f"{payments} payments, {os.path.getsize(path) / 2**20:.0f} MB, generated in {time.perf_counter() - start:.1f}s")
+
+    rng = random.Random(0)
+    items = load_items(config_path)
+    report("without backup", order_latencies(orders, rng, items, customers))
+
+    stop = threading.Event()
+    durations = []
+    def backups():
+        while not stop.is_set():
+            start = time.perf_counter()
+            backup.make_backup(os.path.join(directory, "backups"), 1, pages, sleep)
+            durations.append(time.perf_counter() - start)
+        dbutils.close_thread_connection()
+
+    thread = threading.Thread(target=backups)
+    thread.start()
+    report("during backups", order_latencies(orders, rng, items, customers))
+    stop.set()
+    thread.join()
+    print(f"{len(durations)} backups, {statistics.fmean(durations):.2f}s each, {pages} pages per step, {sleep * 1000:.0f} ms between steps")
+    dbutils.close_connections()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--payments", type=int, default=1000000)
+    parser.add_argument("--orders", type=int, default=500, help="orders timed with and without a backup running")
+    parser.add_argument("--pages", type=int, default=backup.BACKUP_PAGES, help="pages copied in one backup step")
+    parser.add_argument("--sleep", type=float, default=backup.STEP_SLEEP, help="seconds between the steps")
+    parser.add_argument("--config", default="config_default.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        run(directory, args.customers, args.payments, args.orders, args.pages, args.sleep, args.config)
@@ -0,0 +1,76 @@
+""" 1000 rapid taps on the price buttons of Order, with the old full redraw of the basket and with the incremental one.
+Needs Tk with a display, on headless Linux run it as `xvfb-run py -m bench.basket` """
+
+import json, time
+import tkinter as tk
+import tkinter.font as tkfont
+import bench
+import prachy
+
+TAPS = 1000
+# taps handled before Tk gets to idle, staff tapping faster than the basket redraws
+BURST = 5
+
+class BenchRoot(tk.Tk):
+    def __init__(self):
+        tk.Tk.__init__(self)
+        self.withdraw()
+        tkfont.Font(family='Arial', size=22, weight="bold", name="BPThicc")
+        with open("config_default.json", encoding="utf-8") as infil:
+            self.config = json.load(infil)
+        for button in self.config["buttons"]:
+            button.setdefault("color", "#CCCCCC")
+
+class LegacyOrder(prachy.Order):
+    """Order with the basket redraw from before, everything is redrawn on every tap"""
+    def price_button_callback(self, name, value):
+        self.basket.add(name, value)
+        self.legacy_redraw_orders()
+    
+    def legacy_redraw_orders(self):
+        self.prep_area['state'] = 'normal'
+        self.prep_area.delete("1.0", "end")
+        
+        total = sum((x*y for (_,x),y in self.basket.lines.items()))
+        
+        self.prep_area.insert("end","Věci v objednávce:\n")
+        
+        for (name, val), num in sorted(self.basket.lines.items()):
+            key = (name, val)
+            self.prep_area.insert("end", self.line_text(key, num))
+            button = tk.Button(self.prep_area, text="x", cursor="left_ptr",
+                       bd=0, bg=self.prep_area["bg"], fg="#a60000", highlightthickness=0,
+                       command = lambda key=key: self.remove_item(key))
+            self.prep_area.window_create("end", window = button)
+            self.prep_area.insert("end", "\n")
+        
+        self.prep_area.insert("end", "-------------------\nCelkem: "+str(total)+"\nZůstatek: "+str(self.money-total))
+        
+        self.prep_area['state'] = 'disabled'
+        self.prep_area.see('end')
+
+def tap(root, order_class):
+    order = order_class(root)
+    order.place(x=0, y=0, relwidth=1, relheight=1)
+    root.update()
+    buttons = [(settings.get("text", str(settings["value"])), settings["value"]) for settings in root.config["buttons"]]
+    
+    start = time.perf_counter()
+    for i in range(TAPS):
+        order.price_button_callback(*buttons[i % len(buttons)])
+        if i % BURST == BURST - 1:
+            root.update()
+    root.update()
+    elapsed = time.perf_counter() - start
+    
+    widgets = len(order.prep_area.winfo_children())
+    order.destroy()
+    return elapsed, widgets
+
+if __name__ == "__main__":
+    root = BenchRoot()
+    print(f"{TAPS} taps, Tk idle after every {BURST}")
+    for name, order_class in (("full redraw", LegacyOrder), ("incremental", prachy.Order)):
+        elapsed, widgets = tap(root, order_class)
+        print(f"{name:<14}{elapsed * 1000:>9.1f}ms{elapsed / TAPS * 1e6:>9.1f}us/tap{widgets:>7} widgets in basket")
+    root.destroy()
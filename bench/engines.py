@@ -0,0 +1,96 @@
+""" The same till workload on every engine of storage.py: SQLite on a file, SQLite in memory and pyledger on Python dicts.
+The difference of the first two is what the disk costs, of the last two what the SQL costs. Fails when the engines
+don't end with the same balances, histories, search results and sales report.
+
+    py -m bench.engines --customers 500 --operations 20000 """
+
+import argparse, os, random, tempfile, time
+import bench
+import service, storage
+from bench.generate import load_items
+
+# share of each kind of operation, the rest are balance lookups
+SHARES = (("order", 0.35), ("top_up", 0.1), ("history", 0.1), ("search", 0.05))
+NAMES = ("Honza", "Jana", "Petr", "Eva", "Tomáš", "Šárka", "Jiří", "Lucie")
+
+def workload(ledger, customers, operations, items, seed=0):
+    """Runs the operations on ledger, returns ({kind: [seconds]}, what was answered) for comparing the engines"""
+    rng = random.Random(seed)
+    session = service.Session(ledger)
+    answers = []
+    for customer_id in range(1, customers + 1):
+        session.open(customer_id)
+        if rng.random() < 0.5:
+            session.save_info(rng.choice(NAMES), f"Příjmení{customer_id}", None)
+        session.top_up(rng.randint(100, 1000))
+
+    times = {}
+    for _ in range(operations):
+        draw, kind = rng.random(), "lookup"
+        for name, share in SHARES:
+            if draw < share:
+                kind = name
+                break
+            draw -= share
+        customer_id = rng.randint(1, customers)
+        start = time.perf_counter()
+        session.open(customer_id)
+        if kind == "order":
+            for _ in range(rng.randint(1, 3)):
+                session.add_item(*rng.choice(items))
+            try:
+                session.checkout()
+            except ledger.InsufficientFunds:
+                session.checkout(allow_overdraft=True)
+        elif kind == "top_up":
+            session.top_up(rng.randint(50, 500))
+        elif kind == "history":
+            answers.append([(record.payment_id, record.description, record.balance_change, record.balance, record.orders)
+                            for record in session.history(20)])
+        elif kind == "search":
+            answers.append([info.customer_id for info in ledger.search_customers(rng.choice(NAMES)[:3].lower())])
+        else:
+            answers.append(session.balance())
+        times.setdefault(kind, []).append(time.perf_counter() - start)
+    return times, answers
+
+def final_state(ledger):
+    today = time.strftime("%Y-%m-%d", time.gmtime())
+    return [tuple(row) for row in ledger.get_export()], ledger.get_sales_report(today, today)
+
+def run(directory, customers, operations, items):
+    results = {}
+    for engine in storage.ENGINES:
+        ledger = storage.open_engine(engine, os.path.join(directory, "engines.db"))
+        start = time.perf_counter()
+        times, answers = workload(ledger, customers, operations, items)
+        seconds = time.perf_counter() - start
+        results[engine] = (times, answers, final_state(ledger))
+        ledger.close_connections()
+        print(f"{engine:<8}{seconds:8.2f} s" + "".join(f"{kind:>10}{sum(taken) / len(taken) * 1e6:7.0f} µs"
+                                                     for kind, taken in sorted(times.items())))
+
+    def per_operation(engine):
+        times = results[engine][0]
+        return sum(sum(taken) for taken in times.values()) / sum(len(taken) for taken in times.values()) * 1e6
+    print(f"disk {per_operation('sqlite') - per_operation('memory'):.0f} µs, "
+          f"SQL {per_operation('memory') - per_operation('python'):.0f} µs, "
+          f"logic {per_operation('python'):.0f} µs of an operation")
+
+    _, answers, state = results["sqlite"]
+    for engine in storage.ENGINES[1:]:
+        if results[engine][1] != answers:
+            raise SystemExit(f"{engine} answered differently than sqlite")
+        if results[engine][2] != state:
+            raise SystemExit(f"{engine} ended with other balances or another sales report than sqlite")
+    print(f"OK, {len(state[0])} balances and {len(answers)} answers the same on {', '.join(storage.ENGINES)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--customers", type=int, default=500)
+    parser.add_argument("--operations", type=int, default=20000)
+    parser.add_argument("--config", default="config_default.json", help="the items that are ordered")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        run(directory, args.customers, args.operations, load_items(args.config))
@@ -0,0 +1,155 @@
+""" Fills a prachy.db with synthetic data that looks like a season of heavy use.
+
+    py -m bench.generate prachy.db --customers 2000 --payments 200000
+
+Items and prices come from the buttons in config_default.json, some of them are ordered much more often than others. """
+
+import argparse, itertools, json, os, random, sqlite3, time
+import bench
+import dbutils
+
+# the schema of DB version 2, the oldest one upgrade_db can start from. Databases made with legacy=True use it, to time the upgrade
+LEGACY_SCHEMA = [
+    """
+        CREATE TABLE payments (
+            payment_id INTEGER PRIMARY KEY,
+            customer_id INTEGER NOT NULL,
+            stamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            description TEXT,
+            balance_change INTEGER NOT NULL
+        );
+    """,
+    """
+        CREATE TABLE orders (
+            order_id INTEGER PRIMARY KEY,
+            payment_id INTEGER NOT NULL,
+            item_name TEXT,
+            item_cost INTEGER NOT NULL,
+            count INTEGER INTEGER NOT NULL,
+            cost_total INTEGER GENERATED ALWAYS AS (item_cost*count),
+
+            FOREIGN KEY (payment_id) REFERENCES payments(payment_id) ON DELETE CASCADE
+        );
+    """,
+    """
+        CREATE TABLE customers (
+            customer_id INTEGER PRIMARY KEY,
+            nickname TEXT,
+            first_name TEXT,
+            last_name TEXT
+        );
+    """,
+    """
+        CREATE TABLE db_info (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """,
+    f"""
+        INSERT INTO db_info (key, value) VALUES ('app_name', '{dbutils.APP_NAME}'), ('version', '2');
+    """,
+]
+
+INSERT_SQL = {
+    "customer": "INSERT INTO customers (customer_id, first_name, last_name, nickname) VALUES (?, ?, ?, ?)",
+    "payment": "INSERT INTO payments (payment_id, customer_id, stamp, description, balance_change) VALUES (?, ?, ?, ?, ?)",
+    "order": "INSERT INTO orders (payment_id, item_id, item_cost, count) VALUES (?, (SELECT item_id FROM items WHERE name = ?), ?, ?)",
+}
+# the version 2 payments have text stamps and the orders the item name in every line
+LEGACY_INSERT_SQL = dict(INSERT_SQL,
+    payment="INSERT INTO payments (payment_id, customer_id, stamp, description, balance_change) VALUES (?, ?, strftime('%Y-%m-%d %H:%M:%S', ?, 'unixepoch'), ?, ?)",
+    order="INSERT INTO orders (payment_id, item_name, item_cost, count) VALUES (?, ?, ?, ?)")
+
+FIRST_NAMES = ["Jan", "Petr", "Tomáš", "Lucie", "Kateřina", "Jakub", "Eva", "Martin", "Tereza", "Ondřej", "Anna", "Vojtěch"]
+LAST_NAMES = ["Novák", "Svoboda", "Dvořák", "Černá", "Procházka", "Kučera", "Veselá", "Horák", "Marek", "Pokorná"]
+NICKNAMES = ["Bobr", "Sova", "Liška", "Ježek", "Rys", "Kos", "Vydra", "Jezevec", "Čáp", "Sýkora"]
+
+def load_items(config_path):
+    with open(config_path, encoding="utf-8") as infil:
+        buttons = json.load(infil)["buttons"]
+    return [(button.get("text", str(button["value"])), button["value"]) for button in buttons]
+
+def generate_rows(customers, payments, items, seed=0, days=365):
+    """Yields ("customer", row), ("payment", row) and ("order", row) tuples, payments go from oldest to newest"""
+    rng = random.Random(seed)
+
+    for customer_id in range(1, customers + 1):
+        # most regulars never fill in their profile
+        if rng.random() < 0.4:
+            yield "customer", (customer_id, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice(NICKNAMES + [None] * 5))
+
+    # a few items are ordered a lot more than the rest, like beer versus everything else
+    item_weights = [1 / (rank + 1) for rank in range(len(items))]
+    rng.shuffle(item_weights)
+    item_weights = list(itertools.accumulate(item_weights))
+    # and a few customers come much more often than the rest
+    customer_ids = range(1, customers + 1)
+    customer_weights = list(itertools.accumulate(rng.paretovariate(1.2) for _ in customer_ids))
+
+    stamp = time.time() - days * 24 * 3600
+    step = days * 24 * 3600 / max(payments, 1)
+    for payment_id in range(1, payments + 1):
+        stamp += rng.expovariate(1 / step)
+        customer_id = rng.choices(customer_ids, cum_weights=customer_weights)[0]
+        kind = rng.random()
+
+        if kind < 0.25:
+            yield "payment", (payment_id, customer_id, int(stamp), "ADD_FUNDS", rng.choice([100, 200, 300, 500, 1000]))
+        elif kind < 0.28:
+            yield "payment", (payment_id, customer_id, int(stamp), "REMOVE_FUNDS", -rng.randint(1, 300))
+        else:
+            lines = {}
+            for _ in range(rng.choice([1, 1, 1, 2, 2, 3, 4])):
+                item = rng.choices(items, cum_weights=item_weights)[0]
+                lines[item] = lines.get(item, 0) + rng.choice([1, 1, 1, 2, 3])
+            yield "payment", (payment_id, customer_id, int(stamp), "ORDER_PAYMENT", -sum(value * count for (_, value), count in lines.items()))
+            for (name, value), count in lines.items():
+                yield "order", (payment_id, name, value, count)
+
+def generate(path, customers, payments, seed=0, config_path="config_default.json", legacy=False):
+    """Creates a new database at path, with the newest schema or with the version 2 one if legacy is set"""
+    if os.path.exists(path):
+        raise FileExistsError(path)
+
+    items = load_items(config_path)
+    conn = sqlite3.connect(path, isolation_level=None)
+    cur = conn.cursor()
+    cur.execute("BEGIN;")
+    if legacy:
+        for expr in LEGACY_SCHEMA:
+            cur.execute(expr)
+        insert_sql = LEGACY_INSERT_SQL
+    else:
+        dbutils.create_db_newest(cur)
+        cur.executemany("INSERT INTO items (name) VALUES (?) ON CONFLICT(name) DO NOTHING", [(name,) for name, _ in items])
+        insert_sql = INSERT_SQL
+
+    batches = {kind: [] for kind in insert_sql}
+    for kind, row in generate_rows(customers, payments, items, seed):
+        batch = batches[kind]
+        batch.append(row)
+        if len(batch) >= 10000:
+            cur.executemany(insert_sql[kind], batch)
+            batch.clear()
+    for kind, batch in batches.items():
+        cur.executemany(insert_sql[kind], batch)
+    if not legacy:
+        # prepare_db fills the rollups, the upgrade does that for the legacy schema
+        cur.execute("INSERT INTO db_info (key, value) VALUES ('rollups_stale', '1')")
+
+    cur.execute("COMMIT;")
+    conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path")
+    parser.add_argument("--customers", type=int, default=2000)
+    parser.add_argument("--payments", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", default="config_default.json")
+    parser.add_argument("--legacy", action="store_true", help="use the DB version 2 schema")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate(args.path, args.customers, args.payments, args.seed, args.config, args.legacy)
+    print(f"{args.path}: {args.customers} customers, {args.payments} payments in {time.perf_counter() - start:.1f}s")
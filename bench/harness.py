@@ -0,0 +1,109 @@
+""" Times the main dbutils operations on generated databases of several sizes and writes the results as JSON.
+
+    py -m bench.harness --sizes 1000,10000,100000 --out results.json
+
+Compare the files of two versions to find regressions. """
+
+import argparse, datetime, json, os, platform, random, sqlite3, statistics, subprocess, sys, tempfile, time
+import bench
+import dbutils
+from bench.generate import generate, load_items
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def timed(func, args_list, before=None):
+    """Times func on each of args_list, before runs untimed ahead of every call"""
+    times = []
+    for args in args_list:
+        if before:
+            before()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+def summary(size, operation, times):
+    times = sorted(times)
+    return {
+        "size": size,
+        "operation": operation,
+        "calls": len(times),
+        "mean_us": statistics.fmean(times) * 1e6,
+        "p50_us": times[len(times) // 2] * 1e6,
+        "p95_us": times[int(len(times) * 0.95)] * 1e6,
+        "max_us": times[-1] * 1e6,
+    }
+
+def run_size(directory, size, calls, rng, items):
+    customers = max(50, size // 100)
+    results = []
+
+    path = os.path.join(directory, f"legacy-{size}.db")
+    generate(path, customers, size, legacy=True)
+    dbutils.use_database(path)
+    results.append(summary(size, "upgrade_db", timed(dbutils.prepare_db, [()])))
+
+    path = os.path.join(directory, f"bench-{size}.db")
+    generate(path, customers, size)
+    dbutils.use_database(path)
+    dbutils.prepare_db()
+
+    cur = dbutils.get_connection().cursor()
+    cur.execute("SELECT customer_id FROM payments GROUP BY customer_id ORDER BY count(*) DESC LIMIT 1")
+    regular = cur.fetchone()[0]
+    some_customers = [(rng.randint(1, customers),) for _ in range(calls)]
+
+    # the queries themselves with the CustomerInfo cache empty, comparable with the results from before it,
+    # then the calls the cache answers
+    results.append(summary(size, "get_info", timed(dbutils.get_info, some_customers, before=dbutils.clear_cache)))
+    results.append(summary(size, "get_money", timed(dbutils.get_money, some_customers, before=dbutils.clear_cache)))
+    dbutils.warm_cache()
+    results.append(summary(size, "get_info[cached]", timed(dbutils.get_info, some_customers)))
+    results.append(summary(size, "get_money[cached]", timed(dbutils.get_money, some_customers)))
+    results.append(summary(size, "get_payment_list", timed(dbutils.get_payment_list, [(regular,)] * max(1, calls // 100))))
+    results.append(summary(size, "get_payment_list[page]", timed(dbutils.get_payment_list, [(regular, 20)] * calls)))
+    searches = [(rng.choice(["j", "no", "tom", "jan nov", "ježek"]),) for _ in range(calls)]
+    results.append(summary(size, "search_customers", timed(dbutils.search_customers, searches)))
+    results.append(summary(size, "get_export", timed(dbutils.get_export, [()] * max(1, calls // 100))))
+    orders = [(customer_id, {rng.choice(items): rng.randint(1, 3)}) for customer_id, in some_customers]
+    results.append(summary(size, "save_order", timed(dbutils.save_order, orders)))
+
+    dbutils.close_connections()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="1000,10000,100000", help="numbers of payments, comma separated")
+    parser.add_argument("--calls", type=int, default=500, help="calls of the quick operations per size")
+    parser.add_argument("--config", default="config_default.json")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--dir", help="where to put the databases, a temporary directory by default")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    items = load_items(args.config)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (int(size) for size in args.sizes.split(",")):
+            for result in run_size(args.dir or directory, size, args.calls, rng, items):
+                print(f"{result['size']:>9} {result['operation']:<24}{result['p50_us']:>12.1f}us p50{result['p95_us']:>12.1f}us p95")
+                results.append(result)
+
+    with open(args.out, "w", encoding="utf-8") as outfil:
+        json.dump({
+            "commit": git_commit(),
+            "db_version": dbutils.DB_VERSION,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "results": results,
+        }, outfil, indent=2)
+    print("written to", args.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+""" How fast importer.py takes a big CSV. Imports a generated file with --dry-run, in one transaction and chunked,
+compares that with the same top-ups done one add_funds at a time, and checks that the import gives back what the balance
+export of the database wrote.
+
+    py -m bench.importer --rows 100000 """
+
+import argparse, csv, os, random, tempfile, time
+import bench
+import dbutils
+import importer
+from bench.generate import generate
+
+# rows done with add_funds, the time of all of them is estimated from these
+ONE_BY_ONE = 2000
+
+def write_csv(path, rows, customers, seed=0):
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as outfil:
+        writer = csv.writer(outfil, delimiter=";")
+        writer.writerow(["Číslo", "Jméno", "Příjmení", "Přezdívka", "Kredit"])
+        for _ in range(rows):
+            number = rng.randint(1, customers)
+            # a customer has the same name on every row, some rows leave it out
+            names = [f"Jméno{number}", f"Příjmení{number}", ""] if rng.random() < 0.5 else ["", "", ""]
+            writer.writerow([number, *names, rng.randint(-50, 500)])
+
+def state():
+    """Everything the import changes, to compare the databases by"""
+    cur = dbutils._cursor()
+    return (
+        cur.execute("SELECT count(*), total(balance_change) FROM payments").fetchone(),
+        cur.execute("SELECT total(balance) FROM customer_balances").fetchone(),
+        cur.execute("SELECT total(added), total(removed) FROM daily_funds").fetchone(),
+        cur.execute("SELECT count(*), count(first_name), count(last_name) FROM customers").fetchone(),
+    )
+
+def timed_import(name, path, rows, **kwargs):
+    imported, errors, seconds = importer.import_file(path, **kwargs)
+    assert imported == rows and not errors, (imported, errors)
+    print(f"{name:<22}{seconds:8.2f} s {rows / seconds:10.0f} rows/s")
+    return seconds
+
+def run(directory, customers, payments, rows, config_path):
+    path = os.path.join(directory, "import.db")
+    generate(path, customers, payments, config_path=config_path)
+    dbutils.use_database(path)
+    dbutils.prepare_db()
+    csv_path = os.path.join(directory, "import.csv")
+    write_csv(csv_path, rows, customers)
+
+    before = state()
+    timed_import("dry run", csv_path, rows, dry_run=True)
+    assert state() == before, "the dry run changed the database"
+    timed_import("one transaction", csv_path, rows)
+    timed_import("chunked", csv_path, rows, chunked=True)
+    imported = state()
+    dbutils.rebuild_rollups()
+    assert state() == imported, "the rollups don't match the payments"
+
+    with open(csv_path, encoding="utf-8") as infil:
+        sample = list(csv.reader(infil, delimiter=";"))[1:ONE_BY_ONE + 1]
+    start = time.perf_counter()
+    for number, _, _, _, amount in sample:
+        if int(amount) > 0:
+            dbutils.add_funds(int(number), int(amount))
+        elif int(amount) < 0:
+            dbutils.remove_funds(int(number), -int(amount))
+    seconds = (time.perf_counter() - start) / len(sample) * rows
+    print(f"{'add_funds one by one':<22}{seconds:8.2f} s {rows / seconds:10.0f} rows/s   (estimated from {len(sample)} rows)")
+
+    # the balance export imported into an empty database gives the same export
+    export = dbutils.get_export()
+    export_path = os.path.join(directory, "export.csv")
+    with open(export_path, "w", newline="", encoding="utf-8") as outfil:
+        csv.writer(outfil).writerows(export)
+    dbutils.use_database(os.path.join(directory, "empty.db"))
+    dbutils.prepare_db()
+    importer.import_file(export_path)
+    assert [tuple(row) for row in dbutils.get_export()] == [tuple(row) for row in export], "the imported export differs"
+    print(f"export of {len(export)} customers imported back the same")
+    dbutils.close_connections()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--payments", type=int, default=100000)
+    parser.add_argument("--rows", type=int, default=100000, help="rows of the imported CSV")
+    parser.add_argument("--config", default="config_default.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        run(directory, args.customers, args.payments, args.rows, args.config)
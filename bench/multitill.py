@@ -0,0 +1,91 @@
+""" Several processes (tills) writing to one database at the same time. Fails when an update got lost,
+when a balance or the daily rollups don't match the ledger or when a customer got into debt through save_order without allow_overdraft.
+
+    py -m bench.multitill --tills 4 --operations 500 """
+
+import argparse, multiprocessing, os, random, sys, tempfile, time
+import bench
+import dbutils
+
+CUSTOMERS = 20
+ITEMS = [("Pivo", 40), ("Kelímek", 50), ("Utopenec", 70)]
+
+def till(path, number, operations, results):
+    dbutils.use_database(path)
+    rng = random.Random(number)
+    added = payments = refused = 0
+    start = time.perf_counter()
+
+    for _ in range(operations):
+        customer_id = rng.randint(1, CUSTOMERS)
+        if rng.random() < 0.3:
+            amount = rng.choice([50, 100, 200])
+            dbutils.add_funds(customer_id, amount)
+            added += amount
+            payments += 1
+        else:
+            order = {rng.choice(ITEMS): rng.randint(1, 2)}
+            try:
+                dbutils.save_order(customer_id, order, allow_overdraft=False)
+                added -= sum(value * count for (_, value), count in order.items())
+                payments += 1
+            except dbutils.InsufficientFunds:
+                refused += 1
+
+    results.put((number, added, payments, refused, time.perf_counter() - start))
+
+def run(path, tills, operations):
+    dbutils.use_database(path)
+    dbutils.prepare_db()
+    dbutils.close_connections()
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=till, args=(path, number, operations, results)) for number in range(tills)]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    expected_total = sum(report[1] for report in reports)
+    expected_payments = sum(report[2] for report in reports)
+    for number, added, payments, refused, elapsed in sorted(reports):
+        print(f"till {number}: {payments} payments, {refused} orders refused for lack of credit, {payments / elapsed:.0f} payments/s")
+
+    cur = dbutils.get_connection().cursor()
+    cur.execute("SELECT count(*), IFNULL(SUM(balance_change), 0) FROM payments")
+    count, total = cur.fetchone()
+    cur.execute("SELECT IFNULL(SUM(balance), 0), IFNULL(MIN(balance), 0) FROM customer_balances")
+    balances_total, lowest = cur.fetchone()
+    cur.execute("""
+        SELECT count(*) FROM customer_balances
+          WHERE balance != (SELECT IFNULL(SUM(balance_change), 0) FROM payments WHERE payments.customer_id = customer_balances.customer_id)
+    """)
+    mismatched = cur.fetchone()[0]
+    cur.execute("SELECT IFNULL(SUM(added - removed - spent), 0) FROM daily_funds")
+    rollups_total = cur.fetchone()[0]
+    dbutils.close_connections()
+
+    errors = []
+    if count != expected_payments:
+        errors.append(f"{count} payments in the database, the tills made {expected_payments}")
+    if total != expected_total:
+        errors.append(f"payments add up to {total}, the tills added {expected_total}")
+    if balances_total != total or mismatched:
+        errors.append(f"{mismatched} customer balances don't match their payments")
+    if rollups_total != total:
+        errors.append(f"the daily rollups add up to {rollups_total}, the payments to {total}")
+    if lowest < 0:
+        errors.append(f"a customer got to {lowest} without an allowed overdraft")
+
+    print("\n".join(errors) or "OK, no lost updates")
+    return not errors
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--tills", type=int, default=4)
+    parser.add_argument("--operations", type=int, default=500, help="operations per till")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        sys.exit(0 if run(os.path.join(directory, "multitill.db"), args.tills, args.operations) else 1)
@@ -0,0 +1,111 @@
+""" Runs EXPLAIN QUERY PLAN on every query dbutils sends to the database and fails when one of them scans a whole table.
+
+The queries are caught with a trace callback while all the public dbutils functions are called, so new queries get checked
+without being listed here. Only new functions have to be added to CALLS. """
+
+import inspect, os, re, sys, tempfile
+import bench
+import dbutils
+
+# functions that don't query the app data, or only run on startup
+NOT_QUERIES = {"get_connection", "close_connections", "close_thread_connection", "transaction", "clear_cache", "cache_stats", "data_changed", "change_count", "retry_locked", "get_version", "check_is_fresh", "date_stamp", "create_db_newest", "upgrade_db", "prepare_db", "use_database"}
+
+CALLS = [
+    ("save_info", (1, "Jan", "Novák", "Honza")),
+    ("sync_items", (["Pivo", "Kelímek"],)),
+    ("add_funds", (1, 500)),
+    ("remove_funds", (1, 100)),
+    ("import_customers", ([[(2, "Jana", "", "", 300), (3, "", "", "", -50)]],)),
+    ("save_order", (1, {("Pivo", 40): 2, ("Kelímek", 50): 1})),
+    ("save_order", (1, {("Pivo", 40): 1}, False)),
+    ("warm_cache", ()),
+    ("get_money", (1,)),
+    ("get_info", (1,)),
+    ("get_payment_list", (1,)),
+    ("get_payment_list", (1, 2, (dbutils.MAX_STAMP, 0))),
+    ("get_payment_list", (1, 2, None, (dbutils.MIN_STAMP, 0))),
+    ("get_order_list", (3,)),
+    ("get_export", ()),
+    ("search_customers", ("hon nov",)),
+    ("count_export", ()),
+    ("iter_export", (True, "2020-01-01", "2099-12-31")),
+    ("count_export", (True,)),
+    ("delete_payment", (2,)),
+    ("iter_archive", ("2000-01-01",)),
+    ("archive_ledger", ("2099-01-01",)),
+    ("get_payment_list", (1, 2, None, None, True)),
+    ("get_payment_list", (1, 2, (dbutils.MAX_STAMP, 0), None, True)),
+    ("iter_export", (True,)),
+    ("count_export", (True, "2020-01-01")),
+    ("get_payments_between", (0, dbutils.MAX_STAMP)),
+    ("get_payments_between", (0, dbutils.MAX_STAMP, 1)),
+    ("get_sales_report", ("2020-01-01", "2099-12-31")),
+    ("rebuild_rollups", ()),
+]
+
+# tables that functions read whole on purpose, the exports dump every balance or the whole ledger
+ALLOWED_SCANS = {
+    "get_export": {"customer_balances"},
+    "warm_cache": {"customer_balances", "customers"},
+    "count_export": {"customer_balances", "payments"},
+    "iter_export": {"customer_balances", "payments"},
+    # archival goes through the old payments in the order they were made
+    "iter_archive": {"payments"},
+    "archive_ledger": {"payments"},
+    # and the rebuild counts the whole ledger again
+    "rebuild_rollups": {"payments", "orders", "daily_items"},
+}
+
+SCAN_RE = re.compile(r"^SCAN (\w+)")
+
+def full_scans(cur, query, allowed):
+    # only tables count, scans of CTEs and subqueries only go through rows already picked by an index
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {name for name, in cur.fetchall()} - allowed
+    
+    cur.execute("EXPLAIN QUERY PLAN " + query)
+    for _, _, _, detail in cur.fetchall():
+        match = SCAN_RE.match(detail)
+        if match and "INDEX" not in detail and match.group(1) in tables:
+            yield detail
+
+def run(directory):
+    dbutils.close_connections()
+    dbutils.use_database(os.path.join(directory, "plans.db"))
+    dbutils.prepare_db()
+    
+    queries = {}
+    conn = dbutils.get_connection()
+    for name, args in CALLS:
+        # without the cache, so the reads really get to the database
+        dbutils.clear_cache()
+        conn.set_trace_callback(lambda query, name=name: queries.setdefault((name, query)))
+        result = getattr(dbutils, name)(*args)
+        if hasattr(result, "__next__"):
+            list(result)
+    conn.set_trace_callback(None)
+    
+    public = {name for name, value in vars(dbutils).items() if inspect.isfunction(value) and not name.startswith("_")
+              and getattr(value, "__module__", None) == dbutils.__name__}
+    unchecked = public - NOT_QUERIES - {name for name, _ in CALLS}
+    
+    failed = False
+    if unchecked:
+        print("Not called, add them to CALLS:", ", ".join(sorted(unchecked)))
+        failed = True
+    
+    cur = conn.cursor()
+    for name, query in queries:
+        if not re.match(r"\s*(SELECT|UPDATE|DELETE|INSERT|WITH)", query, re.I):
+            continue
+        for detail in full_scans(cur, query, ALLOWED_SCANS.get(name, set())):
+            print(f"{detail}\n    in {name}: {' '.join(query.split())}")
+            failed = True
+    
+    dbutils.close_connections()
+    print("FAILED" if failed else f"OK, {len(queries)} queries checked")
+    return not failed
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        sys.exit(0 if run(directory) else 1)
@@ -0,0 +1,189 @@
+""" Replays a trace recorded at the till (see src/recorder.py) against a copy of a database and reports how fast it went.
+
+    py -m bench.replay traces/session-20250101-200000.trace --db prachy.db
+    py -m bench.replay session.trace --db prachy.db --speed 1    # with the pauses of the recording
+
+Every action does the same database calls as the frame that recorded it, one after another instead of through the DBWorker.
+The time of an action is the time of its database calls. """
+
+import argparse, datetime, json, os, shutil, sqlite3, tempfile, time
+import bench
+import dbutils
+import recorder
+import service
+
+# PaymentHistory.PAGE_SIZE
+HISTORY_PAGE = 20
+
+class Till:
+    """What the frames of the app ask the database for after each action, without Tk"""
+
+    def __init__(self):
+        self.frame = "MainPage"
+        self.customer = None
+        self.basket = service.Basket()
+        self.newest = None
+        self.paid = 0
+
+    def open(self, name, args, kwargs, returned_from):
+        if name == "MainPage":
+            self.customer = None
+            self.basket.clear()
+        elif name == "Order":
+            # coming back from the profile keeps the basket
+            if not returned_from:
+                self.customer = args[0]
+            dbutils.get_info(self.customer)
+        elif name == "EditProfile":
+            self.customer = args[0]
+            dbutils.get_info(self.customer)
+            self.load_history()
+        elif name == "Report":
+            # it opens on the report of today
+            today = datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+            dbutils.get_sales_report(today, today)
+        self.frame = name
+
+    def load_history(self):
+        records = dbutils.get_payment_list(self.customer, HISTORY_PAGE)
+        self.newest = records[-1].key if records else None
+
+    def refresh_history(self):
+        if self.newest is None:
+            self.load_history()
+            return
+        records = dbutils.get_payment_list(self.customer, HISTORY_PAGE, after=self.newest)
+        if records:
+            self.newest = records[-1].key
+
+    def tap(self, name, value):
+        self.basket.add(name, value)
+
+    def untap(self, name, value):
+        self.basket.remove(name, value)
+
+    def pay(self, allow_overdraft):
+        # done_button_callback doesn't pay an empty basket
+        if not self.basket:
+            return
+        try:
+            dbutils.save_order(self.customer, self.basket.lines, allow_overdraft=allow_overdraft)
+        except dbutils.InsufficientFunds:
+            # the till asks and, if confirmed, records another pay
+            return
+        self.basket.clear()
+        self.paid += 1
+
+    def add_funds(self, amount):
+        dbutils.add_funds(self.customer, amount)
+        self.funds_changed()
+
+    def remove_funds(self, amount):
+        dbutils.remove_funds(self.customer, amount)
+        self.funds_changed()
+
+    def funds_changed(self):
+        dbutils.get_money(self.customer)
+        if self.frame == "EditProfile":
+            self.refresh_history()
+
+    def save_info(self, first_name, last_name, nickname):
+        dbutils.save_info(self.customer, first_name, last_name, nickname)
+        dbutils.get_info(self.customer)
+
+    def delete(self, payment_id):
+        dbutils.delete_payment(payment_id)
+        dbutils.get_money(self.customer)
+
+    def search(self, text):
+        dbutils.search_customers(text)
+
+def copy_db(source, directory):
+    """Copies the database with the backup API, so it can be in use meanwhile, and its archive files next to it"""
+    path = os.path.join(directory, os.path.basename(source))
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst)
+        tables = {name for name, in src.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        files = [file for file, in src.execute("SELECT file FROM ledger_archives")] if "ledger_archives" in tables else []
+    finally:
+        dst.close()
+        src.close()
+    for file in files:
+        shutil.copy(os.path.join(os.path.dirname(source), file), os.path.join(directory, file))
+    return path
+
+def replay(actions, speed=0):
+    """Runs the actions, returns [(line, action, args, seconds)] and the Till"""
+    till = Till()
+    steps = []
+    start = time.perf_counter()
+    # line 1 is the header
+    for line, (at, action, args) in enumerate(actions, 2):
+        if speed:
+            delay = at / 1000 / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        step_start = time.perf_counter()
+        getattr(till, action)(*args)
+        steps.append((line, action, args, time.perf_counter() - step_start))
+    return steps, till
+
+def summary(times):
+    times = sorted(times)
+    return {
+        "count": len(times),
+        "p50_ms": times[len(times) // 2] * 1000,
+        "p95_ms": times[int(len(times) * 0.95)] * 1000,
+        "max_ms": times[-1] * 1000,
+        "total_ms": sum(times) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("trace")
+    parser.add_argument("--db", default="prachy.db", help="database to replay against, it is copied first and stays as it was")
+    parser.add_argument("--speed", type=float, default=0, help="1 keeps the pauses of the recording, 2 halves them, 0 leaves them out")
+    parser.add_argument("--out", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    header, actions = recorder.read(args.trace)
+    if not actions:
+        print("the trace is empty")
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        dbutils.use_database(copy_db(args.db, directory))
+        dbutils.prepare_db()
+
+        start = time.perf_counter()
+        steps, till = replay(actions, args.speed)
+        elapsed = time.perf_counter() - start
+        dbutils.close_connections()
+
+    db_time = sum(step[3] for step in steps)
+    print(f"{len(steps)} actions recorded {header['started']}, replayed in {elapsed:.2f}s, {db_time:.2f}s of it in the database")
+    print(f"{till.paid} orders paid, {till.paid / db_time if db_time else 0:.0f} orders/s of database time")
+    by_action = {}
+    for _, action, _, seconds in steps:
+        by_action.setdefault(action, []).append(seconds)
+    results = {action: summary(times) for action, times in sorted(by_action.items())}
+    for action, result in results.items():
+        print(f"{action:<14}{result['count']:>7}{result['p50_ms']:>10.2f} ms p50{result['p95_ms']:>10.2f} ms p95{result['max_ms']:>10.2f} ms max")
+    slowest = max(steps, key=lambda step: step[3])
+    print(f"slowest: line {slowest[0]}, {slowest[1]} {json.dumps(slowest[2], ensure_ascii=False)} took {slowest[3] * 1000:.2f} ms")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as outfil:
+            json.dump({
+                "trace": args.trace,
+                "recorded": header["started"],
+                "actions": len(steps),
+                "orders_paid": till.paid,
+                "db_seconds": db_time,
+                "results": results,
+                "slowest": {"line": slowest[0], "action": slowest[1], "args": slowest[2], "ms": slowest[3] * 1000},
+            }, outfil, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
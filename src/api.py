@@ -0,0 +1,255 @@
+""" HTTP/JSON API for taking orders on phones at the tables, next to the till. An asyncio server on its own thread,
+started by the app with "api": true in config.json, or on its own:
+
+    py src/api.py --db prachy.db --host 0.0.0.0 --port 8765
+
+    GET  /items                  the buttons of the till, [{"name": "Pivo", "price": 40}, …]
+    GET  /customers/12           {"customer_id": 12, "first_name": …, "last_name": …, "nickname": …, "balance": 250}
+    POST /customers/12/orders    {"items": [{"name": "Pivo", "price": 40, "count": 2}], "allow_overdraft": false}
+                                 201 {"total": 80, "balance": 170}
+                                 409 {"error": "insufficient_funds", "balance": 50, "total": 80} when allow_overdraft isn't set
+
+Only the items of the buttons can be ordered, at their prices. With api.token set every request needs
+the header Authorization: Bearer <token>. Errors are {"error": …} with a 4xx or 5xx status.
+
+All the database calls go through one DBWorker (the till's own one when it runs inside the app), so the requests
+never write at the same time and orders arriving together are committed in one transaction. """
+
+import argparse, asyncio, dataclasses, hmac, json, os.path, re, threading, traceback
+import dbutils, service
+from dbworker import DBWorker
+from config import load_config
+
+# longest request body, an order is a few hundred bytes
+MAX_BODY = 64 * 1024
+MAX_HEADERS = 100
+# lines of one order
+MAX_ITEMS = 100
+# the till only takes 4 digit numbers
+CUSTOMER_PATH = r"/customers/([0-9]{1,4})"
+
+STATUS_TEXTS = {
+    200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+    409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error",
+}
+
+class HttpError(Exception):
+    """Answered as {"error": error, **details} with the status"""
+    def __init__(self, status, error, **details):
+        Exception.__init__(self, error)
+        self.status = status
+        self.body = {"error": error, **details}
+
+class ApiServer:
+    """Serves the API on its own thread with its own event loop, the database calls go to worker"""
+
+    def __init__(self, worker, items, host="127.0.0.1", port=8765, token=None):
+        self.worker = worker
+        self.prices = {}
+        for name, price in items:
+            self.prices.setdefault(name, set()).add(price)
+        self.menu = [{"name": name, "price": price} for name, price in items]
+        self.host = host
+        self.port = port
+        self.token = token
+        # orders saved so far, the app adds them to the changes it reloads the shown frame after
+        self.orders = 0
+        self.routes = [
+            (re.compile("/items"), {"GET": self.get_items}),
+            (re.compile(CUSTOMER_PATH), {"GET": self.get_customer}),
+            (re.compile(CUSTOMER_PATH + "/orders"), {"POST": self.post_order}),
+        ]
+
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="API", daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        except OSError as ex:
+            # the port is taken, the caller gets it from __init__
+            self.error = ex
+            self.started.set()
+            return
+        # port 0 picks a free one
+        self.port = server.sockets[0].getsockname()[1]
+        self.started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    def close(self):
+        """Stops the server, connections in the middle of a request are dropped"""
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    async def db(self, name, *args, **kwargs):
+        return await asyncio.wrap_future(self.worker.submit(name, *args, **kwargs))
+
+    async def handle(self, reader, writer):
+        """One connection, its requests are answered one after another while the client keeps it open"""
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body, keep_alive = request
+                    status, answer = await self.respond(method, path, headers, body)
+                except HttpError as ex:
+                    # the rest of a request that couldn't be read would be taken for the next one
+                    status, answer, keep_alive = ex.status, ex.body, False
+                self.write_response(writer, status, answer, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """(method, path, headers, body, keep_alive) of the next request, None when the client closed the connection"""
+        try:
+            line = await reader.readline()
+            if not line:
+                return None
+            method, target, version = line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n"):
+                    break
+                if not line or len(headers) >= MAX_HEADERS:
+                    raise HttpError(400, "bad_request")
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HttpError(400, "bad_request") from None
+
+        if "transfer-encoding" in headers:
+            raise HttpError(400, "bad_request", message="send Content-Length")
+        length = headers.get("content-length", "0")
+        if not length.isdigit():
+            raise HttpError(400, "bad_request")
+        if int(length) > MAX_BODY:
+            raise HttpError(413, "too_large")
+        body = await reader.readexactly(int(length))
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        return method, target.partition("?")[0], headers, body, keep_alive
+
+    def write_response(self, writer, status, answer, keep_alive):
+        body = json.dumps(answer, ensure_ascii=False).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {STATUS_TEXTS[status]}\r\n"
+                     f"Content-Type: application/json; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body)
+
+    async def respond(self, method, path, headers, body):
+        """(status, answer) of a request that was read whole"""
+        try:
+            # compare_digest takes as long whatever the wrong token is
+            if self.token is not None and not hmac.compare_digest(headers.get("authorization", "").encode("latin-1"),
+                                                                  f"Bearer {self.token}".encode("utf-8")):
+                raise HttpError(401, "unauthorized")
+            for pattern, handlers in self.routes:
+                match = pattern.fullmatch(path)
+                if match:
+                    break
+            else:
+                raise HttpError(404, "not_found")
+            handler = handlers.get(method)
+            if handler is None:
+                raise HttpError(405, "method_not_allowed")
+            return await handler(*match.groups(), body=body)
+        except HttpError as ex:
+            return ex.status, ex.body
+        except Exception:
+            traceback.print_exc()
+            return 500, {"error": "internal"}
+
+    async def get_items(self, body):
+        return 200, self.menu
+
+    async def get_customer(self, customer_id, body):
+        return 200, dataclasses.asdict(await self.db("get_info", int(customer_id)))
+
+    async def post_order(self, customer_id, body):
+        customer_id = int(customer_id)
+        order, allow_overdraft = self.parse_order(body)
+        try:
+            await self.db("save_order", customer_id, order, allow_overdraft=allow_overdraft)
+        except dbutils.InsufficientFunds as ex:
+            raise HttpError(409, "insufficient_funds", balance=ex.balance, total=ex.total) from None
+        self.orders += 1
+        total = sum(price * count for (_, price), count in order.items())
+        return 201, {"total": total, "balance": await self.db("get_money", customer_id)}
+
+    def parse_order(self, body):
+        """The order as {(item_name, item_cost): count} for save_order and allow_overdraft, HttpError when it's wrong"""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise HttpError(400, "bad_json") from None
+        items = data.get("items") if isinstance(data, dict) else None
+        allow_overdraft = data.get("allow_overdraft", False) if isinstance(data, dict) else None
+        if not isinstance(items, list) or not 0 < len(items) <= MAX_ITEMS or not isinstance(allow_overdraft, bool):
+            raise HttpError(400, "bad_order", message=f"items must be a list of 1 to {MAX_ITEMS} items, allow_overdraft true or false")
+        basket = service.Basket()
+        for item in items:
+            if not isinstance(item, dict):
+                raise HttpError(400, "bad_order", message="an item must be {\"name\": …, \"price\": …, \"count\": …}")
+            name, price, count = item.get("name"), item.get("price"), item.get("count", 1)
+            # bool is an int too
+            if type(count) is not int or count < 1:
+                raise HttpError(400, "bad_order", message=f"count {count!r} of {name!r} isn't a positive number")
+            # the prices are whole crowns, 40.0 would make the total a float
+            if not isinstance(name, str) or type(price) is not int or price not in self.prices.get(name, ()):
+                raise HttpError(400, "unknown_item", name=name, price=price)
+            basket.add(name, price, count)
+        return basket.lines, allow_overdraft
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--db", default=dbutils.DB_PATH)
+    parser.add_argument("--config", default="./config.json", help="the items and api.token are taken from it")
+    parser.add_argument("--host", help="address to listen on, api.host of the config by default")
+    parser.add_argument("--port", type=int, help="api.port of the config by default")
+    args = parser.parse_args()
+
+    config = load_config(args.config, os.path.splitext(args.config)[0] + ".cache")
+    dbutils.use_database(args.db)
+    dbutils.prepare_db()
+    worker = DBWorker()
+    items = service.menu_items(config)
+    worker.submit("warm_cache")
+    worker.submit("sync_items", [name for name, _ in items])
+    server = ApiServer(worker, items, args.host or config["api.host"], args.port or config["api.port"], config["api.token"])
+    print(f"listening on {server.host}:{server.port}", flush=True)
+    try:
+        while server.thread.is_alive():
+            server.thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        worker.close()
+        dbutils.close_connections()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+""" Backups of the database made with the SQLite backup API on a background thread, the tills can keep working during them """
+
+import datetime, glob, os, os.path, queue, sqlite3, threading, time, traceback
+from concurrent.futures import Future
+import dbutils
+
+# pages copied in one step, the database is only read locked during a step
+BACKUP_PAGES = 256
+# seconds between the steps, lets the tills in
+STEP_SLEEP = 0.005
+# a write by another connection makes the backup start over, after this many restarts the rest is copied in one step
+MAX_RESTARTS = 3
+
+class BackupFailed(Exception):
+    """The copy didn't pass PRAGMA quick_check"""
+
+class _Restarted(Exception):
+    pass
+
+def backup_name(now=None):
+    """File name of a backup made now, e.g. prachy-20250101-120000.db, they sort from the oldest"""
+    now = now or datetime.datetime.now()
+    return f"{os.path.splitext(os.path.basename(dbutils.DB_PATH))[0]}-{now:%Y%m%d-%H%M%S}.db"
+
+def list_backups(directory):
+    """Paths of the backups in directory, oldest first"""
+    stem = os.path.splitext(os.path.basename(dbutils.DB_PATH))[0]
+    return sorted(glob.glob(os.path.join(glob.escape(directory), f"{stem}-????????-??????.db")))
+
+def _copy(path, pages, sleep, progress):
+    restarts = 0
+    remaining_before = None
+    
+    def step(status, remaining, total):
+        nonlocal restarts, remaining_before
+        if remaining_before is not None and remaining > remaining_before:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise _Restarted()
+        remaining_before = remaining
+        if progress:
+            progress(remaining, total)
+    
+    source = sqlite3.connect(dbutils.DB_PATH)
+    target = sqlite3.connect(path)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=step, sleep=sleep)
+        except _Restarted:
+            # in WAL mode a read doesn't block writers, so one step holding the read lock doesn't stop the tills either
+            remaining_before = None
+            source.backup(target, progress=step)
+    finally:
+        target.close()
+        source.close()
+    return restarts
+
+def make_backup(directory, keep, pages=BACKUP_PAGES, sleep=STEP_SLEEP, progress=None):
+    """Copies the database into a new file in directory, checks the copy with PRAGMA quick_check
+    and only then deletes the oldest backups, so at most keep of them stay. progress(remaining_pages, total_pages)
+    is called after every step. Returns the path of the new backup."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, backup_name())
+    part = path + ".part"
+    try:
+        _copy(part, pages, sleep, progress)
+        
+        check = sqlite3.connect(part)
+        try:
+            result = check.execute("PRAGMA quick_check;").fetchall()
+        finally:
+            check.close()
+        if result != [("ok",)]:
+            raise BackupFailed("\n".join(row[0] for row in result))
+        os.replace(part, path)
+    except BaseException:
+        for leftover in (part, part + "-wal", part + "-shm", part + "-journal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    
+    for old in list_backups(directory)[:-keep]:
+        os.remove(old)
+    return path
+
+class BackupScheduler:
+    """Makes a backup every interval minutes and whenever backup_now() is called, one at a time on its own thread"""
+    
+    def __init__(self, directory, keep, interval=0):
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+        self.requests = queue.Queue()
+        
+        self.thread = threading.Thread(target=self.run, name="Backups", daemon=True)
+        self.thread.start()
+    
+    def backup_now(self):
+        """Returns a Future of the path of the backup"""
+        future = Future()
+        self.requests.put(future)
+        return future
+    
+    def close(self):
+        """Waits for a running backup and stops the thread"""
+        self.requests.put(None)
+        self.thread.join()
+    
+    def run(self):
+        next_backup = time.monotonic() + self.interval * 60 if self.interval else None
+        while True:
+            try:
+                future = self.requests.get(timeout=None if next_backup is None else max(0, next_backup - time.monotonic()))
+            except queue.Empty:
+                # the scheduled one, nobody waits for its result
+                future = Future()
+            if future is None:
+                break
+            
+            future.set_running_or_notify_cancel()
+            try:
+                path = make_backup(self.directory, self.keep)
+                print("backup:", path, flush=True)
+                future.set_result(path)
+            except Exception as ex:
+                traceback.print_exc()
+                future.set_exception(ex)
+            if self.interval:
+                next_backup = time.monotonic() + self.interval * 60
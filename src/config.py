@@ -1,7 +1,28 @@
+import hashlib, json
+
 
 schema = {
     'button.size': {'type': 'integer', 'required': True},
     'button.spacing': {'type': 'integer', 'required': True},
+    # the database file, relative to the directory the app is started in
+    'database': {'type': 'string', 'default': 'prachy.db'},
+    # backups of prachy.db, see backup.py. Every backup.interval minutes (0 turns the scheduled ones off), the newest backup.keep are kept
+    'backup.directory': {'type': 'string', 'default': 'backups'},
+    'backup.interval': {'type': 'integer', 'min': 0, 'default': 60},
+    'backup.keep': {'type': 'integer', 'min': 1, 'default': 10},
+    # timing of the database calls and the slow UI paths, see instrument.py. Calls slower than diagnostics.slow_ms go to slow_ops.log
+    'diagnostics': {'type': 'boolean', 'default': False},
+    'diagnostics.slow_ms': {'type': 'number', 'min': 0, 'default': 100},
+    # traces of what was done at the till for bench/replay.py, see recorder.py
+    'recorder': {'type': 'boolean', 'default': False},
+    'recorder.directory': {'type': 'string', 'default': 'traces'},
+    # month and day (MM-DD) the season starts, the sales report shows the last season that started
+    'report.season_start': {'type': 'string', 'regex': '^[0-9]{2}-[0-9]{2}$', 'default': '01-01'},
+    # HTTP API for orders from phones, see api.py. api.host 0.0.0.0 opens it to the whole network, then set api.token
+    'api': {'type': 'boolean', 'default': False},
+    'api.host': {'type': 'string', 'default': '127.0.0.1'},
+    'api.port': {'type': 'integer', 'min': 0, 'max': 65535, 'default': 8765},
+    'api.token': {'type': 'string', 'nullable': True, 'default': None},
     'buttons': {
         'type': 'list',
         'required': True,
@@ -16,3 +37,37 @@ schema = {
             }
         }
     }
+
+class ConfigError(Exception):
+    """config.json doesn't match the schema, args[0] are the cerberus errors"""
+
+def load_config(path="./config.json", cache_path="./config.cache"):
+    """Loads and validates the config. The normalized config is cached together with a hash of the file and of the schema,
+    while neither of them changes the validation is skipped and cerberus isn't even imported"""
+    with open(path, "rb") as infil:
+        raw = infil.read()
+    digest = hashlib.sha256(raw + repr(schema).encode("utf-8")).hexdigest()
+    
+    try:
+        with open(cache_path, encoding="utf-8") as infil:
+            cached = json.load(infil)
+        if cached.get("hash") == digest:
+            return cached["config"]
+    except (OSError, ValueError, AttributeError, KeyError):
+        pass
+    
+    config = json.loads(raw.decode("utf-8"))
+    
+    # importing cerberus takes a while, only do it when the config has to be validated
+    from cerberus import Validator
+    val = Validator(schema)
+    if not val.validate(config):
+        raise ConfigError(val.errors)
+    config = val.normalized(config)
+    
+    try:
+        with open(cache_path, "w", encoding="utf-8") as outfil:
+            json.dump({"hash": digest, "config": config}, outfil, ensure_ascii=False)
+    except OSError:
+        pass
+    return config
@@ -1,3 +1,4 @@
+import time
 from dataclasses import dataclass
 
 @dataclass(order = True, frozen = True)
@@ -7,4 +8,32 @@ class CustomerInfo:
     last_name: str
     nickname: str
     balance: int
-    
\ No newline at end of file
+    
+@dataclass(frozen = True)
+class PaymentRecord:
+    payment_id: int
+    description: str
+    stamp: int # seconds since the epoch, UTC
+    balance_change: int
+    balance: int # balance of the customer right after this payment
+    orders: tuple # (item_name, count, cost_total) of every ordered item
+    
+    @property
+    def key(self):
+        """Position in the history, used as before/after in dbutils.get_payment_list"""
+        return (self.stamp, self.payment_id)
+    
+    @property
+    def stamp_text(self):
+        """The stamp the way the database used to store it"""
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(self.stamp))
+
+@dataclass(frozen = True)
+class SalesReport:
+    since: str # first day, YYYY-MM-DD
+    until: str # last day, included
+    added: int # credit topped up
+    removed: int # credit paid out
+    spent: int # credit spent on orders
+    orders: int # number of orders
+    items: tuple # (item_name, count, revenue) of every item sold, the most sold first
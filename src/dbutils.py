@@ -1,8 +1,172 @@
-import sqlite3
+import sqlite3, threading, calendar, dataclasses, datetime, functools, json, os.path, pathlib, random, re, time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from data_classes import *
 
 APP_NAME = "BratroPrachy"
-DB_VERSION = '2'
+DB_VERSION = '11'
+DB_PATH = "prachy.db"
+# DB_PATH of a database in memory, see use_database
+MEMORY = ":memory:"
+
+# payments.stamp is in seconds since the epoch, these are beyond any of them
+MIN_STAMP = -2**62
+MAX_STAMP = 2**62
+DAY = 24 * 3600
+
+# prepared statements kept per connection, dbutils has a few dozen distinct queries
+STATEMENT_CACHE_SIZE = 128
+# how long a connection waits for another till to finish writing, then writes are retried LOCK_RETRIES times with backoff
+BUSY_TIMEOUT = 5000
+LOCK_RETRIES = 5
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+# the database in memory lives while a connection to it is open, this one keeps it until use_database switches to another one
+_memory_keeper = None
+_memory_uri = None
+_memory_count = 0
+
+# CustomerInfo of recently used customers. Writes in dbutils update it, changes from other connections clear it
+CACHE_SIZE = 10000
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_external_changes = 0
+
+class InsufficientFunds(Exception):
+    """save_order without allow_overdraft would leave the customer in debt"""
+    def __init__(self, balance, total):
+        Exception.__init__(self, f"Kredit {balance}, objednávka za {total}")
+        self.balance = balance
+        self.total = total
+
+def use_database(path):
+    """Switches to the database at path, the connections to the one before are closed. MEMORY is a new empty database in memory,
+    shared by the threads of this process like a file would be and dropped when another database is used, for tests and benchmarks"""
+    global DB_PATH, _memory_keeper
+    close_connections()
+    clear_cache()
+    if _memory_keeper is not None:
+        _memory_keeper.close()
+        _memory_keeper = None
+    DB_PATH = path
+
+def _open_memory():
+    global _memory_keeper, _memory_uri, _memory_count
+    _memory_count += 1
+    # the memdb VFS shares a database named with a / among the connections of the process, with the usual locking
+    # unlike the shared cache of mode=memory, whose table locks don't wait for busy_timeout
+    _memory_uri = f"file:/{APP_NAME}-memory-{_memory_count}?vfs=memdb"
+    _memory_keeper = sqlite3.connect(_memory_uri, uri=True, check_same_thread=False)
+
+def _connect():
+    if DB_PATH == MEMORY and _memory_keeper is None:
+        _open_memory()
+    # isolation_level=None turns off the implicit transactions of the sqlite3 module, transaction() handles them instead
+    # uri lets _attach_archives open the archives read only, a plain path still works as before
+    conn = sqlite3.connect(_memory_uri if DB_PATH == MEMORY else DB_PATH, isolation_level=None, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE, uri=True)
+    # a database in memory has no WAL, it stays in its own journal mode
+    conn.execute("PRAGMA journal_mode=WAL;")
+    # NORMAL is durable in WAL mode except for the last transactions on power loss, and it doesn't fsync on every commit
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA foreign_keys=ON;")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT};")
+    return conn
+
+def get_connection():
+    """Returns the connection of the current thread, opens it on first use. Every thread gets its own one, they are kept open until close_connections()"""
+    if getattr(_local, "generation", None) != _generation:
+        conn = _connect()
+        with _connections_lock:
+            _connections.append(conn)
+        _local.conn = conn
+        _local.depth = 0
+        # _cache_update changes made in the transaction, applied to the cache after its COMMIT
+        _local.cache_changes = []
+        _local.data_version = None
+        _local.archives = None
+        _local.generation = _generation
+    return _local.conn
+
+def close_connections():
+    """Closes all open connections, threads will open new ones when they need them. Call only when no query is running."""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+
+def close_thread_connection():
+    """Closes the connection of the current thread, for threads that are about to end"""
+    if getattr(_local, "generation", None) == _generation:
+        with _connections_lock:
+            _connections.remove(_local.conn)
+        _local.conn.close()
+        _local.generation = None
+
+def _is_locked(ex):
+    return isinstance(ex, sqlite3.OperationalError) and ("locked" in str(ex) or "busy" in str(ex))
+
+def retry_locked(func):
+    """Runs func again with a growing delay when another till keeps the database locked longer than BUSY_TIMEOUT.
+    Inside of an outer transaction the error is left to the outer one, only a whole transaction can be repeated."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = 0.1
+        for attempt in range(LOCK_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as ex:
+                if getattr(_local, "depth", 0) or not _is_locked(ex) or attempt == LOCK_RETRIES - 1:
+                    raise
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+    return wrapper
+
+def _cursor():
+    return get_connection().cursor()
+
+@contextmanager
+def transaction():
+    """Runs the block in one write transaction and yields a cursor.
+    Nested blocks become savepoints, so callers can group several dbutils calls into one commit:
+    
+        with dbutils.transaction():
+            dbutils.add_funds(1, 100)
+            dbutils.save_order(1, order)
+    """
+    cur = _cursor()
+    depth = _local.depth
+    changes = len(_local.cache_changes)
+    if depth:
+        cur.execute(f"SAVEPOINT sp{depth};")
+    else:
+        # IMMEDIATE takes the write lock right away, so the transaction can't fail halfway on a lock upgrade
+        cur.execute("BEGIN IMMEDIATE;")
+    _local.depth = depth + 1
+    try:
+        yield cur
+        if depth:
+            cur.execute(f"RELEASE sp{depth};")
+        else:
+            cur.execute("COMMIT;")
+            _apply_cache_changes()
+    except BaseException:
+        # the changes being undone never get to the cache
+        del _local.cache_changes[changes:]
+        if depth:
+            cur.execute(f"ROLLBACK TO sp{depth};")
+            cur.execute(f"RELEASE sp{depth};")
+        elif get_connection().in_transaction:
+            cur.execute("ROLLBACK;")
+        raise
+    finally:
+        _local.depth = depth
 
 def get_version(cur):
     """return version number as a str if version was found or None if not"""
@@ -38,18 +202,159 @@ def check_is_fresh(cur):
     
     return cur.fetchone()[0] < 1
 
-def create_db_newest(cur):
-    cur.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-                payment_id INTEGER PRIMARY KEY,
-                customer_id INTEGER NOT NULL,
-                stamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                description TEXT,
-                balance_change INTEGER NOT NULL
-            );
-        """)
+# customer_balances holds SUM(balance_change) of every customer, the triggers keep it in sync with payments
+BALANCES_SQL = [
+    """
+        CREATE TABLE IF NOT EXISTS customer_balances (
+            customer_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 0
+        );
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS payments_balance_insert AFTER INSERT ON payments BEGIN
+            INSERT INTO customer_balances (customer_id, balance) VALUES (NEW.customer_id, NEW.balance_change)
+            ON CONFLICT(customer_id) DO UPDATE SET balance = balance + excluded.balance;
+        END;
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS payments_balance_update AFTER UPDATE OF customer_id, balance_change ON payments BEGIN
+            UPDATE customer_balances SET balance = balance - OLD.balance_change WHERE customer_id = OLD.customer_id;
+            INSERT INTO customer_balances (customer_id, balance) VALUES (NEW.customer_id, NEW.balance_change)
+            ON CONFLICT(customer_id) DO UPDATE SET balance = balance + excluded.balance;
+        END;
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS payments_balance_delete AFTER DELETE ON payments BEGIN
+            UPDATE customer_balances SET balance = balance - OLD.balance_change WHERE customer_id = OLD.customer_id;
+        END;
+    """,
+]
+
+# covering indexes for the per customer and per payment lookups, checked by bench/query_plans.py
+INDEXES_SQL = [
+    """
+        CREATE INDEX IF NOT EXISTS payments_customer ON payments (customer_id, stamp, balance_change, description);
+    """,
+    """
+        CREATE INDEX IF NOT EXISTS orders_payment ON orders (payment_id, item_id, item_cost, count);
+    """,
+]
+
+# the stamps are seconds since the epoch in UTC, what CURRENT_TIMESTAMP used to give as text.
+# AUTOINCREMENT never gives out an id again, the archived payments keep theirs after they are deleted here
+PAYMENTS_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER NOT NULL,
+        stamp INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        description TEXT,
+        balance_change INTEGER NOT NULL
+    );
+"""
+
+# time ranges over everybody, for get_payments_between and the ledger export. The ones of a single customer use payments_customer
+STAMP_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS payments_stamp ON payments (stamp);
+"""
+
+# orders_payment from before the items table, the archive files keep the item names and use it too
+NAMED_ORDERS_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS orders_payment ON orders (payment_id, item_name, item_cost, count);
+"""
+
+# the catalog item of the order lines saved without an item name, before the catalog the name could be NULL
+UNNAMED_ITEM = "(bez názvu)"
+
+# every order line refers to an item of the catalog instead of repeating its name. The price is still kept per line,
+# so a button that changes its price in config.json doesn't change the history. sync_items adds the buttons to the catalog
+ITEMS_SQL = [
+    """
+        CREATE TABLE IF NOT EXISTS items (
+            item_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+    """,
+]
+
+ORDERS_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payment_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        item_cost INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        cost_total INTEGER GENERATED ALWAYS AS (item_cost*count),
         
-    cur.execute("""
+        FOREIGN KEY (payment_id) REFERENCES payments(payment_id) ON DELETE CASCADE,
+        FOREIGN KEY (item_id) REFERENCES items(item_id)
+    );
+"""
+
+# the order lines with the item names, for everything that shows or exports them. The name is a subquery, not a join,
+# so the view stays a single table SQLite can flatten into the LEFT JOIN of the ledger export
+ORDER_LINES_SQL = """
+    CREATE VIEW IF NOT EXISTS order_lines AS
+      SELECT order_id, payment_id, item_id, (SELECT name FROM items WHERE items.item_id = orders.item_id) AS item_name,
+        item_cost, count, cost_total FROM orders;
+"""
+
+# full text index of the customer names for search_customers, kept in sync with customers by the triggers.
+# remove_diacritics lets "jez" find "Ježek", the prefix indexes make the first letters typed fast
+SEARCH_SQL = [
+    """
+        CREATE VIRTUAL TABLE IF NOT EXISTS customers_search USING fts5 (
+            nickname, first_name, last_name,
+            content='customers', content_rowid='customer_id',
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+        );
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS customers_search_insert AFTER INSERT ON customers BEGIN
+            INSERT INTO customers_search (rowid, nickname, first_name, last_name) VALUES (NEW.customer_id, NEW.nickname, NEW.first_name, NEW.last_name);
+        END;
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS customers_search_update AFTER UPDATE ON customers BEGIN
+            INSERT INTO customers_search (customers_search, rowid, nickname, first_name, last_name) VALUES ('delete', OLD.customer_id, OLD.nickname, OLD.first_name, OLD.last_name);
+            INSERT INTO customers_search (rowid, nickname, first_name, last_name) VALUES (NEW.customer_id, NEW.nickname, NEW.first_name, NEW.last_name);
+        END;
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS customers_search_delete AFTER DELETE ON customers BEGIN
+            INSERT INTO customers_search (customers_search, rowid, nickname, first_name, last_name) VALUES ('delete', OLD.customer_id, OLD.nickname, OLD.first_name, OLD.last_name);
+        END;
+    """,
+]
+
+# archival moves old payments into a file per year (see iter_archive) and leaves one ARCHIVE_CHECKPOINT payment
+# per customer with their sum. ledger_archives lists the files with the last archival batch committed to each of them,
+# 'archive_cutoff' in db_info is the date before which all payments are archived
+ARCHIVES_SQL = [
+    """
+        CREATE TABLE IF NOT EXISTS ledger_archives (
+            period TEXT PRIMARY KEY,
+            file TEXT NOT NULL,
+            batch INTEGER NOT NULL
+        );
+    """,
+    """
+        CREATE UNIQUE INDEX IF NOT EXISTS payments_checkpoint ON payments (customer_id) WHERE description = 'ARCHIVE_CHECKPOINT';
+    """,
+]
+
+# schema of the archive files, archive_batch tells which archival batch copied the payment there
+ARCHIVE_FILE_SQL = [
+    """
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id INTEGER PRIMARY KEY,
+            customer_id INTEGER NOT NULL,
+            stamp INTEGER NOT NULL,
+            description TEXT,
+            balance_change INTEGER NOT NULL,
+            archive_batch INTEGER NOT NULL
+        );
+    """,
+    """
         CREATE TABLE IF NOT EXISTS orders (
             order_id INTEGER PRIMARY KEY,
             payment_id INTEGER NOT NULL,
@@ -60,7 +365,49 @@ def create_db_newest(cur):
             
             FOREIGN KEY (payment_id) REFERENCES payments(payment_id) ON DELETE CASCADE
         );
-    """)
+    """,
+    """
+        CREATE INDEX IF NOT EXISTS archive_batch ON payments (archive_batch);
+    """,
+] + INDEXES_SQL[:1] + [NAMED_ORDERS_INDEX_SQL]
+
+# totals per day for the reports, so they never have to read the ledger. day is the number of the day since 1970-01-01
+# in UTC, like the stamps. The dbutils writes keep them up to date in their transactions, archival leaves them as they are.
+# 'rollups_stale' in db_info makes prepare_db rebuild them
+ROLLUPS_SQL = [
+    """
+        CREATE TABLE IF NOT EXISTS daily_items (
+            day INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            revenue INTEGER NOT NULL,
+            
+            PRIMARY KEY (day, item_id),
+            FOREIGN KEY (item_id) REFERENCES items(item_id)
+        ) WITHOUT ROWID;
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS daily_funds (
+            day INTEGER PRIMARY KEY,
+            added INTEGER NOT NULL,
+            removed INTEGER NOT NULL,
+            spent INTEGER NOT NULL,
+            orders INTEGER NOT NULL
+        );
+    """,
+]
+
+# upgrades from these versions rebuild big tables, prepare_db vacuums the database afterwards to give the freed space back
+VACUUM_AFTER_UPGRADE = {'6', '7', '9'}
+
+def create_db_newest(cur):
+    cur.execute(PAYMENTS_SQL.format(table="payments"))
+    
+    for expr in ITEMS_SQL + [ORDERS_SQL.format(table="orders"), ORDER_LINES_SQL]:
+        cur.execute(expr)
+        
+    for expr in BALANCES_SQL + INDEXES_SQL + [STAMP_INDEX_SQL]:
+        cur.execute(expr)
     
     cur.execute("""
         CREATE TABLE IF NOT EXISTS customers (
@@ -71,6 +418,9 @@ def create_db_newest(cur):
         );
     """)
     
+    for expr in SEARCH_SQL + ARCHIVES_SQL + ROLLUPS_SQL:
+        cur.execute(expr)
+    
     cur.execute("""
         CREATE TABLE IF NOT EXISTS db_info (
             key TEXT PRIMARY KEY,
@@ -85,6 +435,8 @@ def create_db_newest(cur):
     """, (APP_NAME, DB_VERSION))
 
 def upgrade_db(cur, from_version):
+    """Upgrades the database step by step to DB_VERSION. Returns the size of the database before the first step
+    that rebuilds big tables (see VACUUM_AFTER_UPGRADE), None when there was none"""
     
     # makes simple upgrades easier to write
     def create_from_sql(expr, ret):
@@ -96,151 +448,863 @@ def upgrade_db(cur, from_version):
                     cur.execute(exp)
             return ret
         return new_func
+    
+    def add_balances(cur):
+        for expr in BALANCES_SQL:
+            cur.execute(expr)
+        cur.execute("""
+            INSERT INTO customer_balances (customer_id, balance)
+              SELECT customer_id, SUM(balance_change) FROM payments GROUP BY customer_id;
+        """)
+        return '3'
+    
+    def add_items(cur):
+        # orders is rebuilt with an item_id in place of item_name, the order_ids stay the same
+        for expr in ITEMS_SQL:
+            cur.execute(expr)
+        cur.execute("""
+            INSERT INTO items (name) SELECT IFNULL(item_name, ?) FROM orders GROUP BY 1 ORDER BY MIN(order_id);
+        """, (UNNAMED_ITEM,))
+        cur.execute(ORDERS_SQL.format(table="orders_new"))
+        cur.execute("""
+            INSERT INTO orders_new (order_id, payment_id, item_id, item_cost, count)
+              SELECT order_id, payment_id, item_id, item_cost, count FROM orders
+                JOIN items ON items.name = IFNULL(item_name, ?);
+        """, (UNNAMED_ITEM,))
+        cur.execute("DROP TABLE orders;")
+        cur.execute("ALTER TABLE orders_new RENAME TO orders;")
+        for expr in INDEXES_SQL + [ORDER_LINES_SQL]:
+            cur.execute(expr)
+        return '7'
+    
+    def integer_stamps(cur):
+        # payments is rebuilt with the stamps as integers, prepare_db turns the foreign keys off for it,
+        # otherwise dropping the old table would delete all the orders
+        cur.execute(PAYMENTS_SQL.format(table="payments_new"))
+        cur.execute("""
+            INSERT INTO payments_new (payment_id, customer_id, stamp, description, balance_change)
+              SELECT payment_id, customer_id, CAST(strftime('%s', stamp) AS INTEGER), description, balance_change FROM payments;
+        """)
+        cur.execute("DROP TABLE payments;")
+        cur.execute("ALTER TABLE payments_new RENAME TO payments;")
+        # the triggers and indexes went with the old table
+        for expr in BALANCES_SQL + INDEXES_SQL + ARCHIVES_SQL + [STAMP_INDEX_SQL]:
+            cur.execute(expr)
+        
+        # the archive files commit on their own. Only text stamps are converted, so a failed upgrade can simply run again.
+        # A missing file can't be converted, _attach_archives complains about it
+        cur.execute("SELECT file FROM ledger_archives;")
+        for file, in cur.fetchall():
+            if not os.path.exists(_archive_path(file)):
+                continue
+            archive = _open_archive(file)
+            try:
+                archive.execute("""
+                    UPDATE payments SET stamp = CAST(strftime('%s', stamp) AS INTEGER) WHERE typeof(stamp) = 'text';
+                """)
+            finally:
+                archive.close()
+        return '8'
+    
+    def add_rollups(cur):
+        for expr in ROLLUPS_SQL:
+            cur.execute(expr)
+        # filling them needs the archives attached, which can't be done in a transaction
+        cur.execute("INSERT INTO db_info (key, value) VALUES ('rollups_stale', '1') ON CONFLICT(key) DO UPDATE SET value = '1';")
+        return '9'
+    
+    def autoincrement_ids(cur):
+        # payments and orders are rebuilt with AUTOINCREMENT keys, before it the ids of the newest payments
+        # were given out again once they got archived. The view on orders would stop the rename
+        cur.execute("DROP VIEW order_lines;")
+        for sql, table, columns in ((PAYMENTS_SQL, "payments", "payment_id, customer_id, stamp, description, balance_change"),
+                                    (ORDERS_SQL, "orders", "order_id, payment_id, item_id, item_cost, count")):
+            cur.execute(sql.format(table=table + "_new"))
+            cur.execute(f"INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table};")
+            cur.execute(f"DROP TABLE {table};")
+            cur.execute(f"ALTER TABLE {table}_new RENAME TO {table};")
+        for expr in BALANCES_SQL + INDEXES_SQL + ARCHIVES_SQL + [STAMP_INDEX_SQL, ORDER_LINES_SQL]:
+            cur.execute(expr)
+        
+        # the new ids start above the archived ones too
+        last_ids = {"payments": 0, "orders": 0}
+        cur.execute("SELECT file FROM ledger_archives;")
+        for file, in cur.fetchall():
+            if not os.path.exists(_archive_path(file)):
+                continue
+            archive = _open_archive(file)
+            try:
+                last_ids["payments"] = max(last_ids["payments"], archive.execute("SELECT IFNULL(MAX(payment_id), 0) FROM payments;").fetchone()[0])
+                last_ids["orders"] = max(last_ids["orders"], archive.execute("SELECT IFNULL(MAX(order_id), 0) FROM orders;").fetchone()[0])
+            finally:
+                archive.close()
+        for table, last_id in last_ids.items():
+            cur.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?;", (last_id, table))
+            if not cur.rowcount:
+                cur.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?);", (table, last_id))
+        return '10'
+    
+    def name_unnamed_items(cur):
+        # the upgrade to version 7 gave the order lines without a name the item '', which looked like a button without a text.
+        # The archives keep the names, there it is '' or NULL from before the catalog
+        cur.execute("UPDATE items SET name = ? WHERE name = '';", (UNNAMED_ITEM,))
+        cur.execute("SELECT file FROM ledger_archives;")
+        for file, in cur.fetchall():
+            if not os.path.exists(_archive_path(file)):
+                continue
+            archive = _open_archive(file)
+            try:
+                archive.execute("UPDATE orders SET item_name = ? WHERE IFNULL(item_name, '') = '';", (UNNAMED_ITEM,))
+            finally:
+                archive.close()
+        return '11'
+    
     upgrades = {
         #key is version to upgrade from, function returns version it upgraded to. This will allow to add "jump" upgrade functions if upgardes would take too much time
-        '1': create_from_sql(["ALTER TABLE customers ADD COLUMN first_name TEXT;", 'ALTER TABLE customers ADD COLUMN last_name TEXT;'], '2')
+        '1': create_from_sql(["ALTER TABLE customers ADD COLUMN first_name TEXT;", 'ALTER TABLE customers ADD COLUMN last_name TEXT;'], '2'),
+        '2': add_balances,
+        '3': create_from_sql(INDEXES_SQL[:1] + [NAMED_ORDERS_INDEX_SQL], '4'),
+        '4': create_from_sql(SEARCH_SQL + ["INSERT INTO customers_search (customers_search) VALUES ('rebuild');"], '5'),
+        '5': create_from_sql(ARCHIVES_SQL, '6'),
+        '6': add_items,
+        '7': integer_stamps,
+        '8': add_rollups,
+        '9': autoincrement_ids,
+        '10': name_unnamed_items,
     }
     
+    size = None
     while from_version != DB_VERSION:
+        if size is None and from_version in VACUUM_AFTER_UPGRADE:
+            size = _db_size(cur)
         from_version=upgrades[from_version](cur)
         cur.execute("UPDATE db_info SET value = ? WHERE key='version'", (from_version,))
+    return size
+
+def _db_size(cur):
+    cur.execute("PRAGMA page_count;")
+    page_count = cur.fetchone()[0]
+    cur.execute("PRAGMA page_size;")
+    return page_count * cur.fetchone()[0]
 
 def prepare_db():
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
-        
-        version = get_version(cur)
-        
-        if not version:
-            if check_is_fresh(cur):
-                create_db_newest(cur)
+    size = None
+    # upgrades rebuild tables other tables refer to, foreign keys can only be turned off outside of a transaction
+    _cursor().execute("PRAGMA foreign_keys=OFF;")
+    try:
+        with transaction() as cur:
+            version = get_version(cur)
+            
+            if not version:
+                if check_is_fresh(cur):
+                    create_db_newest(cur)
+                else:
+                    raise Exception("Neidentifikovatelná databáze! Možná špatný .db soubor?")
+            elif int(version) > int(DB_VERSION):
+                raise Exception(f"Nepoužitelná verze databáze! Možná špatný .db soubor?\nVerze v souboru: {version}\n Verze v programu: {DB_VERSION}")
             else:
-                raise Exception("Neidentifikovatelná databáze! Možná špatný .db soubor?")
-        elif int(version) > int(DB_VERSION):
-            raise Exception(f"Nepoužitelná verze databáze! Možná špatný .db soubor?\nVerze v souboru: {version}\n Verze v programu: {DB_VERSION}")
-        else:
-            upgrade_db(cur, version)
+                size = upgrade_db(cur, version)
+                cur.execute("PRAGMA foreign_key_check;")
+                if cur.fetchone():
+                    raise Exception("Po aktualizaci databáze nesedí odkazy mezi tabulkami, zůstává původní verze.")
+    finally:
+        _cursor().execute("PRAGMA foreign_keys=ON;")
+    
+    if _get_info_value(_cursor(), "rollups_stale"):
+        rebuild_rollups()
+    
+    # VACUUM can't run inside of a transaction
+    if size is not None:
+        cur = _cursor()
+        cur.execute("VACUUM;")
+        new_size = _db_size(cur)
+        change = (new_size - size) / size if size else 0
+        print(f"database upgraded to version {DB_VERSION}: {size / 2**20:.1f} MB -> {new_size / 2**20:.1f} MB, "
+              f"{abs(change):.0%} {'larger' if change > 0 else 'smaller'}", flush=True)
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+        _cache_stats["invalidations"] += 1
+
+def cache_stats():
+    with _cache_lock:
+        return dict(_cache_stats, size=len(_cache))
+
+def _cache_put(info):
+    with _cache_lock:
+        _cache[info.customer_id] = info
+        _cache.move_to_end(info.customer_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def _cache_update(customer_id, **changes):
+    """Changes a cached customer in place, balance_change is added to the balance. Inside of a transaction
+    it waits for the COMMIT, so the cache never has a change that was rolled back or that the other threads can't see yet"""
+    _local.cache_changes.append((customer_id, changes))
+    if not _local.depth:
+        _apply_cache_changes()
+
+def _apply_cache_changes():
+    changes, _local.cache_changes = _local.cache_changes, []
+    with _cache_lock:
+        for customer_id, change in changes:
+            info = _cache.get(customer_id)
+            if info is None:
+                continue
+            if "balance_change" in change:
+                change = dict(change, balance=info.balance + change["balance_change"])
+                del change["balance_change"]
+            _cache[customer_id] = dataclasses.replace(info, **change)
+
+def data_changed():
+    """Returns True when another connection (another thread or another till) changed the database since the last check
+    from this thread. The cache is cleared then, as it only knows about the changes made through dbutils"""
+    cur = _cursor()
+    cur.execute("PRAGMA data_version;")
+    version = cur.fetchone()[0]
+    if version == _local.data_version:
+        return False
+    # a new connection doesn't know what happened before it was opened
+    global _external_changes
+    _local.data_version = version
+    _external_changes += 1
+    clear_cache()
+    return True
+
+def change_count():
+    """Counts the changes data_changed noticed so far, including this check.
+    Compare it with an older value to find out whether anything changed since, even when get_info already noticed it"""
+    data_changed()
+    return _external_changes
+
+def warm_cache():
+    """Loads the customers into the cache with one query"""
+    cur = _cursor()
+    data_changed()
+    cur.execute("""
+        SELECT customer_balances.customer_id, first_name, last_name, nickname, balance FROM customer_balances
+          LEFT JOIN customers ON customers.customer_id = customer_balances.customer_id
+        UNION ALL
+        SELECT customer_id, first_name, last_name, nickname, 0 FROM customers
+          WHERE customer_id NOT IN (SELECT customer_id FROM customer_balances)
+        LIMIT ?;
+    """, (CACHE_SIZE,))
+    for row in cur:
+        _cache_put(CustomerInfo(*row))
+
+# tables the history and the ledger export read from, the ledger_ views add the attached archives to them
+LEDGER_TABLES = {
+    False: {"payments": "payments", "orders": "order_lines"},
+    True: {"payments": "ledger_payments", "orders": "ledger_orders"},
+}
+
+def date_stamp(date):
+    """Stamp of the start of a day given as YYYY-MM-DD. The stamps are in UTC, like CURRENT_TIMESTAMP was, so are the days"""
+    return calendar.timegm(datetime.date.fromisoformat(date).timetuple())
+
+def _get_info_value(cur, key):
+    cur.execute("SELECT value FROM db_info WHERE key = ?", (key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def _archive_file(period):
+    """Name of the archive file for payments of a year, next to the database, e.g. prachy-2025.db"""
+    return f"{os.path.splitext(os.path.basename(DB_PATH))[0]}-{period}.db"
+
+def _archive_path(file):
+    return os.path.join(os.path.dirname(DB_PATH), file)
+
+def _attach_archives():
+    """Attaches the archive files to the connection of this thread and (re)creates the ledger_payments and ledger_orders views
+    over the payments here and in all of them. Payments of an archival batch that wasn't committed here yet are left out.
+    Can't be called inside of a transaction"""
+    cur = _cursor()
+    cur.execute("SELECT period, file FROM ledger_archives ORDER BY period")
+    archives = cur.fetchall()
+    if archives == _local.archives:
+        return
     
-        conn.commit()
+    attached = {name for _, name, _ in cur.execute("PRAGMA database_list;").fetchall()}
+    for period, file in archives:
+        if f"archive_{period}" in attached:
+            continue
+        path = _archive_path(file)
+        # ATTACH would create an empty file in its place
+        if not os.path.exists(path):
+            raise Exception(f"Chybí archiv plateb {path}")
+        # read only, otherwise every write transaction of this connection would lock the archives too
+        cur.execute(f"ATTACH DATABASE ? AS archive_{period};", (pathlib.Path(path).resolve().as_uri() + "?mode=ro",))
+    
+    payments = ["""
+        SELECT payment_id, customer_id, stamp, description,
+          CASE WHEN description = 'ARCHIVE_CHECKPOINT' THEN 0 ELSE balance_change END AS balance_change
+        FROM main.payments
+    """]
+    # order_lines spelled out, a view inside of a view gets materialized
+    orders = ["""
+        SELECT order_id, payment_id, item_id, (SELECT name FROM main.items WHERE items.item_id = orders.item_id) AS item_name,
+          item_cost, count, cost_total FROM main.orders
+    """]
+    for period, _ in archives:
+        committed = f"(SELECT batch FROM main.ledger_archives WHERE period = '{period}')"
+        payments.append(f"""
+            SELECT payment_id, customer_id, stamp, description, balance_change FROM archive_{period}.payments
+              WHERE archive_batch <= {committed}
+        """)
+        orders.append(f"""
+            SELECT order_id, payment_id, (SELECT item_id FROM main.items WHERE items.name = item_name) AS item_id,
+              item_name, item_cost, count, cost_total FROM archive_{period}.orders
+              WHERE payment_id IN (SELECT payment_id FROM archive_{period}.payments WHERE archive_batch <= {committed})
+        """)
+    cur.execute("DROP VIEW IF EXISTS temp.ledger_payments;")
+    cur.execute("DROP VIEW IF EXISTS temp.ledger_orders;")
+    cur.execute("CREATE TEMP VIEW ledger_payments AS " + " UNION ALL ".join(payments))
+    cur.execute("CREATE TEMP VIEW ledger_orders AS " + " UNION ALL ".join(orders))
+    _local.archives = archives
 
 def get_money(customer_id):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT SUM(balance_change) FROM payments WHERE customer_id = ?;
-        """, (customer_id,))
-        ret = cur.fetchone()[0]
-        if not ret:
-            return 0
-        return ret
+    return get_info(customer_id).balance
 
 def get_info(customer_id):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
-        
-        #sqlite3 doesn't support full outer joins for some reason. This could be solved nicer with that. Or nicer in general
-        cur.execute("""
-            SELECT :customer_id AS customer_id,
-              (SELECT first_name FROM customers WHERE customer_id = :customer_id) AS first_name,
-              (SELECT last_name FROM customers WHERE customer_id = :customer_id) AS last_name,
-              (SELECT nickname FROM customers WHERE customer_id = :customer_id) AS nickname,
-              IFNULL((SELECT SUM(balance_change) FROM payments WHERE customer_id = :customer_id), 0) AS balance
-
-        """, {"customer_id":customer_id})
-        ret = cur.fetchone()
-        if not ret:
-            ret = (customer_id, None, None, None, 0)
-        return CustomerInfo(*ret)
+    data_changed()
+    with _cache_lock:
+        info = _cache.get(customer_id)
+        if info is not None:
+            _cache.move_to_end(customer_id)
+            _cache_stats["hits"] += 1
+            return info
+        _cache_stats["misses"] += 1
+    
+    cur = _cursor()
+    
+    #sqlite3 doesn't support full outer joins for some reason. This could be solved nicer with that. Or nicer in general
+    cur.execute("""
+        SELECT :customer_id AS customer_id,
+          (SELECT first_name FROM customers WHERE customer_id = :customer_id) AS first_name,
+          (SELECT last_name FROM customers WHERE customer_id = :customer_id) AS last_name,
+          (SELECT nickname FROM customers WHERE customer_id = :customer_id) AS nickname,
+          IFNULL((SELECT balance FROM customer_balances WHERE customer_id = :customer_id), 0) AS balance
+
+    """, {"customer_id":customer_id})
+    ret = cur.fetchone()
+    if not ret:
+        ret = (customer_id, None, None, None, 0)
+    info = CustomerInfo(*ret)
+    _cache_put(info)
+    return info
         
+def search_customers(text, limit=10):
+    """Customers whose nickname, first or last name start with the words of text, by customer number.
+    Ranking the matches would have to score all of them, that's too slow for the first letter typed"""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return []
+    # every word is a quoted prefix query, so nothing typed is read as FTS syntax
+    query = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+    
+    cur = _cursor()
+    cur.execute("""
+        SELECT customers.customer_id, customers.first_name, customers.last_name, customers.nickname, IFNULL(balance, 0) FROM customers_search
+          JOIN customers ON customers.customer_id = customers_search.rowid
+          LEFT JOIN customer_balances ON customer_balances.customer_id = customers.customer_id
+          WHERE customers_search MATCH ?
+          ORDER BY customers_search.rowid
+          LIMIT ?;
+    """, (query, limit))
+    return [CustomerInfo(*row) for row in cur.fetchall()]
+
+# every payment, with a row for each of its order lines. Checkpoints only stand in for the archived payments, they are left out.
+# The range goes through payments_stamp, the stamps are written out as they used to be stored
+LEDGER_EXPORT_SQL = """
+    SELECT payments.payment_id, customer_id, datetime(stamp, 'unixepoch'), description, balance_change,
+      item_name, item_cost, count FROM {payments} AS payments
+      LEFT JOIN {orders} AS orders ON orders.payment_id = payments.payment_id
+      WHERE stamp >= :since AND stamp < :until AND description IS NOT 'ARCHIVE_CHECKPOINT'
+      ORDER BY stamp ASC, payments.payment_id ASC
+"""
+
+EXPORT_SQL = {
+    # balance of every customer
+    False: """
+        SELECT customer_balances.customer_id, first_name, last_name, nickname, balance FROM customer_balances
+          LEFT JOIN customers ON customers.customer_id = customer_balances.customer_id
+          WHERE balance != 0 OR COALESCE(first_name, last_name, nickname) IS NOT NULL
+          ORDER BY customer_balances.customer_id ASC
+    """,
+    True: LEDGER_EXPORT_SQL.format(**LEDGER_TABLES[False]),
+    "archived": LEDGER_EXPORT_SQL.format(**LEDGER_TABLES[True]),
+}
+
+def _export_sql(ledger, since):
+    """The archives are only attached when the ledger export reaches back before the archive cutoff"""
+    if not ledger:
+        return EXPORT_SQL[False]
+    cutoff = _get_info_value(_cursor(), "archive_cutoff")
+    if cutoff is None or since is not None and since >= cutoff:
+        return EXPORT_SQL[True]
+    _attach_archives()
+    return EXPORT_SQL["archived"]
+
+def _export_range(since, until):
+    """The since and until dates (YYYY-MM-DD, inclusive) as a range of stamps, the missing ones reach as far as the stamps go"""
+    return {
+        "since": MIN_STAMP if since is None else date_stamp(since),
+        "until": MAX_STAMP if until is None else date_stamp(until) + 24 * 3600,
+    }
+
+def count_export(ledger=False, since=None, until=None):
+    """Number of rows iter_export will give, for showing progress"""
+    cur = _cursor()
+    cur.execute(f"SELECT count(*) FROM ({_export_sql(ledger, since)})", _export_range(since, until))
+    return cur.fetchone()[0]
+
+def iter_export(ledger=False, since=None, until=None, chunk_size=1000):
+    """Yields the export in lists of at most chunk_size rows, so it never has to be in memory whole.
+    Without ledger it is the balance summary, with it the payments and order lines between the since and until dates (YYYY-MM-DD, inclusive),
+    archived payments included"""
+    cur = _cursor()
+    cur.execute(_export_sql(ledger, since), _export_range(since, until))
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
 def get_export():
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT payments.customer_id, first_name, last_name, nickname, SUM(balance_change) AS balance FROM payments
-              LEFT JOIN customers ON customers.customer_id = payments.customer_id
-              GROUP BY payments.customer_id
-              HAVING balance != 0 OR COALESCE(first_name, last_name, nickname) IS NOT NULL
-              ORDER BY payments.customer_id ASC;
-        """)
-        return cur.fetchall();
+    return [row for rows in iter_export() for row in rows]
 
+PAYMENTS_BETWEEN_SQL = {
+    # payments_stamp
+    False: """
+        SELECT payment_id, customer_id, stamp, description, balance_change FROM payments
+          WHERE stamp >= :start AND stamp < :end AND description IS NOT 'ARCHIVE_CHECKPOINT'
+          ORDER BY stamp ASC, payment_id ASC
+    """,
+    # payments_customer
+    True: """
+        SELECT payment_id, customer_id, stamp, description, balance_change FROM payments
+          WHERE customer_id = :customer_id AND stamp >= :start AND stamp < :end AND description IS NOT 'ARCHIVE_CHECKPOINT'
+          ORDER BY stamp ASC, payment_id ASC
+    """,
+}
+
+def get_payments_between(start, end, customer_id=None):
+    """Payments from the start stamp up to the end one, end not included, oldest first,
+    as (payment_id, customer_id, stamp, description, balance_change). Of one customer with customer_id, otherwise of everybody.
+    Reads only the range from an index. The archived payments aren't included, neither are their checkpoints"""
+    cur = _cursor()
+    cur.execute(PAYMENTS_BETWEEN_SQL[customer_id is not None], {"start": start, "end": end, "customer_id": customer_id})
+    return cur.fetchall()
+
+class _DryRun(Exception):
+    """Rolls back the transaction of a dry run of import_customers"""
+
+def _import_chunk(cur, rows, stamp):
+    # empty names leave the ones already saved as they are, unchanged rows aren't updated so the search index is left alone
+    cur.executemany("""
+        INSERT INTO customers (customer_id, first_name, last_name, nickname) VALUES (?, ?, ?, ?)
+        ON CONFLICT(customer_id) DO UPDATE SET first_name = IFNULL(excluded.first_name, first_name),
+          last_name = IFNULL(excluded.last_name, last_name), nickname = IFNULL(excluded.nickname, nickname)
+        WHERE excluded.first_name IS NOT NULL AND excluded.first_name IS NOT first_name
+          OR excluded.last_name IS NOT NULL AND excluded.last_name IS NOT last_name
+          OR excluded.nickname IS NOT NULL AND excluded.nickname IS NOT nickname;
+    """, [(customer_id, first_name or None, last_name or None, nickname or None)
+          for customer_id, first_name, last_name, nickname, _ in rows if first_name or last_name or nickname])
+    cur.executemany("""
+        INSERT INTO payments (customer_id, stamp, description, balance_change) VALUES (?, ?, ?, ?);
+    """, [(customer_id, stamp, "ADD_FUNDS" if amount > 0 else "REMOVE_FUNDS", amount)
+          for customer_id, _, _, _, amount in rows if amount])
+    # all of the payments are from the same day, one update of the rollups for the whole chunk
+    cur.execute("""
+        INSERT INTO daily_funds (day, added, removed, spent, orders) VALUES (?, ?, ?, 0, 0)
+        ON CONFLICT(day) DO UPDATE SET added = added + excluded.added, removed = removed + excluded.removed;
+    """, (stamp // DAY, sum(row[4] for row in rows if row[4] > 0), -sum(row[4] for row in rows if row[4] < 0)))
+
+def import_customers(chunks, dry_run=False, chunked=False, progress=None):
+    """Imports lists of (customer_id, first_name, last_name, nickname, amount) rows, see importer.py. The amount is added to the credit
+    as one ADD_FUNDS payment, a negative one as REMOVE_FUNDS, all of them with the same stamp. Returns the number of rows.
+    
+    Everything is one transaction, an exception from chunks rolls all of it back. With chunked every chunk is committed
+    on its own, so the tills don't wait for the whole import. dry_run does all of the work and rolls it back at the end.
+    progress(rows) is called after every chunk"""
+    stamp = int(time.time())
+    done = 0
+    try:
+        with nullcontext() if chunked and not dry_run else transaction():
+            for rows in chunks:
+                # a savepoint inside of the transaction of the whole import, a transaction of its own when chunked
+                with transaction() as cur:
+                    _import_chunk(cur, rows, stamp)
+                done += len(rows)
+                if progress:
+                    progress(done)
+            if dry_run:
+                raise _DryRun()
+    except _DryRun:
+        pass
+    # the writes above don't go through the cache
+    clear_cache()
+    return done
+
+@retry_locked
 def save_info(customer_id, first_name, last_name, nickname):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
-        print([customer_id, first_name, last_name, nickname])
+    with transaction() as cur:
         cur.execute("""
             INSERT INTO customers (customer_id, first_name, last_name, nickname) VALUES (:customer_id, :first_name, :last_name, :nickname)
             ON CONFLICT(customer_id) DO UPDATE SET first_name = :first_name, last_name = :last_name, nickname = :nickname;
         """, {"customer_id": customer_id, "first_name":first_name or None, "last_name": last_name or None, "nickname": nickname or None})
-        conn.commit()
+        _cache_update(customer_id, first_name=first_name or None, last_name=last_name or None, nickname=nickname or None)
+
+def _update_rollups(cur, payment_id, sign=1):
+    """Adds a payment with its orders to the daily rollups, sign=-1 takes it away again"""
+    params = {"payment_id": payment_id, "sign": sign}
+    cur.execute("""
+        INSERT INTO daily_funds (day, added, removed, spent, orders)
+          SELECT stamp / :day,
+            :sign * (description IS 'ADD_FUNDS') * balance_change,
+            :sign * (description IS 'REMOVE_FUNDS') * -balance_change,
+            :sign * (description IS 'ORDER_PAYMENT') * -balance_change,
+            :sign * (description IS 'ORDER_PAYMENT')
+          FROM payments WHERE payment_id = :payment_id AND description IS NOT 'ARCHIVE_CHECKPOINT'
+        ON CONFLICT(day) DO UPDATE SET added = added + excluded.added, removed = removed + excluded.removed,
+          spent = spent + excluded.spent, orders = orders + excluded.orders;
+    """, dict(params, day=DAY))
+    cur.execute("""
+        INSERT INTO daily_items (day, item_id, count, revenue)
+          SELECT stamp / :day, item_id, :sign * SUM(count), :sign * SUM(cost_total) FROM orders
+            JOIN payments ON payments.payment_id = orders.payment_id
+            WHERE orders.payment_id = :payment_id
+            GROUP BY item_id
+        ON CONFLICT(day, item_id) DO UPDATE SET count = count + excluded.count, revenue = revenue + excluded.revenue;
+    """, dict(params, day=DAY))
 
-def save_order(customer_id, order):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
+@retry_locked
+def sync_items(names):
+    """Adds the items to the catalog, in the given order, the ones already there stay as they are"""
+    with transaction() as cur:
+        cur.executemany("""
+            INSERT INTO items (name) VALUES (?) ON CONFLICT(name) DO NOTHING
+        """, [(name,) for name in names])
+
+@retry_locked
+def save_order(customer_id, order, allow_overdraft=True):
+    """Saves the order {(item_name, item_cost): count}. Without allow_overdraft it raises InsufficientFunds instead of saving
+    an order the customer can't pay, the check is in the same transaction, so another till can't spend the money in between"""
+    with transaction() as cur:
+        if not allow_overdraft:
+            total = sum(val * count for (_, val), count in order.items())
+            cur.execute("""
+                SELECT balance FROM customer_balances WHERE customer_id = ?;
+            """, (customer_id,))
+            balance = (cur.fetchone() or (0,))[0]
+            # an order that only gives money back, like a returned cup, is fine even for a customer in debt
+            if total > 0 and total > balance:
+                raise InsufficientFunds(balance, total)
+        
         cur.execute("""
             INSERT INTO payments (customer_id, description, balance_change) VALUES (?, "ORDER_PAYMENT", 0)
         """, (customer_id,))
         
         payment_id = cur.lastrowid
+        # items that aren't among the buttons sync_items added (another till's config) are added to the catalog here
         cur.executemany("""
-            INSERT INTO orders (payment_id, item_name, item_cost, count) VALUES (?, ?, ?, ?)
+            INSERT INTO items (name) VALUES (?) ON CONFLICT(name) DO NOTHING
+        """, [(name,) for name, _ in order])
+        cur.executemany("""
+            INSERT INTO orders (payment_id, item_id, item_cost, count) VALUES (?, (SELECT item_id FROM items WHERE name = ?), ?, ?)
         """, [(payment_id, name, val, count) for (name, val), count in order.items()])
         
         cur.execute("""
             UPDATE payments SET balance_change = -1 * (SELECT SUM(cost_total) FROM orders WHERE payment_id = ?) WHERE payment_id = ?
         """, (payment_id, payment_id))
-        
-        conn.commit()
+        _update_rollups(cur, payment_id)
+        _cache_update(customer_id, balance_change=-sum(val * count for (_, val), count in order.items()))
 
+@retry_locked
 def add_funds(customer_id, amount):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
+    with transaction() as cur:
         cur.execute("""
             INSERT INTO payments (customer_id, description, balance_change) VALUES (?, "ADD_FUNDS", ?)
         """, (customer_id, amount))
-        conn.commit()
+        _update_rollups(cur, cur.lastrowid)
+        _cache_update(customer_id, balance_change=amount)
 
+@retry_locked
 def remove_funds(customer_id, amount):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
+    with transaction() as cur:
         cur.execute("""
             INSERT INTO payments (customer_id, description, balance_change) VALUES (?, "REMOVE_FUNDS", ?)
         """, (customer_id, -amount))
-        conn.commit()
+        _update_rollups(cur, cur.lastrowid)
+        _cache_update(customer_id, balance_change=-amount)
 
-def get_payment_list(customer_id):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT payment_id, description, stamp, balance_change, CASE WHEN EXISTS (SELECT * FROM orders WHERE orders.payment_id = payments.payment_id) THEN 1 ELSE 0 END as order_exists FROM payments
-            WHERE customer_id = ?
-            ORDER BY stamp ASC
-        """, (customer_id,))
-        
-        payments = [list(x) for x in cur.fetchall()]
-        
-    for payment in payments:
-        if payment[4]:
-            payment[4] = get_order_list(payment[0])
-        else:
-            payment[4] = []
+# page of payments for get_payment_list, {where} and {order} are filled in by the paging direction,
+# {payments} and {orders} by whether the archives are included
+PAYMENT_PAGE_SQL = """
+    WITH page AS (
+        SELECT payment_id, description, stamp, balance_change FROM {payments}
+        WHERE customer_id = :customer_id {where}
+        ORDER BY stamp {order}, payment_id {order}
+        LIMIT :limit
+    ), balances AS (
+        -- balance after a payment is the current balance minus everything newer,
+        -- which is whatever is after the page plus the newer payments inside the page
+        SELECT page.*,
+          IFNULL((SELECT balance FROM customer_balances WHERE customer_id = :customer_id), 0)
+          - IFNULL((SELECT SUM(balance_change) FROM {payments} WHERE customer_id = :customer_id
+              AND (stamp, payment_id) > (SELECT stamp, payment_id FROM page ORDER BY stamp DESC, payment_id DESC LIMIT 1)), 0)
+          - IFNULL(SUM(balance_change) OVER (ORDER BY stamp DESC, payment_id DESC ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS balance
+        FROM page
+    )
+    -- the order lines, then a row without one for every payment. Not a LEFT JOIN, that would read the whole ledger_orders view
+    SELECT balances.payment_id, description, stamp, balance_change, balance, item_name, count, cost_total FROM balances
+      JOIN {orders} AS orders ON orders.payment_id = balances.payment_id
+    UNION ALL
+    SELECT payment_id, description, stamp, balance_change, balance, NULL, NULL, NULL FROM balances
+    ORDER BY stamp ASC, payment_id ASC, item_name DESC
+"""
+
+PAYMENT_PAGE_QUERIES = {
+    (archived, direction): PAYMENT_PAGE_SQL.format(where=where, order=order, **LEDGER_TABLES[archived])
+    for archived in (False, True)
+    for direction, where, order in (
+        (None, "", "DESC"),
+        ("before", "AND (stamp, payment_id) < (:stamp, :payment_id)", "DESC"),
+        ("after", "AND (stamp, payment_id) > (:stamp, :payment_id)", "ASC"),
+    )
+}
+
+def get_payment_list(customer_id, limit=None, before=None, after=None, archived=False):
+    """Returns PaymentRecords of a customer, oldest first, with their orders and the balance after each of them.
+    With limit only that many payments are loaded: the newest ones, the ones right before the `before` key
+    or right after the `after` key (keys are PaymentRecord.key).
+    With archived the archived payments are included too, the ARCHIVE_CHECKPOINT payment then has a balance_change of 0"""
+    if archived:
+        _attach_archives()
+    params = {"customer_id": customer_id, "limit": -1 if limit is None else limit}
+    direction = None
+    if before is not None:
+        direction = "before"
+        params["stamp"], params["payment_id"] = before
+    elif after is not None:
+        direction = "after"
+        params["stamp"], params["payment_id"] = after
+    
+    cur = _cursor()
+    cur.execute(PAYMENT_PAGE_QUERIES[archived, direction], params)
     
-    return payments
+    payments = []
+    last = None
+    # NULLs come last in DESC order, so the row without an order line is the last one of its payment
+    for payment_id, description, stamp, balance_change, balance, item_name, count, cost_total in cur:
+        if payment_id != last:
+            last = payment_id
+            orders = []
+            payments.append((payment_id, description, stamp, balance_change, balance, orders))
+        if count is not None:
+            orders.append((item_name, count, cost_total))
     
+    return [PaymentRecord(*payment[:5], tuple(payment[5])) for payment in payments]
+    
+@retry_locked
 def delete_payment(payment_id):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
+    with transaction() as cur:
+        cur.execute("""
+            SELECT customer_id, balance_change FROM payments WHERE payment_id = ?
+        """, (payment_id,))
+        payment = cur.fetchone()
+        if not payment:
+            return
+        _update_rollups(cur, payment_id, -1)
         cur.execute("""
             DELETE FROM payments WHERE payment_id = ?
         """, (payment_id,))
+        _cache_update(payment[0], balance_change=-payment[1])
 
 def get_order_list(payment_id):
-    with sqlite3.connect("prachy.db") as conn:
-        cur = conn.cursor()
+    cur = _cursor()
+    cur.execute("""
+        SELECT item_name, count, cost_total FROM order_lines WHERE payment_id = ?
+        ORDER BY item_name DESC
+    """, (payment_id,))
+    return cur.fetchall()
+
+# the rollups from scratch, {payments} and {orders} are filled in by whether there are archives
+ROLLUPS_REBUILD_SQL = [
+    """
+        INSERT INTO daily_funds (day, added, removed, spent, orders)
+          SELECT stamp / :day,
+            SUM((description IS 'ADD_FUNDS') * balance_change),
+            SUM((description IS 'REMOVE_FUNDS') * -balance_change),
+            SUM((description IS 'ORDER_PAYMENT') * -balance_change),
+            SUM(description IS 'ORDER_PAYMENT')
+          FROM {payments} WHERE description IS NOT 'ARCHIVE_CHECKPOINT'
+          GROUP BY 1;
+    """,
+    """
+        INSERT INTO daily_items (day, item_id, count, revenue)
+          SELECT stamp / :day, item_id, SUM(count), SUM(cost_total) FROM {orders} AS orders
+            JOIN {payments} AS payments ON payments.payment_id = orders.payment_id
+            GROUP BY 1, 2;
+    """,
+]
+
+@retry_locked
+def rebuild_rollups():
+    """Counts the daily rollups again from the whole ledger, archives included. Runs by itself after the upgrade that added them,
+    needed by hand only after the payments were changed around dbutils"""
+    archived = bool(_cursor().execute("SELECT count(*) FROM ledger_archives;").fetchone()[0])
+    if archived:
+        _attach_archives()
+    with transaction() as cur:
+        if archived:
+            # items archived before the catalog existed that nothing sold since
+            cur.execute("""
+                INSERT INTO items (name) SELECT DISTINCT item_name FROM ledger_orders WHERE item_id IS NULL
+                ON CONFLICT(name) DO NOTHING;
+            """)
+        cur.execute("DELETE FROM daily_items;")
+        cur.execute("DELETE FROM daily_funds;")
+        for expr in ROLLUPS_REBUILD_SQL:
+            cur.execute(expr.format(**LEDGER_TABLES[archived]), {"day": DAY})
+        cur.execute("DELETE FROM db_info WHERE key = 'rollups_stale';")
+
+def get_sales_report(since, until):
+    """SalesReport of the days from since to until (YYYY-MM-DD, inclusive), read only from the daily rollups"""
+    days = (date_stamp(since) // DAY, date_stamp(until) // DAY)
+    cur = _cursor()
+    cur.execute("""
+        SELECT IFNULL(SUM(added), 0), IFNULL(SUM(removed), 0), IFNULL(SUM(spent), 0), IFNULL(SUM(orders), 0) FROM daily_funds
+          WHERE day BETWEEN ? AND ?;
+    """, days)
+    funds = cur.fetchone()
+    cur.execute("""
+        SELECT name, SUM(count), SUM(revenue) FROM daily_items
+          JOIN items ON items.item_id = daily_items.item_id
+          WHERE day BETWEEN ? AND ?
+          GROUP BY daily_items.item_id
+          HAVING SUM(count) != 0
+          ORDER BY SUM(count) DESC, name ASC;
+    """, days)
+    return SalesReport(since, until, *funds, tuple(cur.fetchall()))
+
+def _open_archive(file):
+    """Opens an archive file on its own connection, creates it when it doesn't exist yet"""
+    conn = sqlite3.connect(_archive_path(file), isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA foreign_keys=ON;")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT};")
+    for expr in ARCHIVE_FILE_SQL:
+        conn.execute(expr)
+    return conn
+
+@retry_locked
+def _archive_batch(cutoff, batch_size, archive_connections):
+    """Archives up to batch_size of the oldest payments made before cutoff, all from the same year. Returns how many.
+    
+    The payments are first committed to the archive file, then deleted here in one transaction with the checkpoint update
+    and the new batch number of the file in ledger_archives. The write lock is held the whole time, so nobody changes them
+    in between. If the second commit never happens, the payments stay here and the copies in the archive have a higher
+    archive_batch than ledger_archives knows of, so they don't count and the next batch into that file deletes them."""
+    cutoff_stamp = date_stamp(cutoff)
+    with transaction() as cur:
         cur.execute("""
-            SELECT item_name, count, cost_total FROM orders WHERE payment_id = ?
-            ORDER BY item_name DESC
-        """, (payment_id,))
-        return cur.fetchall()
\ No newline at end of file
+            SELECT payment_id, customer_id, stamp, description, balance_change FROM payments
+              WHERE stamp < ? AND description IS NOT 'ARCHIVE_CHECKPOINT'
+              ORDER BY payment_id ASC
+              LIMIT ?;
+        """, (cutoff_stamp, batch_size))
+        payments = cur.fetchall()
+        if not payments:
+            return 0
+        # one archive file per year
+        period = str(time.gmtime(payments[0][2]).tm_year)
+        payments = [payment for payment in payments if str(time.gmtime(payment[2]).tm_year) == period]
+        ids = json.dumps([payment[0] for payment in payments])
+        cur.execute("""
+            SELECT order_id, payment_id, item_name, item_cost, count FROM order_lines
+              WHERE payment_id IN (SELECT value FROM json_each(?));
+        """, (ids,))
+        orders = cur.fetchall()
+        
+        file = _archive_file(period)
+        cur.execute("""
+            SELECT batch FROM ledger_archives WHERE period = ?;
+        """, (period,))
+        committed = (cur.fetchone() or (0,))[0]
+        archive = archive_connections.get(file)
+        if archive is None:
+            archive = archive_connections[file] = _open_archive(file)
+        archive.execute("BEGIN IMMEDIATE;")
+        try:
+            archive.execute("DELETE FROM payments WHERE archive_batch > ?;", (committed,))
+            # plain INSERTs, an id that is in the archive already must not overwrite the payment there
+            archive.executemany("""
+                INSERT INTO payments (payment_id, customer_id, stamp, description, balance_change, archive_batch) VALUES (?, ?, ?, ?, ?, ?)
+            """, [payment + (committed + 1,) for payment in payments])
+            archive.executemany("""
+                INSERT INTO orders (order_id, payment_id, item_name, item_cost, count) VALUES (?, ?, ?, ?, ?)
+            """, orders)
+            archive.execute("COMMIT;")
+        except BaseException:
+            if archive.in_transaction:
+                archive.execute("ROLLBACK;")
+            raise
+        
+        # the checkpoint gets the sum of the archived payments, the balance triggers then cancel out, no balance changes
+        cur.execute("""
+            INSERT INTO payments (customer_id, stamp, description, balance_change)
+              SELECT customer_id, :cutoff, 'ARCHIVE_CHECKPOINT', SUM(balance_change) FROM payments
+              WHERE payment_id IN (SELECT value FROM json_each(:ids))
+              GROUP BY customer_id
+            ON CONFLICT(customer_id) WHERE description = 'ARCHIVE_CHECKPOINT'
+              DO UPDATE SET balance_change = balance_change + excluded.balance_change, stamp = MAX(stamp, excluded.stamp);
+        """, {"cutoff": cutoff_stamp, "ids": ids})
+        cur.execute("""
+            DELETE FROM payments WHERE payment_id IN (SELECT value FROM json_each(?));
+        """, (ids,))
+        cur.execute("""
+            INSERT INTO ledger_archives (period, file, batch) VALUES (?, ?, ?)
+            ON CONFLICT(period) DO UPDATE SET batch = excluded.batch;
+        """, (period, file, committed + 1))
+        cur.execute("""
+            INSERT INTO db_info (key, value) VALUES ('archive_cutoff', ?)
+            ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value);
+        """, (cutoff,))
+        return len(payments)
+
+def iter_archive(cutoff, batch_size=1000):
+    """Moves the payments made before the cutoff date (YYYY-MM-DD) to the archive files, prachy-<year>.db next to the database,
+    and leaves an ARCHIVE_CHECKPOINT payment with their sum for every customer, so the balances stay the same.
+    
+    Yields (archived, total) after every committed batch. Each batch is a transaction of its own and the tills
+    can write in between, so it can run while they are in use. Stopping the iteration keeps what got archived,
+    running it again continues."""
+    if DB_PATH == MEMORY:
+        raise Exception("Databáze v paměti nemá vedle sebe kam archivovat.")
+    cur = _cursor()
+    cur.execute("""
+        SELECT count(*) FROM payments WHERE stamp < ? AND description IS NOT 'ARCHIVE_CHECKPOINT';
+    """, (date_stamp(cutoff),))
+    total = cur.fetchone()[0]
+    
+    archive_connections = {}
+    try:
+        done = 0
+        while True:
+            archived = _archive_batch(cutoff, batch_size, archive_connections)
+            if not archived:
+                return
+            done += archived
+            yield done, total
+    finally:
+        for conn in archive_connections.values():
+            conn.close()
+
+def archive_ledger(cutoff, batch_size=1000):
+    """Runs iter_archive to the end, returns the number of archived payments"""
+    done = 0
+    for done, _ in iter_archive(cutoff, batch_size):
+        pass
+    return done
@@ -0,0 +1,157 @@
+""" Runs dbutils calls on a background thread, so a slow disk doesn't freeze the UI while a write waits on fsync """
+
+import queue, threading, traceback
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import dbutils
+
+# dbutils functions that write, writes queued right after each other are committed in one transaction
+WRITES = {"save_info", "sync_items", "save_order", "add_funds", "remove_funds", "delete_payment"}
+# rebuild_rollups writes too, but it attaches the archives first, which can't be done inside of the group commit transaction
+
+_STOP = object()
+
+@dataclass
+class Request:
+    name: str
+    args: tuple
+    kwargs: dict
+    callback: object = None
+    errback: object = None
+    future: Future = field(default_factory=Future)
+    # submit()ted requests only finish their future, nothing of them goes to the Tk thread
+    reported: bool = True
+
+class DBWorker:
+    """Owns the database connection on its own thread. Requests run in the order they were made,
+    so a read made after a write always sees it. Callbacks are run on the Tk thread through after().
+    Without a root (api.py on its own) there is no Tk thread, only submit() can be used then.
+    ledger is the module the calls go to, dbutils or another engine of storage.py"""
+
+    def __init__(self, root=None, poll_interval=25, max_batch=64, ledger=dbutils):
+        self.root = root
+        self.ledger = ledger
+        self.poll_interval = poll_interval
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.finished = queue.Queue()
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.shown_pending = 0
+        self.pending_listeners = []
+
+        self.thread = threading.Thread(target=self.run, name="DBWorker", daemon=True)
+        self.thread.start()
+        if self.root is not None:
+            self.root.after(self.poll_interval, self.poll)
+
+    def call(self, name, *args, callback=None, errback=None, **kwargs):
+        """Queues ledger.<name>(*args, **kwargs). callback(result) or errback(exception) is then called on the Tk thread,
+        errors without an errback go to on_error. Returns a Future for callers that want to wait."""
+        request = Request(name, args, kwargs, callback, errback)
+        with self.pending_lock:
+            self.pending += 1
+        self.requests.put(request)
+        return request.future
+
+    def submit(self, name, *args, **kwargs):
+        """Queues ledger.<name>(*args, **kwargs) like call(), the result or the exception is only in the returned Future.
+        Safe from any thread"""
+        request = Request(name, args, kwargs, reported=False)
+        with self.pending_lock:
+            self.pending += 1
+        self.requests.put(request)
+        return request.future
+
+    def close(self):
+        """Finishes everything queued and stops the thread"""
+        self.requests.put(_STOP)
+        self.thread.join()
+
+    def on_error(self, request, ex):
+        traceback.print_exception(type(ex), ex, ex.__traceback__)
+
+    def poll(self):
+        while True:
+            try:
+                request = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            ex = request.future.exception()
+            if ex is None:
+                if request.callback:
+                    request.callback(request.future.result())
+            elif request.errback:
+                request.errback(ex)
+            else:
+                self.on_error(request, ex)
+
+        pending = self.pending
+        if pending != self.shown_pending:
+            self.shown_pending = pending
+            for listener in self.pending_listeners:
+                listener(pending)
+        self.root.after(self.poll_interval, self.poll)
+
+    def run(self):
+        held = None
+        while True:
+            if held is not None:
+                request, held = held, None
+            else:
+                request = self.requests.get()
+            if request is _STOP:
+                break
+
+            if request.name not in WRITES:
+                try:
+                    self.finish(request, getattr(self.ledger, request.name)(*request.args, **request.kwargs))
+                except Exception as ex:
+                    self.finish(request, error=ex)
+                continue
+
+            # group commit, take every write that is already waiting
+            batch = [request]
+            while len(batch) < self.max_batch:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is _STOP or request.name not in WRITES:
+                    held = request
+                    break
+                batch.append(request)
+            self.write(batch)
+
+        self.ledger.close_thread_connection()
+
+    def write(self, batch):
+        try:
+            results = self.ledger.retry_locked(self.write_batch)(batch)
+        except Exception as ex:
+            # the commit failed, nothing of the batch got saved
+            results = [(request, None, ex) for request in batch]
+
+        for request, result, error in results:
+            self.finish(request, result, error)
+
+    def write_batch(self, batch):
+        results = []
+        with self.ledger.transaction():
+            for request in batch:
+                # every dbutils write is a savepoint inside of this transaction, so a failed one doesn't undo the others
+                try:
+                    results.append((request, getattr(self.ledger, request.name)(*request.args, **request.kwargs), None))
+                except Exception as ex:
+                    results.append((request, None, ex))
+        return results
+
+    def finish(self, request, result=None, error=None):
+        if error is None:
+            request.future.set_result(result)
+        else:
+            request.future.set_exception(error)
+        with self.pending_lock:
+            self.pending -= 1
+        if request.reported:
+            self.finished.put(request)
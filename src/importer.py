@@ -0,0 +1,117 @@
+""" Bulk import of customers and top-ups from a CSV, the other way round than the balance export of the app.
+
+    py src/importer.py signup.csv
+    py src/importer.py signup.csv --dry-run          # checks the file and rolls the import back
+    py src/importer.py signup.csv --skip-invalid     # imports the good rows, lists the bad ones
+    py src/importer.py signup.csv --chunked          # commits every CHUNK_SIZE rows, the tills don't wait for the whole import
+
+The columns are the ones of the balance export: Číslo, Jméno, Příjmení, Přezdívka, Kredit. Only the number is required,
+the names fill in the profile (empty ones leave the saved names as they were) and the amount is added to the credit,
+so importing a balance export into an empty database gives the same balances. The delimiter can be , ; or a tab,
+the first line is skipped when it is a header.
+
+By default it is all or nothing: one bad row and nothing is imported, the errors of all the rows are listed. """
+
+import argparse, csv, sys, time
+import dbutils
+
+CHUNK_SIZE = 5000
+# the till only takes 4 digit numbers
+MAX_CUSTOMER = 9999
+# more errors than this aren't collected, the file is surely the wrong one
+MAX_ERRORS = 100
+# the first one is used when the first line has none of them
+DELIMITERS = ",;\t"
+
+class InvalidImport(Exception):
+    """Rows of the file are wrong, errors is a list of (line, message)"""
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} chybných řádků")
+        self.errors = errors
+
+def parse_row(row):
+    """(customer_id, first_name, last_name, nickname, amount) of a CSV row, raises ValueError with a message for the user"""
+    if len(row) > 5:
+        raise ValueError(f"řádek má {len(row)} sloupců, čekáno nejvýš 5")
+    number, first_name, last_name, nickname, amount = [cell.strip() for cell in row] + [""] * (5 - len(row))
+    if not number.isdigit() or not 0 < int(number) <= MAX_CUSTOMER:
+        raise ValueError(f"číslo „{number}“ není od 1 do {MAX_CUSTOMER}")
+    try:
+        amount = int(amount or 0)
+    except ValueError:
+        raise ValueError(f"kredit „{amount}“ není celé číslo") from None
+    return int(number), first_name, last_name, nickname, amount
+
+def iter_chunks(infil, errors, skip_invalid=False, chunk_size=CHUNK_SIZE):
+    """Yields lists of parsed rows of the CSV file infil, the wrong ones go to errors as (line, message).
+    Without skip_invalid InvalidImport is raised at the end when there were any, after all of the file has been checked"""
+    # the delimiter the first line has the most of, csv.Sniffer guesses wrong on files with a lot of empty cells
+    first = infil.readline()
+    infil.seek(0)
+    delimiter = max(DELIMITERS, key=first.count)
+    chunk = []
+    for line, row in enumerate(csv.reader(infil, delimiter=delimiter), 1):
+        if not any(cell.strip() for cell in row):
+            continue
+        if line == 1 and not row[0].strip().isdigit():
+            # header
+            continue
+        try:
+            chunk.append(parse_row(row))
+        except ValueError as ex:
+            if len(errors) >= MAX_ERRORS:
+                if skip_invalid:
+                    continue
+                raise InvalidImport(errors) from None
+            errors.append((line, str(ex)))
+        if len(chunk) >= chunk_size:
+            # after an error nothing more is imported without skip_invalid, only the rest of the file is checked
+            if skip_invalid or not errors:
+                yield chunk
+            chunk = []
+    if chunk and (skip_invalid or not errors):
+        yield chunk
+    if errors and not skip_invalid:
+        raise InvalidImport(errors)
+
+def import_file(path, dry_run=False, skip_invalid=False, chunked=False, progress=None, chunk_size=CHUNK_SIZE):
+    """Imports the CSV file at path, returns the number of imported rows, the errors as (line, message) and the seconds it took.
+    Raises InvalidImport when a row is wrong and skip_invalid isn't set, nothing is imported then"""
+    errors = []
+    start = time.perf_counter()
+    # utf-8-sig, Excel starts its CSVs with a BOM
+    with open(path, newline="", encoding="utf-8-sig") as infil:
+        if chunked and not dry_run and not skip_invalid:
+            # the chunks are committed one by one, a bad row at the end couldn't take back the ones before it
+            for _ in iter_chunks(infil, errors, skip_invalid, chunk_size):
+                pass
+            infil.seek(0)
+        rows = dbutils.import_customers(iter_chunks(infil, errors, skip_invalid, chunk_size), dry_run, chunked, progress)
+    return rows, errors, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("file")
+    parser.add_argument("--db", default=dbutils.DB_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="do the whole import and roll it back")
+    parser.add_argument("--skip-invalid", action="store_true", help="import the good rows even when some are wrong")
+    parser.add_argument("--chunked", action="store_true", help=f"commit every {CHUNK_SIZE} rows instead of all at once")
+    args = parser.parse_args()
+
+    dbutils.use_database(args.db)
+    dbutils.prepare_db()
+    try:
+        rows, errors, seconds = import_file(args.file, args.dry_run, args.skip_invalid, args.chunked)
+    except InvalidImport as ex:
+        for line, message in ex.errors:
+            print(f"řádek {line}: {message}", file=sys.stderr)
+        print(f"nic nebylo naimportováno, {len(ex.errors)} chybných řádků", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        dbutils.close_connections()
+    for line, message in errors:
+        print(f"řádek {line}: {message} (přeskočeno)", file=sys.stderr)
+    print(f"{'vyzkoušeno' if args.dry_run else 'naimportováno'} {rows} řádků za {seconds:.2f}s, {rows / seconds if seconds else 0:.0f} řádků/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+""" Call counts and latency histograms of the slow prone parts of the app, and a log of the calls slower than a threshold.
+
+Nothing is wrapped until enable(), after that install() and install_methods() wrap the functions in place,
+so without diagnostics turned on in the config the app runs the same code as before. """
+
+import functools, inspect, logging, logging.handlers, math, threading, time
+from contextlib import contextmanager, nullcontext
+
+# histogram buckets are 2^(1/BUCKETS_PER_OCTAVE) wide, about 19 %, starting at 1 µs
+BUCKETS_PER_OCTAVE = 4
+SLOW_LOG = "slow_ops.log"
+
+_enabled = False
+_slow = 0.1
+_stats = {}
+_lock = threading.Lock()
+_log = logging.getLogger("prachy.slow")
+
+class Stats:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def percentile(self, q):
+        """Upper bound of the bucket the q-th fraction of the calls falls into, in seconds"""
+        wanted = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                return min(2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE) / 1e6, self.max)
+        return self.max
+
+def enable(slow_ms=100, log_path=SLOW_LOG):
+    """Starts collecting, calls longer than slow_ms go to the rotating log at log_path"""
+    global _enabled, _slow
+    _enabled = True
+    _slow = slow_ms / 1000
+    if not _log.handlers:
+        handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=1024 * 1024, backupCount=3, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(message)s"))
+        _log.addHandler(handler)
+        _log.setLevel(logging.INFO)
+        _log.propagate = False
+
+def is_enabled():
+    return _enabled
+
+def record(name, elapsed, args=None):
+    bucket = int(math.log2(max(elapsed * 1e6, 1)) * BUCKETS_PER_OCTAVE)
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = Stats()
+        stats.count += 1
+        stats.total += elapsed
+        stats.max = max(stats.max, elapsed)
+        stats.buckets[bucket] = stats.buckets.get(bucket, 0) + 1
+    if elapsed >= _slow:
+        _log.info("%s %.1f ms %s", name, elapsed * 1000, "" if args is None else repr(args)[:200])
+
+def timed(name):
+    """Decorator recording every call of the function under name, generators are timed over the whole iteration"""
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                elapsed = 0.0
+                gen = func(*args, **kwargs)
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(gen)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                finally:
+                    gen.close()
+                    record(name, elapsed, args)
+            return wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start, args)
+        return wrapper
+    return decorator
+
+@contextmanager
+def _timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+def timer(name):
+    """Context manager recording how long its block took, does nothing until enable()"""
+    return _timer(name) if _enabled else nullcontext()
+
+def install(module, skip=()):
+    """Wraps the public functions defined in module, so calls from other modules and from inside of it are recorded"""
+    for name, value in list(vars(module).items()):
+        if inspect.isfunction(value) and not name.startswith("_") and value.__module__ == module.__name__ and name not in skip:
+            setattr(module, name, timed(f"{module.__name__}.{name}")(value))
+
+def install_methods(cls, *names):
+    """Wraps methods of cls, only instances made after that and bound methods taken after that use the wrappers"""
+    for name in names:
+        setattr(cls, name, timed(f"{cls.__name__}.{name}")(getattr(cls, name)))
+
+def snapshot():
+    """{name: (count, mean, p50, p95, p99, max)} in seconds"""
+    with _lock:
+        return {name: (stats.count, stats.total / stats.count, stats.percentile(0.5), stats.percentile(0.95),
+                       stats.percentile(0.99), stats.max)
+                for name, stats in _stats.items()}
+
+def report():
+    """Table of the recorded operations, the ones that took the most time in total first"""
+    rows = sorted(snapshot().items(), key=lambda item: -item[1][0] * item[1][1])
+    lines = [f"{'operation':<36}{'calls':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}   (ms)"]
+    for name, (count, mean, p50, p95, p99, longest) in rows:
+        lines.append(f"{name:<36}{count:>8}" + "".join(f"{value * 1000:>10.2f}" for value in (mean, p50, p95, p99, longest)))
+    return "\n".join(lines)
+
+def reset():
+    with _lock:
+        _stats.clear()
@@ -1,12 +1,17 @@
+import time
+STARTED = time.perf_counter()
+
 import tkinter as tk
 import tkinter.messagebox as tkmessagebox
-import tkinter.scrolledtext as tkscrolledtext
 import tkinter.filedialog as tkfiledialog
 import tkinter.simpledialog as tksimpledialog
 import tkinter.font as tkfont
-import sqlite3, json, sys, dbutils, os, os.path, traceback, csv
-from config import schema
-from cerberus import Validator
+import tkinter.ttk as ttk
+import sys, dbutils, os, os.path, traceback, csv, dataclasses, bisect, threading, queue, datetime
+from dbworker import DBWorker
+from backup import BackupScheduler
+import instrument, recorder, service
+from config import load_config, ConfigError
 
 def only4Num(inStr, acttyp):
     if acttyp == '1': #insert
@@ -16,7 +21,12 @@ def only4Num(inStr, acttyp):
 
 
 class App(tk.Tk):
+    # how often to look for changes made by other tills sharing the database, in ms
+    CHANGE_POLL_INTERVAL = 1000
+    
     def __init__(self, *args, **kwargs):
+        self.phase_start = STARTED
+        self.startup_phase("imports")
         tk.Tk.__init__(self, *args, **kwargs)
         default_font = tkfont.nametofont("TkDefaultFont")
         default_font.configure(size=22, family='Arial')
@@ -29,52 +39,149 @@ class App(tk.Tk):
         self.wm_geometry("800x600")
         self.state('zoomed')
         self.iconbitmap(self.resource_path("icon.ico"))
+        self.startup_phase("window")
         
+        # validated config is cached, see load_config
         self.config = {}
         try:
-            with open("./config.json", encoding="utf-8") as infil:
-                self.config = json.load(infil)
+            self.config = load_config()
+        except ConfigError as ex:
+            tkmessagebox.showerror(title="Chyba v nastavení", message="Při načítání config.json se objevily chyby:\n" + str(ex.args[0])[:1024])
+            sys.exit()
         except Exception as ex:
             traceback.print_exc()
             tkmessagebox.showerror(title="Chyba v nastavení", message="Při načítání config.json se objevila nějaká chyba\nZkontrolujte, že je všechno tak, jak má být.")
             sys.exit()
+        self.startup_phase("config")
         
-        # validate config
-        val = Validator(schema)
-        if not val.validate(self.config):
-            tkmessagebox.showerror(title="Chyba v nastavení", message="Při načítání config.json se objevily chyby:\n" + str(val.errors)[:1024])
-            sys.exit()
-        
-        self.config = val.normalized(self.config)
+        self.diagnostics = None
+        if self.config["diagnostics"]:
+            enable_diagnostics(self.config["diagnostics.slow_ms"])
+            # hidden, for when the till feels slow
+            self.bind_all("<Control-Shift-KeyPress-D>", lambda _: self.show_diagnostics())
         
         try:
+            dbutils.use_database(self.config["database"])
             dbutils.prepare_db()
         except Exception as ex:
             traceback.print_exc()
-            tkmessagebox.showerror(title="Chyba v databázi", message="Při načítání nebo vytváření prachy.db se objevila chyba:\n"+str(ex))
+            tkmessagebox.showerror(title="Chyba v databázi", message="Při načítání nebo vytváření %s se objevila chyba:\n" % self.config["database"] + str(ex))
             sys.exit()
-        
-        self.frames = {
-            "MainPage": MainPage(self),
-            "Order": Order(self),
-            "EditProfile": EditProfile(self),
+        self.startup_phase("database")
+        # the trace header names the database, the one of the config is in use only now
+        if self.config["recorder"]:
+            print("recording to", recorder.start(self.config["recorder.directory"]), flush=True)
+        
+        self.db = DBWorker(self)
+        self.db.on_error = self.db_error
+        self.db.call("warm_cache")
+        self.db.call("sync_items", [name for name, _ in service.menu_items(self.config)])
+        self.backups = BackupScheduler(self.config["backup.directory"], self.config["backup.keep"], self.config["backup.interval"])
+        self.api = None
+        if self.config["api"]:
+            # asyncio takes a while to import, only do it when the API is on
+            from api import ApiServer
+            try:
+                self.api = ApiServer(self.db, service.menu_items(self.config), self.config["api.host"], self.config["api.port"], self.config["api.token"])
+                print(f"api: listening on {self.api.host}:{self.api.port}", flush=True)
+            except OSError as ex:
+                # the till works without it
+                traceback.print_exc()
+                tkmessagebox.showerror(title="API", message="Objednávky z telefonů nepůjdou, API se nepodařilo spustit:\n"+str(ex))
+        
+        # frames are built the first time they are needed, the ones not needed yet get built after the main page is shown
+        self.frame_classes = {
+            "MainPage": MainPage,
+            "Order": Order,
+            "EditProfile": EditProfile,
+            "Report": Report,
         }
+        self.frames = {}
+        self.current_frame = None
+        self.change_count = None
         
-        for frame in self.frames.values():
-            frame.place(x=0, y=0, relwidth=1, relheight=1)
+        # shown over the frames while something waits to be saved
+        self.pending_label = tk.Label(self, text="Ukládám…", bg="#fffb80")
+        self.db.pending_listeners.append(self.show_pending)
         
         self.open_frame("MainPage")
+        self.startup_phase("main page")
+        self.after_idle(self.startup_done)
+        self.after(self.CHANGE_POLL_INTERVAL, self.poll_changes)
     
-
+    def poll_changes(self):
+        self.db.call("change_count", callback=self.changes_counted)
+    
+    def changes_counted(self, count):
+        """Lets the shown frame reload what another till might have changed"""
+        # the API writes through self.db, the database doesn't count those as changes made by others
+        if self.api is not None:
+            count += self.api.orders
+        if self.change_count is not None and count != self.change_count:
+            refresh = getattr(self.current_frame, "external_change", None)
+            if refresh:
+                refresh()
+        self.change_count = count
+        self.after(self.CHANGE_POLL_INTERVAL, self.poll_changes)
+    
+    def show_diagnostics(self):
+        """Opens DiagnosticsDialog, or brings up the one that is open already"""
+        if self.diagnostics is not None and self.diagnostics.winfo_exists():
+            self.diagnostics.lift()
+            self.diagnostics.focus_set()
+            return
+        self.diagnostics = DiagnosticsDialog(self)
+    
+    def startup_phase(self, name):
+        now = time.perf_counter()
+        print(f"startup: {name:<12}{(now - self.phase_start) * 1000:8.1f} ms", flush=True)
+        self.phase_start = now
+    
+    def startup_done(self):
+        # idle callbacks run once the window has been drawn
+        print(f"startup: window shown after {(time.perf_counter() - STARTED) * 1000:.1f} ms", flush=True)
+        self.after(100, self.build_next_frame)
+    
+    def build_next_frame(self):
+        """Builds one of the frames that weren't needed yet, one per call so the UI stays responsive in between"""
+        for name in self.frame_classes:
+            if name not in self.frames:
+                self.get_frame(name)
+                self.after_idle(self.build_next_frame)
+                return
+    
+    def get_frame(self, name):
+        frame = self.frames.get(name)
+        if frame is None:
+            start = time.perf_counter()
+            frame = self.frames[name] = self.frame_classes[name](self)
+            frame.place(x=0, y=0, relwidth=1, relheight=1)
+            # new widgets stack on top, keep it under the shown frame until it is opened
+            frame.lower()
+            print(f"startup: built {name} in {(time.perf_counter() - start) * 1000:.1f} ms", flush=True)
+        return frame
+    
+    def show_pending(self, pending):
+        if pending:
+            self.pending_label.place(relx=1, rely=0, anchor="ne")
+            self.pending_label.lift()
+        else:
+            self.pending_label.place_forget()
+    
+    def db_error(self, request, ex):
+        traceback.print_exception(type(ex), ex, ex.__traceback__)
+        tkmessagebox.showerror(title="Chyba v databázi", message="Při práci s databází se objevila chyba:\n"+str(ex))
     
     def open_frame(self, name, *args, returned_from=False, **kwargs):
-        frame = self.frames[name];
+        recorder.record("open", name, args, kwargs, returned_from)
+        frame = self.get_frame(name);
         if returned_from:
             ret = frame.returned_back(returned_from, *args, **kwargs)
         else:
             ret = frame.setup(*args, **kwargs)
         if ret is not False:
             frame.tkraise()
+            self.current_frame = frame
     
     @staticmethod
     def resource_path(relative_path):
@@ -88,6 +195,9 @@ class App(tk.Tk):
         return os.path.join(base_path, relative_path)
 
 class MainPage(tk.Frame):
+    # ms after the last key before the customer search runs
+    SEARCH_DELAY = 150
+    
     def __init__(self, root):
         self.app = root;
         tk.Frame.__init__(self, root)
@@ -96,14 +206,23 @@ class MainPage(tk.Frame):
         menu_frame.grid(row=0, column=0, columnspan=2, sticky="ew", pady=5)
         
         """payment_button = tk.Button(menu_frame, text="Opravit poslední\nobjednávku", bg="#a3ffb3")
-        payment_button.pack(side="left", fill="y", expand=True)
-        
-        payment_button = tk.Button(menu_frame, text="Zazálohovat", bg="#a3ffb3")
         payment_button.pack(side="left", fill="y", expand=True)"""
         
+        backup_button = self.backup_button = tk.Button(menu_frame, text="Zazálohovat", bg="#a3ffb3", command=self.backup_callback)
+        backup_button.pack(side="left", fill="y", expand=True)
+        
         db_export_button = tk.Button(menu_frame, text="Export DB", bg="#a3ffb3", command=self.db_export_callback)
         db_export_button.pack(side="left", fill="y", expand=True)
         
+        db_import_button = tk.Button(menu_frame, text="Import", bg="#a3ffb3", command=self.db_import_callback)
+        db_import_button.pack(side="left", fill="y", expand=True)
+        
+        archive_button = tk.Button(menu_frame, text="Archivovat", bg="#a3ffb3", command=self.archive_callback)
+        archive_button.pack(side="left", fill="y", expand=True)
+        
+        report_button = tk.Button(menu_frame, text="Přehled prodeje", bg="#a3ffb3", command=lambda: self.app.open_frame("Report"))
+        report_button.pack(side="left", fill="y", expand=True)
+        
         last_num_frame = tk.Frame(self)
         last_num_frame.grid(row=2, column=0, columnspan=2, sticky="s")
         tk.Label(last_num_frame, text="Poslední číslo:", font="BPThicc")\
@@ -128,25 +247,55 @@ class MainPage(tk.Frame):
         add_money_button = tk.Button(buttons_frame, text="Upravit profil", bg="#fffb80", command=self.add_money)
         add_money_button.pack(side="left", padx=5)
         
+        tk.Label(self, text="Hledat:", font="BPThicc")\
+          .grid(row=5, column=0, sticky="en")
+        
+        search_text = self.search_text = tk.StringVar()
+        search_text.trace_add("write", lambda *_: self.schedule_search())
+        search_entry = self.search_entry = tk.Entry(self, font="BPThicc", width=15, textvariable=search_text)
+        search_entry.bind("<Down>", lambda _: self.focus_results())
+        search_entry.bind("<Return>", lambda _: self.focus_results())
+        search_entry.grid(row=5, column=1, sticky="wn")
+        
+        results = self.results = tk.Listbox(self, font="BPThicc", height=5, width=30, activestyle="none")
+        results.bind("<Double-Button-1>", lambda _: self.pick_result())
+        results.bind("<Return>", lambda _: self.pick_result())
+        results.grid(row=6, column=1, sticky="wn")
+        results.grid_remove()
+        self.found = []
+        self.search_after = None
+        self.search_number = 0
+        
         self.grid_rowconfigure(2, weight=1)
-        self.grid_rowconfigure(4, weight=1)
+        self.grid_rowconfigure(6, weight=1)
         self.grid_columnconfigure(0, weight=1)
         self.grid_columnconfigure(1, weight=1)
         
     def db_export_callback(self):
-        file = tkfiledialog.asksaveasfilename(filetypes=[("CSV tabulka", "*.csv")], initialfile="db_export.csv")
-        self.config(cursor="wait")
-        self.update()
-        try: 
-            with open(file, mode="w", newline='', encoding="utf-8") as outfil:
-                writer = csv.writer(outfil)
-                writer.writerow(["Číslo", "Jméno", "Příjmení", "Přezdívka", "Kredit"])
-                writer.writerows(dbutils.get_export())
-        except OSError as ex:
-            tkmessagebox.showerror(title="Chyba při ukládání souboru", message="Soubor se nepodařilo správně uložit.", **options)
-            
-        self.config(cursor="")
-        self.update()
+        ExportDialog(self.app)
+    
+    def db_import_callback(self):
+        ImportDialog(self.app)
+    
+    def archive_callback(self):
+        ArchiveDialog(self.app)
+    
+    def backup_callback(self):
+        self.backup_button["state"] = "disabled"
+        self.backup_button["text"] = "Zálohuji…"
+        self.after(100, self.backup_done, self.app.backups.backup_now())
+    
+    def backup_done(self, future):
+        if not future.done():
+            self.after(100, self.backup_done, future)
+            return
+        self.backup_button["state"] = "normal"
+        self.backup_button["text"] = "Zazálohovat"
+        ex = future.exception()
+        if ex:
+            tkmessagebox.showerror(title="Chyba při zálohování", message="Zálohu se nepodařilo vytvořit:\n"+str(ex))
+        else:
+            tkmessagebox.showinfo(title="Záloha", message="Záloha uložena do " + os.path.abspath(future.result()))
     
     def open_order(self):
         if not self.input_number.get():
@@ -164,13 +313,535 @@ class MainPage(tk.Frame):
         self.clear()
         self.app.open_frame("EditProfile", val)
     
+    def schedule_search(self):
+        # search once the typing pauses, not on every key
+        if self.search_after is not None:
+            self.after_cancel(self.search_after)
+        self.search_after = self.after(self.SEARCH_DELAY, self.search)
+    
+    def search(self):
+        self.search_after = None
+        self.search_number += 1
+        number = self.search_number
+        text = self.search_text.get()
+        if not text.strip():
+            self.show_results(number, [])
+            return
+        recorder.record("search", text)
+        self.app.db.call("search_customers", text, callback=lambda found: self.show_results(number, found))
+    
+    def show_results(self, number, found):
+        # an older search that finished late
+        if number != self.search_number:
+            return
+        self.found = found
+        self.results.delete(0, "end")
+        for customer_info in found:
+            name = " ".join(filter(None, (customer_info.first_name, customer_info.last_name)))
+            if customer_info.nickname:
+                name = f"{name} ({customer_info.nickname})" if name else customer_info.nickname
+            self.results.insert("end", f"{customer_info.customer_id}: {name}")
+        if found:
+            self.results.grid()
+        else:
+            self.results.grid_remove()
+    
+    def focus_results(self):
+        if self.found:
+            self.results.focus_set()
+            self.results.selection_clear(0, "end")
+            self.results.selection_set(0)
+            self.results.activate(0)
+    
+    def pick_result(self):
+        selection = self.results.curselection()
+        if not selection:
+            return
+        self.input_number.delete(0, "end")
+        self.input_number.insert(0, self.found[selection[0]].customer_id)
+        self.search_text.set("")
+        self.input_number.focus_set()
+    
     def clear(self):
         self.input_number.delete(0, "end")
+        self.search_text.set("")
     
     def setup(self):
         self.input_number.focus_set()
         pass
+
+class Report(tk.Frame):
+    """What was sold and how much credit was topped up and spent in a day, a week or the season.
+    It only reads the daily rollups, so it is quick however long the ledger is"""
+    PERIODS = (("day", "Dnes"), ("week", "Tento týden"), ("season", "Sezóna"))
+    FUNDS = (("added", "Nabito:"), ("removed", "Vybito:"), ("spent", "Utraceno:"), ("orders", "Objednávek:"))
+    
+    def __init__(self, root):
+        self.app = root;
+        tk.Frame.__init__(self, root)
+        
+        range_frame = tk.Frame(self)
+        range_frame.grid(row=0, column=0, sticky="ew", padx=5, pady=5)
+        for period, text in self.PERIODS:
+            tk.Button(range_frame, text=text, bg="#a3ffb3", font="BPThicc", command=lambda period=period: self.show_period(period))\
+              .pack(side="left", padx=5)
+        tk.Label(range_frame, text="Od:", font="BPThicc").pack(side="left", padx=(20, 0))
+        input_since = self.input_since = tk.Entry(range_frame, font="BPThicc", width=10)
+        input_since.pack(side="left")
+        tk.Label(range_frame, text="Do:", font="BPThicc").pack(side="left")
+        input_until = self.input_until = tk.Entry(range_frame, font="BPThicc", width=10)
+        input_until.bind("<Return>", lambda _: self.show_entered())
+        input_until.pack(side="left")
+        tk.Button(range_frame, text="Zobrazit", bg="#fffb80", font="BPThicc", command=self.show_entered)\
+          .pack(side="left", padx=5)
+        
+        funds_frame = tk.Frame(self)
+        funds_frame.grid(row=1, column=0, sticky="w", padx=5)
+        self.funds_labels = {}
+        for row, (key, text) in enumerate(self.FUNDS):
+            tk.Label(funds_frame, text=text, font="BPThicc").grid(row=row, column=0, sticky="w")
+            label = self.funds_labels[key] = tk.Label(funds_frame, text="", font="BPThicc")
+            label.grid(row=row, column=1, sticky="e", padx=10)
+        
+        style = ttk.Style(self)
+        style.configure("Report.Treeview", font="BPThicc", rowheight=tkfont.nametofont("BPThicc").metrics("linespace") + 4)
+        style.configure("Report.Treeview.Heading", font="BPThicc")
+        items = self.items = ttk.Treeview(self, columns=("count", "revenue"), style="Report.Treeview", selectmode="none")
+        items.heading("#0", text="Položka", anchor="w")
+        items.heading("count", text="Počet", anchor="e")
+        items.heading("revenue", text="Tržba", anchor="e")
+        items.column("count", anchor="e", width=150, stretch=False)
+        items.column("revenue", anchor="e", width=200, stretch=False)
+        items.grid(row=2, column=0, sticky="nsew", padx=(5, 0), pady=5)
+        scrollbar = tk.Scrollbar(self, command=items.yview)
+        scrollbar.grid(row=2, column=1, sticky="ns", pady=5)
+        items["yscrollcommand"] = scrollbar.set
+        
+        finish_area = tk.Frame(self)
+        finish_area.grid(row=3, column=0, columnspan=2, sticky="nsew")
+        back_button=tk.Button(finish_area, text="Zpět", bg="#ff9696", font="BPThicc", command=self.exit_button_callback)
+        back_button.pack(side="left", fill="y", padx=5, pady=5)
+        rebuild_button = self.rebuild_button = tk.Button(finish_area, text="Přepočítat", bg="#fffb80", command=self.rebuild_callback)
+        rebuild_button.pack(side="right", padx=5, pady=5)
+        self.bind('<Escape>', lambda _: self.exit_button_callback())
+        
+        self.grid_rowconfigure(2, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        
+        self.period = "day"
+        self.shown = None
+        self.report_number = 0
+    
+    @staticmethod
+    def period_range(period, today, season_start):
+        """(since, until) of the period up to today, season_start is MM-DD"""
+        if period == "week":
+            since = today - datetime.timedelta(days=today.weekday())
+        elif period == "season":
+            month, day = map(int, season_start.split("-"))
+            since = today.replace(month=month, day=day)
+            if since > today:
+                since = since.replace(year=since.year - 1)
+        else:
+            since = today
+        return since.isoformat(), today.isoformat()
+    
+    def show_period(self, period):
+        self.period = period
+        # the rollup days are in UTC, like the stamps
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        try:
+            since, until = self.period_range(period, today, self.app.config["report.season_start"])
+        except ValueError:
+            tkmessagebox.showerror(title="Chyba v nastavení", message="Začátek sezóny v config.json (report.season_start) není platné datum.")
+            return
+        self.show(since, until)
+    
+    def show_entered(self):
+        since = self.input_since.get().strip()
+        until = self.input_until.get().strip() or since
+        try:
+            if datetime.date.fromisoformat(since) > datetime.date.fromisoformat(until):
+                since, until = until, since
+        except ValueError:
+            tkmessagebox.showerror(title="Špatné datum", message="Datum musí být ve tvaru RRRR-MM-DD.")
+            return
+        self.period = None
+        self.show(since, until)
+    
+    def show(self, since, until):
+        for entry, date in ((self.input_since, since), (self.input_until, until)):
+            entry.delete(0, "end")
+            entry.insert(0, date)
+        self.shown = (since, until)
+        self.report_number += 1
+        number = self.report_number
+        self.app.db.call("get_sales_report", since, until, callback=lambda report: self.show_report(number, report))
+    
+    def show_report(self, number, report):
+        # an older report that finished late
+        if number != self.report_number:
+            return
+        for key, _ in self.FUNDS:
+            self.funds_labels[key]["text"] = str(getattr(report, key))
+        self.items.delete(*self.items.get_children())
+        for name, count, revenue in report.items:
+            self.items.insert("", "end", text=name.replace("\n", " "), values=(count, revenue))
+    
+    def rebuild_callback(self):
+        confirm = tkmessagebox.askyesno(title="Přepočítat přehled", message="Přepočítat přehled prodeje z celé historie plateb včetně archivu?\nMůže to chvíli trvat.")
+        if not confirm:
+            return
+        self.rebuild_button["state"] = "disabled"
+        self.rebuild_button["text"] = "Přepočítávám…"
+        self.app.db.call("rebuild_rollups", callback=lambda _: self.rebuilt(), errback=self.rebuilt)
+    
+    def rebuilt(self, ex=None):
+        self.rebuild_button["state"] = "normal"
+        self.rebuild_button["text"] = "Přepočítat"
+        if ex is not None:
+            self.app.db_error(None, ex)
+        self.external_change()
+    
+    def external_change(self):
+        if self.shown is not None:
+            self.show(*self.shown)
+    
+    def exit_button_callback(self):
+        self.app.open_frame("MainPage")
+    
+    def setup(self):
+        self.show_period(self.period or "day")
+        self.focus_set()
+
+class ExportDialog(tk.Toplevel):
+    """Asks what to export, then writes the CSV on its own thread while showing progress"""
+    CHUNK_SIZE = 1000
+    BALANCE_HEADER = ["Číslo", "Jméno", "Příjmení", "Přezdívka", "Kredit"]
+    LEDGER_HEADER = ["Platba", "Číslo", "Čas", "Typ", "Změna kreditu", "Položka", "Cena", "Počet"]
+    
+    def __init__(self, root):
+        tk.Toplevel.__init__(self, root)
+        self.title("Export DB")
+        self.transient(root)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+        
+        ledger = self.ledger = tk.BooleanVar(value=False)
+        tk.Radiobutton(self, text="Zůstatky zákazníků", variable=ledger, value=False)\
+          .grid(row=0, column=0, columnspan=2, sticky="w", padx=5)
+        tk.Radiobutton(self, text="Všechny pohyby na účtech", variable=ledger, value=True)\
+          .grid(row=1, column=0, columnspan=2, sticky="w", padx=5)
+        
+        tk.Label(self, text="Pohyby od (RRRR-MM-DD):").grid(row=2, column=0, sticky="w", padx=5)
+        input_since = self.input_since = tk.Entry(self, width=10)
+        input_since.grid(row=2, column=1, sticky="w")
+        tk.Label(self, text="Pohyby do (RRRR-MM-DD):").grid(row=3, column=0, sticky="w", padx=5)
+        input_until = self.input_until = tk.Entry(self, width=10)
+        input_until.grid(row=3, column=1, sticky="w")
+        
+        progress = self.progress = ttk.Progressbar(self, length=500, mode="determinate")
+        progress.grid(row=4, column=0, columnspan=2, padx=5, pady=5)
+        status = self.status = tk.Label(self, text="")
+        status.grid(row=5, column=0, columnspan=2)
+        
+        buttons_frame = tk.Frame(self)
+        buttons_frame.grid(row=6, column=0, columnspan=2, pady=5)
+        start_button = self.start_button = tk.Button(buttons_frame, text="Exportovat", bg="#a3ffb3", command=self.start)
+        start_button.pack(side="left", padx=5)
+        tk.Button(buttons_frame, text="Zrušit", bg="#ff9696", command=self.cancel)\
+          .pack(side="left", padx=5)
+        
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.messages = queue.Queue()
+    
+    def start(self):
+        ledger = self.ledger.get()
+        since = self.input_since.get().strip() or None
+        until = self.input_until.get().strip() or None
+        try:
+            for date in (since, until):
+                if date:
+                    datetime.date.fromisoformat(date)
+        except ValueError:
+            tkmessagebox.showerror(title="Špatné datum", message="Datum musí být ve tvaru RRRR-MM-DD.", parent=self)
+            return
+        
+        file = tkfiledialog.asksaveasfilename(parent=self, filetypes=[("CSV tabulka", "*.csv")], initialfile="db_export.csv")
+        if not file:
+            return
+        
+        self.start_button["state"] = "disabled"
+        self.status["text"] = "Exportuji…"
+        self.thread = threading.Thread(target=self.export, args=(file, ledger, since, until), daemon=True)
+        self.thread.start()
+        self.after(50, self.poll)
+    
+    def cancel(self):
+        if self.thread is None:
+            self.destroy()
+            return
+        self.cancelled.set()
+        self.status["text"] = "Ruším…"
+    
+    def export(self, file, ledger, since, until):
+        """Runs on the export thread, everything for the UI goes through self.messages"""
+        try:
+            self.messages.put(("total", dbutils.count_export(ledger, since, until)))
+            done = 0
+            with open(file, mode="w", newline='', encoding="utf-8") as outfil:
+                writer = csv.writer(outfil)
+                writer.writerow(self.LEDGER_HEADER if ledger else self.BALANCE_HEADER)
+                for rows in dbutils.iter_export(ledger, since, until, self.CHUNK_SIZE):
+                    if self.cancelled.is_set():
+                        break
+                    writer.writerows(rows)
+                    done += len(rows)
+                    self.messages.put(("progress", done))
+            
+            if self.cancelled.is_set():
+                os.remove(file)
+                self.messages.put(("cancelled", None))
+            else:
+                self.messages.put(("done", done))
+        except Exception as ex:
+            traceback.print_exc()
+            self.messages.put(("error", ex))
+        finally:
+            dbutils.close_thread_connection()
+    
+    def poll(self):
+        while True:
+            try:
+                kind, value = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            
+            if kind == "total":
+                self.total = value
+                self.progress["maximum"] = max(value, 1)
+            elif kind == "progress":
+                self.progress["value"] = value
+                self.status["text"] = f"{value} / {self.total}"
+            elif kind == "done":
+                tkmessagebox.showinfo(title="Export DB", message=f"Hotovo, vyexportováno {value} řádků.", parent=self)
+                self.destroy()
+                return
+            elif kind == "cancelled":
+                self.destroy()
+                return
+            elif kind == "error":
+                if isinstance(value, OSError):
+                    tkmessagebox.showerror(title="Chyba při ukládání souboru", message="Soubor se nepodařilo správně uložit.", parent=self)
+                else:
+                    tkmessagebox.showerror(title="Chyba v databázi", message="Při exportu se objevila chyba:\n"+str(value), parent=self)
+                self.destroy()
+                return
+        self.after(50, self.poll)
+
+class ImportDialog(tk.Toplevel):
+    """Imports customers and top-ups from a CSV (see importer.py) on its own thread, the tills can be used meanwhile"""
+    SHOWN_ERRORS = 10
+    
+    def __init__(self, root):
+        tk.Toplevel.__init__(self, root)
+        self.title("Import")
+        self.transient(root)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+        
+        tk.Label(self, text="CSV se sloupci jako u exportu zůstatků: Číslo, Jméno, Příjmení, Přezdívka, Kredit.\n"
+                            "Kredit se přičte k dosavadnímu, prázdná jména nechají uložená beze změny.", justify="left")\
+          .grid(row=0, column=0, sticky="w", padx=5, pady=5)
+        dry_run = self.dry_run = tk.BooleanVar(value=False)
+        tk.Checkbutton(self, text="Jen vyzkoušet, nic neuložit", variable=dry_run)\
+          .grid(row=1, column=0, sticky="w", padx=5)
+        skip_invalid = self.skip_invalid = tk.BooleanVar(value=False)
+        tk.Checkbutton(self, text="Přeskočit chybné řádky (jinak se při chybě nenaimportuje nic)", variable=skip_invalid)\
+          .grid(row=2, column=0, sticky="w", padx=5)
+        
+        status = self.status = tk.Label(self, text="")
+        status.grid(row=3, column=0, pady=5)
+        
+        buttons_frame = tk.Frame(self)
+        buttons_frame.grid(row=4, column=0, pady=5)
+        start_button = self.start_button = tk.Button(buttons_frame, text="Vybrat soubor a importovat", bg="#a3ffb3", command=self.start)
+        start_button.pack(side="left", padx=5)
+        cancel_button = self.cancel_button = tk.Button(buttons_frame, text="Zrušit", bg="#ff9696", command=self.cancel)
+        cancel_button.pack(side="left", padx=5)
+        
+        self.thread = None
+        self.messages = queue.Queue()
+    
+    def start(self):
+        file = tkfiledialog.askopenfilename(parent=self, filetypes=[("CSV tabulka", "*.csv"), ("Všechny soubory", "*")])
+        if not file:
+            return
+        
+        self.start_button["state"] = "disabled"
+        # a committed chunk can't be taken back, the import runs to the end
+        self.cancel_button["state"] = "disabled"
+        self.status["text"] = "Importuji…"
+        self.thread = threading.Thread(target=self.run_import, args=(file, self.dry_run.get(), self.skip_invalid.get()), daemon=True)
+        self.thread.start()
+        self.after(50, self.poll)
+    
+    def cancel(self):
+        if self.thread is None:
+            self.destroy()
+    
+    def run_import(self, file, dry_run, skip_invalid):
+        """Runs on the import thread, everything for the UI goes through self.messages"""
+        # only needed here, it isn't loaded at startup
+        import importer
+        try:
+            # chunked, so the tills only ever wait for one chunk; a wrong row is found before the first one is committed
+            rows, errors, seconds = importer.import_file(file, dry_run, skip_invalid, chunked=True,
+                                                         progress=lambda done: self.messages.put(("progress", done)))
+            self.messages.put(("done", (rows, errors, seconds)))
+        except importer.InvalidImport as ex:
+            self.messages.put(("invalid", ex.errors))
+        except Exception as ex:
+            traceback.print_exc()
+            self.messages.put(("error", ex))
+        finally:
+            dbutils.close_thread_connection()
+    
+    def error_lines(self, errors):
+        lines = [f"řádek {line}: {message}" for line, message in errors[:self.SHOWN_ERRORS]]
+        if len(errors) > self.SHOWN_ERRORS:
+            lines.append(f"… a další ({len(errors) - self.SHOWN_ERRORS})")
+        return "\n".join(lines)
+    
+    def poll(self):
+        while True:
+            try:
+                kind, value = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            
+            if kind == "progress":
+                self.status["text"] = f"{value} řádků"
+            elif kind == "done":
+                rows, errors, seconds = value
+                message = (f"{'Vyzkoušeno, v pořádku by se naimportovalo' if self.dry_run.get() else 'Hotovo, naimportováno'} {rows} řádků"
+                           f" za {seconds:.1f} s ({rows / seconds if seconds else 0:.0f} řádků/s).")
+                if errors:
+                    message += "\n\nPřeskočené řádky:\n" + self.error_lines(errors)
+                tkmessagebox.showinfo(title="Import", message=message, parent=self)
+                self.destroy()
+                return
+            elif kind == "invalid":
+                tkmessagebox.showerror(title="Chybný soubor", message="Nic nebylo naimportováno, soubor obsahuje chybné řádky:\n"
+                                       + self.error_lines(value), parent=self)
+                self.destroy()
+                return
+            elif kind == "error":
+                if isinstance(value, (OSError, UnicodeError, csv.Error)):
+                    tkmessagebox.showerror(title="Chyba při čtení souboru", message="Soubor se nepodařilo přečíst:\n"+str(value), parent=self)
+                else:
+                    tkmessagebox.showerror(title="Chyba v databázi", message="Při importu se objevila chyba:\n"+str(value), parent=self)
+                self.destroy()
+                return
+        self.after(50, self.poll)
+
+class ArchiveDialog(tk.Toplevel):
+    """Moves old payments to the archive files on its own thread, the tills can be used meanwhile"""
+    BATCH_SIZE = 1000
+    
+    def __init__(self, root):
+        tk.Toplevel.__init__(self, root)
+        self.title("Archivace")
+        self.transient(root)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+        
+        tk.Label(self, text="Platby starší než datum se přesunou do archivních souborů vedle prachy.db.\n"
+                            "Kredity zákazníků se nezmění, historie i export archiv dál zobrazí.", justify="left")\
+          .grid(row=0, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        tk.Label(self, text="Archivovat před (RRRR-MM-DD):").grid(row=1, column=0, sticky="w", padx=5)
+        input_cutoff = self.input_cutoff = tk.Entry(self, width=10)
+        input_cutoff.insert(0, f"{datetime.date.today().year}-01-01")
+        input_cutoff.grid(row=1, column=1, sticky="w")
+        
+        progress = self.progress = ttk.Progressbar(self, length=500, mode="determinate")
+        progress.grid(row=2, column=0, columnspan=2, padx=5, pady=5)
+        status = self.status = tk.Label(self, text="")
+        status.grid(row=3, column=0, columnspan=2)
         
+        buttons_frame = tk.Frame(self)
+        buttons_frame.grid(row=4, column=0, columnspan=2, pady=5)
+        start_button = self.start_button = tk.Button(buttons_frame, text="Archivovat", bg="#a3ffb3", command=self.start)
+        start_button.pack(side="left", padx=5)
+        tk.Button(buttons_frame, text="Zrušit", bg="#ff9696", command=self.cancel)\
+          .pack(side="left", padx=5)
+        
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.messages = queue.Queue()
+    
+    def start(self):
+        cutoff = self.input_cutoff.get().strip()
+        try:
+            datetime.date.fromisoformat(cutoff)
+        except ValueError:
+            tkmessagebox.showerror(title="Špatné datum", message="Datum musí být ve tvaru RRRR-MM-DD.", parent=self)
+            return
+        
+        self.start_button["state"] = "disabled"
+        self.status["text"] = "Archivuji…"
+        self.thread = threading.Thread(target=self.archive, args=(cutoff,), daemon=True)
+        self.thread.start()
+        self.after(50, self.poll)
+    
+    def cancel(self):
+        if self.thread is None:
+            self.destroy()
+            return
+        # stops after the batch being archived, the next archivation continues from there
+        self.cancelled.set()
+        self.status["text"] = "Ruším…"
+    
+    def archive(self, cutoff):
+        """Runs on the archive thread, everything for the UI goes through self.messages"""
+        batches = dbutils.iter_archive(cutoff, self.BATCH_SIZE)
+        try:
+            done = 0
+            for done, total in batches:
+                self.messages.put(("progress", (done, total)))
+                if self.cancelled.is_set():
+                    break
+            self.messages.put(("cancelled" if self.cancelled.is_set() else "done", done))
+        except Exception as ex:
+            traceback.print_exc()
+            self.messages.put(("error", ex))
+        finally:
+            batches.close()
+            dbutils.close_thread_connection()
+    
+    def poll(self):
+        while True:
+            try:
+                kind, value = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            
+            if kind == "progress":
+                done, total = value
+                self.progress["maximum"] = max(total, 1)
+                self.progress["value"] = done
+                self.status["text"] = f"{done} / {total}"
+            elif kind == "done":
+                tkmessagebox.showinfo(title="Archivace", message=f"Hotovo, archivováno {value} plateb.", parent=self)
+                self.destroy()
+                return
+            elif kind == "cancelled":
+                self.destroy()
+                return
+            elif kind == "error":
+                tkmessagebox.showerror(title="Chyba v databázi", message="Při archivaci se objevila chyba:\n"+str(value), parent=self)
+                self.destroy()
+                return
+        self.after(50, self.poll)
+
 class EditProfile(tk.Frame):
     def __init__(self, root):
         self.app = root;
@@ -179,7 +850,7 @@ class EditProfile(tk.Frame):
         info_area = self.info_area = CutomerTopPanel(self)
         info_area.grid(row=0, column=0, columnspan=2, sticky="nsew", padx=5, pady=5)
         
-        order_history = self.order_history = tkscrolledtext.ScrolledText(self, width=30, borderwidth=0, highlightthickness=0, state="disabled", font=tkfont.Font(family='Courier', size=22))
+        order_history = self.order_history = PaymentHistory(self, root.db, self.delete_order, width=30, borderwidth=0, highlightthickness=0, font=tkfont.Font(family='Courier', size=22))
         order_history.grid(row=1, column=1, sticky="nsew")
 
         main_area = tk.Frame(self)
@@ -261,10 +932,11 @@ class EditProfile(tk.Frame):
             return
         value_add = int(value_add)
         
+        recorder.record("add_funds", value_add)
         self.input_funds.delete(0, "end")
-        dbutils.add_funds(self.customer_num, value_add)
-        self.info_area.set_money(dbutils.get_money(self.customer_num))
-        self.load_old_orders()
+        self.app.db.call("add_funds", self.customer_num, value_add)
+        self.load_money()
+        self.order_history.refresh_newest()
         
     def remove_funds_button_callback(self):
         value = self.input_remove_funds.get()
@@ -277,31 +949,41 @@ class EditProfile(tk.Frame):
         if not cancel:
             return
         
+        recorder.record("remove_funds", value)
         self.input_remove_funds.delete(0, "end")
-        dbutils.remove_funds(self.customer_num, value)
-        self.info_area.set_money(dbutils.get_money(self.customer_num))
-        self.load_old_orders()
+        self.app.db.call("remove_funds", self.customer_num, value)
+        self.load_money()
+        self.order_history.refresh_newest()
 
     def save_user_info_button_callback(self):
-        dbutils.save_info(self.customer_num,
+        recorder.record("save_info", self.input_first_name.get(), self.input_last_name.get(), self.input_nickname.get())
+        self.app.db.call("save_info", self.customer_num,
                           self.input_first_name.get(),
                           self.input_last_name.get(),
                           self.input_nickname.get())
         
-        self.info_area.set_customer(dbutils.get_info(self.customer_num))
+        customer_num = self.customer_num
+        self.app.db.call("get_info", customer_num, callback=lambda info: customer_num == self.customer_num and self.info_area.set_customer(info))
+    
+    def load_money(self):
+        # answers come later, the customer might have been closed by then
+        customer_num = self.customer_num
+        self.app.db.call("get_money", customer_num, callback=lambda money: customer_num == self.customer_num and self.info_area.set_money(money))
     
     def setup(self, customer_num, return_to=None):
         self.return_to = return_to
         self.customer_num = customer_num
-        customer_info = dbutils.get_info(self.customer_num)
-        self.info_area.set_customer(customer_info)
+        self.app.db.call("get_info", customer_num, callback=lambda info: customer_num == self.customer_num and self.show_customer(info))
         self.load_old_orders()
+
+        self.focus_set()
+    
+    def show_customer(self, customer_info):
+        self.info_area.set_customer(customer_info)
         
         self.input_first_name.insert(0, customer_info.first_name or "")
         self.input_last_name.insert(0, customer_info.last_name or "")
         self.input_nickname.insert(0, customer_info.nickname or "")
-
-        self.focus_set()
     
     def clear(self):
         self.info_area.clear()
@@ -312,54 +994,24 @@ class EditProfile(tk.Frame):
         self.input_last_name.delete(0, "end")
         self.input_nickname.delete(0, "end")
         
-        self.order_history['state'] = 'normal'
-        self.order_history.delete("1.0", "end")
-        self.order_history['state'] = 'disabled'
+        self.order_history.clear()
         
     def delete_order(self, order_id):
         cancel = tkmessagebox.askyesno(title="Zrušení z historie", message="Opravdu chcete tento pohyb na účtu zrušit?")
         if not cancel:
             return
         
-        dbutils.delete_payment(order_id)
-        self.info_area.set_money(dbutils.get_money(self.customer_num))
-        self.load_old_orders()
+        recorder.record("delete", order_id)
+        self.app.db.call("delete_payment", order_id)
+        self.load_money()
+        self.order_history.remove_payment(order_id)
+    
+    def external_change(self):
+        self.load_money()
+        self.order_history.refresh_newest()
         
     def load_old_orders(self):
-        self.order_history['state'] = 'normal'
-        self.order_history.delete("1.0", "end")
-        
-        payments = dbutils.get_payment_list(self.customer_num)
-        total = 0
-        
-        for payment in payments:
-            pay_id, typ, stamp, pay_total, orders = payment
-            
-            if typ == "ORDER_PAYMENT":
-                typ = "Objednávka"
-            elif typ == "ADD_FUNDS":
-                typ = "Nabití kreditu"
-            elif typ == "REMOVE_FUNDS":
-                typ = "Vybití kreditu"
-                
-            button = tk.Button(self.order_history, text="X", cursor="left_ptr",
-                       bd=0, bg=self.order_history["bg"], fg="#a60000", highlightthickness=0,
-                       command = lambda pay_id=pay_id: self.delete_order(pay_id))
-                       
-            self.order_history.insert("end", stamp)
-            self.order_history.window_create("end", window = button)
-            text_out = "\n" +typ + "\n" + "------------\n"
-            total += pay_total
-            if orders:
-                text_out += "\n".join(("%s\t\t%sx" % (order[0], order[1])  for order in orders))
-                text_out += "\n------------\n"
-            
-            text_out += "Zůstatek %d (%+d)\n" % (total, pay_total)
-            
-            self.order_history.insert("end", text_out + "\n\n")
-        
-        self.order_history['state'] = 'disabled'
-        self.order_history.see('end')
+        self.order_history.load(self.customer_num)
 
 
 class Order(tk.Frame):
@@ -370,19 +1022,22 @@ class Order(tk.Frame):
         info_area = self.info_area = CutomerTopPanel(self)
         info_area.grid(row=0, column=0, columnspan=2, sticky="nsew", padx=5, pady=5)
         
-        button_area = AutoGrid(self)
+        spacing = int(self.app.config["button.spacing"] / 2)
+        button_area = AutoGrid(self, cell_size=self.app.config["button.size"] + spacing * 2)
         button_area.grid(row=1, column=0, sticky='nsew')
         
+        self.button_fonts = {} # all the price buttons share one font per size
+        
         for i, settings in enumerate(self.app.config["buttons"]):
             button=self.create_price_button(button_area, settings["color"], settings["value"], settings.get("text", None))
-            button.grid()
+            button_area.add(button)
 
         prep_area = self.prep_area = tk.Text(self, width=28, borderwidth=0, highlightthickness=0, state="disabled", font=tkfont.Font(family='Courier', size=22));
         prep_area.grid(row=1, column=1, sticky='sn')
         
         finish_area = tk.Frame(self)
         finish_area.grid(row=2, column=0, columnspan=2, padx=5, pady=5, sticky="we")
-        done_button=tk.Button(finish_area, text="Zaplatit", bg="#a3ffb3", font="BPThicc", command=self.done_button_callback)
+        done_button = self.done_button = tk.Button(finish_area, text="Zaplatit", bg="#a3ffb3", font="BPThicc", command=self.done_button_callback)
         done_button.pack(side="right")
         
         cancel_button=tk.Button(finish_area, text="Zrušit", bg="#ff9696", font="BPThicc", command=self.cancel_button_callback)
@@ -392,9 +1047,9 @@ class Order(tk.Frame):
         center_buttons = tk.Frame(finish_area)
         center_buttons.pack()
         
-        add_funds_button = tk.Button(center_buttons, text="Nabít kredit", bg="#fffb80", font="BPThicc", command=self.add_funds_button_callback)
+        add_funds_button = self.add_funds_button = tk.Button(center_buttons, text="Nabít kredit", bg="#fffb80", font="BPThicc", command=self.add_funds_button_callback)
         add_funds_button.pack(side="left")
-        profile_button = tk.Button(center_buttons, text="Profil", bg="#fffb80", font="BPThicc", command=self.profile_button_callback)
+        profile_button = self.profile_button = tk.Button(center_buttons, text="Profil", bg="#fffb80", font="BPThicc", command=self.profile_button_callback)
         profile_button.pack(side="left", padx=5)
         
         
@@ -406,10 +1061,15 @@ class Order(tk.Frame):
         self.grid_columnconfigure(0, weight=1)
         self.grid_columnconfigure(1, weight=0)
         
+        self.line_buttons = {}
         self.clear()
         
     def cancel_button_callback(self):
-        if self.orders:
+        # the order is being saved, cancelling wouldn't stop it
+        if self.paying:
+            self.bell()
+            return
+        if self.basket:
             cancel = tkmessagebox.askyesno(title="Zrušit objednávku", message="Opravdu chcete zrušit tuto objednávku?")
         else:
             cancel = True
@@ -419,21 +1079,45 @@ class Order(tk.Frame):
             self.app.open_frame("MainPage")
         
     def done_button_callback(self):
-        if not self.orders:
+        if not self.basket or self.paying or not self.money_loaded:
             self.bell()
             return
-    
-        money = dbutils.get_money(self.customer_num)
-        total = sum((x*y for (_, x),y in self.orders.items()))
         
-        mbox_text = "Zákazník si objednal za více, než kolik má nabito.\n Chcete pokračovat v platbě? (Zákazníkovi se tím vytvoří dluh)"
-        if total > money and not tkmessagebox.askyesno(title="Poračovat na dluh", message=mbox_text):
+        # the shown balance settles the usual case, save_order checks it again in its transaction in case another till was faster
+        overdraft = self.basket.needs_overdraft(self.money)
+        if overdraft and not self.confirm_overdraft():
             return
-        
-        dbutils.save_order(self.customer_num, self.orders)
+        self.pay(allow_overdraft=overdraft)
+    
+    def confirm_overdraft(self):
+        mbox_text = "Zákazník si objednal za více, než kolik má nabito.\n Chcete pokračovat v platbě? (Zákazníkovi se tím vytvoří dluh)"
+        return tkmessagebox.askyesno(title="Poračovat na dluh", message=mbox_text)
+    
+    def pay(self, allow_overdraft):
+        recorder.record("pay", allow_overdraft)
+        self.paying = True
+        self.update_buttons()
+        num = self.customer_num
+        # a copy, the worker thread reads it while the basket stays in the UI
+        self.app.db.call("save_order", num, dict(self.basket.lines), allow_overdraft=allow_overdraft,
+                         callback=lambda _: num == self.customer_num and self.paid(),
+                         errback=lambda ex: num == self.customer_num and self.pay_failed(ex))
+    
+    def paid(self):
         self.clear()
         self.app.open_frame("MainPage")
     
+    def pay_failed(self, ex):
+        self.paying = False
+        self.update_buttons()
+        if not isinstance(ex, dbutils.InsufficientFunds):
+            self.app.db_error(None, ex)
+            return
+        # another till spent the money in the meantime
+        self.set_money(ex.balance)
+        if self.confirm_overdraft():
+            self.pay(allow_overdraft=True)
+    
     def profile_button_callback(self):
         self.app.open_frame("EditProfile", self.customer_num, return_to="Order")
     
@@ -442,79 +1126,150 @@ class Order(tk.Frame):
         if not value:
             return
         
-        dbutils.add_funds(self.customer_num, value)
+        recorder.record("add_funds", value)
+        self.app.db.call("add_funds", self.customer_num, value)
         self.setup_money()
     
     def clear(self):
         self.info_area.clear();
         self.customer_num = -1
-        self.orders = {}
+        self.basket = service.Basket()
         self.money = 0
+        # money is only a placeholder until get_info answers, paying can't decide about the overdraft on it
+        self.money_loaded = False
+        self.paying = False
+        self.update_buttons()
         #self.old_order_id = -1
         #self.old_orders = ""
-        self.redraw_orders()
+        self.clear_orders()
     
     def returned_back(self, from_page):
         self.setup(num=self.customer_num)
     
+    def update_buttons(self):
+        """Paying waits for the balance, nothing else can be done with the customer while an order is being saved"""
+        self.done_button["state"] = "normal" if self.money_loaded and not self.paying else "disabled"
+        for button in (self.add_funds_button, self.profile_button):
+            button["state"] = "disabled" if self.paying else "normal"
+    
     def setup(self, num, old_order=False):
         self.customer_num = num
-        customer_info = dbutils.get_info(self.customer_num)
-        self.info_area.set_customer(customer_info)
-        self.money = customer_info.balance
+        self.money_loaded = False
+        self.update_buttons()
+        self.app.db.call("get_info", num, callback=lambda info: num == self.customer_num and self.show_customer(info))
         
         #This is yet unused
         #self.old_orders = ""
         
         self.focus_set()
+    
+    def show_customer(self, customer_info):
+        self.info_area.set_customer(customer_info)
+        self.money = customer_info.balance
+        self.money_loaded = True
+        self.update_buttons()
+        self.schedule_redraw()
         
     def setup_money(self, load_money=True):
         if load_money:
-            self.money = dbutils.get_money(self.customer_num)
+            num = self.customer_num
+            self.app.db.call("get_money", num, callback=lambda money: num == self.customer_num and self.set_money(money))
+        else:
+            self.set_money(self.money)
+    
+    def set_money(self, money):
+        self.money = money
         self.info_area.set_money(self.money)
-        self.redraw_orders()
+        self.schedule_redraw()
+    
+    def external_change(self):
+        if self.customer_num >= 0:
+            self.setup_money()
         
     def remove_item(self, key):
-        count = self.orders.get(key, 0) - 1
-        if(count < 1):
-            self.orders.pop(key)
-        else:
-            self.orders[key] = count
-        self.redraw_orders()
-        
+        if self.paying:
+            self.bell()
+            return
+        recorder.record("untap", *key)
+        self.basket.remove(*key)
+        self.schedule_redraw(key)
+    
+    def schedule_redraw(self, key=None):
+        """Marks a line of the basket as changed, all changes until Tk gets idle are drawn at once"""
+        if key is not None:
+            self.changed_lines.add(key)
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.after_idle(self.redraw_orders)
+    
+    def clear_orders(self):
+        for button in self.line_buttons.values():
+            button.destroy()
+        self.line_keys = [] # keys of the lines in prep_area, sorted the same way
+        self.line_buttons = {}
+        self.changed_lines = set()
+        self.redraw_pending = False
         
-    def redraw_orders(self):
         self.prep_area['state'] = 'normal'
         self.prep_area.delete("1.0", "end")
-        
-        total = sum((x*y for (_,x),y in self.orders.items()))
-        
         self.prep_area.insert("end","Věci v objednávce:\n")
+        self.prep_area.insert("end", self.summary_text(), "summary")
+        self.prep_area['state'] = 'disabled'
         
-        for (name, val), num in sorted(self.orders.items()):
-            key = (name, val)
-            name = name.replace("\n", " ")
-            if len(name) > 17:
-                name = name[:10]+"..."
-            text = f'{name:<17}{val:>4}{num:>3}x '
-            self.prep_area.insert("end", text)
-            button = tk.Button(self.prep_area, text="x", cursor="left_ptr",
-                       bd=0, bg=self.prep_area["bg"], fg="#a60000", highlightthickness=0,
-                       command = lambda key=key: self.remove_item(key))
-            self.prep_area.window_create("end", window = button)
-            self.prep_area.insert("end", "\n")
-                       
+    def redraw_orders(self):
+        """Redraws the changed lines and the summary, every item has its own line on line number 2 + its position"""
+        self.redraw_pending = False
+        self.prep_area['state'] = 'normal'
+        
+        for key in sorted(self.changed_lines):
+            num = self.basket.count(*key)
+            pos = bisect.bisect_left(self.line_keys, key)
+            line = pos + 2
+            exists = pos < len(self.line_keys) and self.line_keys[pos] == key
             
-        self.prep_area.insert("end", "-------------------\nCelkem: "+str(total)+"\nZůstatek: "+str(self.money-total))
+            if exists and not num:
+                self.prep_area.delete(f"{line}.0", f"{line + 1}.0")
+                self.line_buttons.pop(key).destroy()
+                del self.line_keys[pos]
+            elif exists:
+                # the button is an index too, everything before it is the line text
+                self.prep_area.delete(f"{line}.0", self.line_buttons[key])
+                self.prep_area.insert(f"{line}.0", self.line_text(key, num))
+            elif num:
+                text = self.line_text(key, num)
+                self.prep_area.insert(f"{line}.0", text + "\n")
+                button = self.line_buttons[key] = tk.Button(self.prep_area, text="x", cursor="left_ptr",
+                           bd=0, bg=self.prep_area["bg"], fg="#a60000", highlightthickness=0,
+                           command = lambda key=key: self.remove_item(key))
+                self.prep_area.window_create(f"{line}.{len(text)}", window = button)
+                self.line_keys.insert(pos, key)
+        self.changed_lines.clear()
+        
+        self.prep_area.delete("summary.first", "summary.last")
+        self.prep_area.insert("end-1c", self.summary_text(), "summary")
         
         self.prep_area['state'] = 'disabled'
         self.prep_area.see('end')
     
+    @staticmethod
+    def line_text(key, num):
+        name, val = key
+        name = name.replace("\n", " ")
+        if len(name) > 17:
+            name = name[:10]+"..."
+        return f'{name:<17}{val:>4}{num:>3}x '
+    
+    def summary_text(self):
+        return "-------------------\nCelkem: "+str(self.basket.total)+"\nZůstatek: "+str(self.basket.remaining(self.money))
     
     def price_button_callback(self, name, value):
-        key = (name, value)
-        self.orders[key] = self.orders.get(key, 0) + 1
-        self.redraw_orders()
+        # the basket being paid stays as it is
+        if self.paying:
+            self.bell()
+            return
+        recorder.record("tap", name, value)
+        self.basket.add(name, value)
+        self.schedule_redraw((name, value))
 
     def create_price_button(self, root, color, price, text=None):
         spacing = int(self.app.config["button.spacing"] / 2)
@@ -531,7 +1286,9 @@ class Order(tk.Frame):
         price_button.place(x=spacing, y=spacing, width=butt_size, height=butt_size)
         price_button["anchor"] = "center"
         price_button["bg"] = color
-        price_button["font"] = tkfont.Font(family='Arial',size=font_size, weight="bold")
+        if font_size not in self.button_fonts:
+            self.button_fonts[font_size] = tkfont.Font(family='Arial',size=font_size, weight="bold")
+        price_button["font"] = self.button_fonts[font_size]
         price_button["fg"] = "#000000"
         price_button["justify"] = "center"
         price_button["text"] = text
@@ -561,12 +1318,7 @@ class CutomerTopPanel(tk.Frame):
         
     def set_customer(self, customer_info):
         self.customer_label["text"] = customer_info.customer_id
-        if customer_info.nickname:
-            self.set_customer_name(customer_info.nickname)
-        elif customer_info.first_name and customer_info.last_name:
-            self.set_customer_name(customer_info.first_name+ " " + customer_info.last_name)
-        elif customer_info.first_name or customer_info.last_name:
-            self.set_customer_name(customer_info.first_name or customer_info.last_name)
+        self.set_customer_name(service.customer_name(customer_info))
         
         self.money_label["text"] = customer_info.balance;
     
@@ -585,29 +1337,329 @@ class CutomerTopPanel(tk.Frame):
         self.money_label["text"] = "-";
         self.customer_name_label["text"] = ""
 
+class PaymentHistory(tk.Frame):
+    """Payment history of one customer. Only a window of at most MAX_LOADED payments is rendered,
+    older and newer pages are loaded from the database while scrolling and the far end of the window is dropped.
+    Scrolling past the archive checkpoint goes on into the archived payments"""
+    PAGE_SIZE = 20
+    MAX_LOADED = 60
+    
+    def __init__(self, root, db, delete_callback, **kwargs):
+        tk.Frame.__init__(self, root)
+        self.db = db
+        self.delete_callback = delete_callback
+        
+        text = self.text = tk.Text(self, state="disabled", **kwargs)
+        scrollbar = self.scrollbar = tk.Scrollbar(self, command=text.yview)
+        text["yscrollcommand"] = self.on_scroll
+        text.grid(row=0, column=0, sticky="nsew")
+        scrollbar.grid(row=0, column=1, sticky="ns")
+        
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        
+        self.entries = []
+        self.buttons = {}
+        self.customer_id = None
+        self.has_older = False
+        self.has_newer = False
+        self.load_pending = False
+        self.archived = False
+        # key of the checkpoint, the payments before it come from the archive
+        self.checkpoint = None
+        self.generation = 0
+    
+    def fetch(self, callback, **kwargs):
+        """Loads a page through the db worker, answers that come after the history was cleared are dropped"""
+        generation = self.generation
+        self.db.call("get_payment_list", self.customer_id, self.PAGE_SIZE, archived=self.archived,
+                     callback=lambda records: generation == self.generation and callback(records), **kwargs)
+    
+    def load(self, customer_id):
+        """Shows the newest payments of the customer"""
+        self.clear()
+        self.customer_id = customer_id
+        self.load_pending = True
+        self.fetch(self.loaded)
+    
+    def loaded(self, records):
+        self.load_pending = False
+        self.has_older = len(records) == self.PAGE_SIZE
+        self.insert_entries(records, "end")
+        self.text.see("end")
+    
+    def refresh_newest(self):
+        """Adds payments made after the newest shown one and scrolls to the end"""
+        if self.has_newer or not self.entries:
+            self.load(self.customer_id)
+            return
+        self.fetch(self.refreshed, after=self.entries[-1].key)
+    
+    def refreshed(self, records):
+        if len(records) == self.PAGE_SIZE:
+            self.load(self.customer_id)
+            return
+        self.insert_entries(records, "end")
+        self.trim(from_start=True)
+        self.text.see("end")
+    
+    def remove_payment(self, payment_id):
+        """Removes a deleted payment and fixes the balances shown after it"""
+        position = next((i for i, record in enumerate(self.entries) if record.payment_id == payment_id), None)
+        if position is None:
+            return
+        removed = self.entries[position]
+        self.delete_entries(position, position + 1)
+        
+        self.text["state"] = "normal"
+        for i in range(position, len(self.entries)):
+            record = self.entries[i] = dataclasses.replace(self.entries[i], balance=self.entries[i].balance - removed.balance_change)
+            tag = f"balance{record.payment_id}"
+            start = self.text.index(tag + ".first")
+            self.text.delete(start, tag + ".last")
+            self.text.insert(start, service.balance_text(record), tag)
+        self.text["state"] = "disabled"
+    
+    def clear(self):
+        self.delete_entries(0, len(self.entries))
+        self.customer_id = None
+        self.has_older = False
+        self.has_newer = False
+        self.load_pending = False
+        self.archived = False
+        self.checkpoint = None
+        self.generation += 1
+    
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self.load_pending:
+            return
+        # the archives are only opened when the user gets to the checkpoint
+        if float(first) < 0.05 and not self.has_older and not self.archived and self.entries and self.entries[0].description == "ARCHIVE_CHECKPOINT":
+            self.archived = True
+            self.checkpoint = self.entries[0].key
+            self.has_older = True
+        if float(first) < 0.05 and self.has_older or float(last) > 0.95 and self.has_newer:
+            self.load_pending = True
+            if float(first) < 0.05 and self.has_older:
+                self.fetch(lambda records: self.page_loaded(records, True), before=self.entries[0].key)
+            else:
+                self.fetch(lambda records: self.page_loaded(records, False), after=self.entries[-1].key)
+    
+    def page_loaded(self, records, older):
+        self.load_pending = False
+        
+        # keep the payment the user looks at in place while the text around it changes
+        self.text.mark_set("view", "@0,0")
+        if older:
+            self.has_older = len(records) == self.PAGE_SIZE
+            self.insert_entries(records, "1.0")
+        else:
+            self.has_newer = len(records) == self.PAGE_SIZE
+            self.insert_entries(records, "end")
+        self.trim(from_start=not older)
+        self.text.yview("view")
+    
+    def trim(self, from_start):
+        extra = len(self.entries) - self.MAX_LOADED
+        if extra <= 0:
+            return
+        if from_start:
+            self.delete_entries(0, extra)
+            self.has_older = True
+        else:
+            self.delete_entries(len(self.entries) - extra, len(self.entries))
+            self.has_newer = True
+    
+    def insert_entries(self, records, where):
+        """Renders records (oldest first) at the start or the end of the text"""
+        if not records:
+            return
+        text = self.text
+        text["state"] = "normal"
+        # right gravity moves the mark behind everything inserted at it, so the pieces come out in order
+        text.mark_set("insert_here", "1.0" if where == "1.0" else "end-1c")
+        text.mark_gravity("insert_here", "right")
+        for record in records:
+            start = text.index("insert_here")
+            self.render(record)
+            # marks keep the default right gravity, so older entries inserted at 1.0 end up before them
+            text.mark_set(f"payment{record.payment_id}", start)
+        text["state"] = "disabled"
+        
+        if where == "1.0":
+            self.entries[0:0] = records
+        else:
+            self.entries.extend(records)
+    
+    def delete_entries(self, start, stop):
+        """Removes entries[start:stop] from the text and destroys their buttons"""
+        if start >= stop:
+            return
+        text = self.text
+        text["state"] = "normal"
+        end = f"payment{self.entries[stop].payment_id}" if stop < len(self.entries) else "end-1c"
+        text.delete(f"payment{self.entries[start].payment_id}", end)
+        text["state"] = "disabled"
+        
+        for record in self.entries[start:stop]:
+            text.mark_unset(f"payment{record.payment_id}")
+            button = self.buttons.pop(record.payment_id, None)
+            if button:
+                button.destroy()
+        del self.entries[start:stop]
+    
+    def render(self, record):
+        self.text.insert("insert_here", record.stamp_text)
+        # the checkpoint stands for the archived payments, neither it nor they can be deleted, delete_payment only sees the live ones
+        archived = self.checkpoint is not None and record.key < self.checkpoint
+        if record.description != "ARCHIVE_CHECKPOINT" and not archived:
+            button = self.buttons[record.payment_id] = tk.Button(self.text, text="X", cursor="left_ptr",
+                       bd=0, bg=self.text["bg"], fg="#a60000", highlightthickness=0,
+                       command = lambda pay_id=record.payment_id: self.delete_callback(pay_id))
+            self.text.window_create("insert_here", window = button)
+        text_out = "\n" + service.payment_type(record) + "\n" + "------------\n"
+        if record.orders:
+            text_out += service.orders_text(record)
+            text_out += "\n------------\n"
+        self.text.insert("insert_here", text_out)
+        self.text.insert("insert_here", service.balance_text(record), f"balance{record.payment_id}")
+        self.text.insert("insert_here", "\n\n")
+
 class AutoGrid(tk.Frame):
-    def __init__(self, root=None, **kwargs):
+    """Grids children of the same size in as many columns as fit, in the order they were added.
+    When they don't fit into the height either, they are split into pages with buttons to flip them.
+    The layout is computed from cell_size alone and only after the resizing stops, only children that
+    end up in another cell are moved."""
+    RESIZE_DELAY = 50
+    
+    def __init__(self, root=None, cell_size=None, **kwargs):
         tk.Frame.__init__(self, root, **kwargs)
-        self.columns = None
-        self.bind('<Configure>', self.regrid)
+        # the size comes from the parent, not from the children, so regridding can't resize the window
+        self.grid_propagate(False)
+        self.cell_size = cell_size
+        self.cells = []
+        self.positions = {} # widget -> (row, column) where it is gridded now
+        self.width = self.height = 1
+        self.layout = None
+        self.page = 0
+        self.regrid_after = None
+        
+        pager = self.pager = tk.Frame(self)
+        tk.Button(pager, text="◀", font="BPThicc", command=lambda: self.flip(-1)).pack(side="left")
+        page_label = self.page_label = tk.Label(pager, font="BPThicc")
+        page_label.pack(side="left", padx=5)
+        tk.Button(pager, text="▶", font="BPThicc", command=lambda: self.flip(1)).pack(side="left")
+        
+        self.bind('<Configure>', self.schedule_regrid)
+    
+    def add(self, widget):
+        self.cells.append(widget)
+        self.layout = None
+        self.schedule_regrid()
+    
+    def schedule_regrid(self, event=None):
+        # <Configure> comes dozens of times a second while the window is resized, only the last one matters
+        if event is not None:
+            self.width, self.height = event.width, event.height
+        if self.regrid_after is not None:
+            self.after_cancel(self.regrid_after)
+        self.regrid_after = self.after(self.RESIZE_DELAY, self.regrid)
+    
+    def flip(self, step):
+        self.page += step
+        self.regrid()
+    
+    def regrid(self):
+        self.regrid_after = None
+        if not self.cells:
+            return
+        if self.cell_size is None:
+            # all the cells are the same, measure one once
+            self.cell_size = max(self.cells[0].winfo_reqwidth(), self.cells[0].winfo_reqheight())
+        
+        columns = max(1, self.width // self.cell_size)
+        rows = max(1, self.height // self.cell_size)
+        if columns * rows < len(self.cells):
+            # room for the pager under the buttons
+            rows = max(1, (self.height - self.pager.winfo_reqheight()) // self.cell_size)
+        per_page = columns * rows
+        pages = -(-len(self.cells) // per_page)
+        self.page = min(max(self.page, 0), pages - 1)
+        
+        layout = (columns, rows, self.page)
+        if layout == self.layout:
+            return
+        self.layout = layout
+        
+        shown = range(self.page * per_page, min((self.page + 1) * per_page, len(self.cells)))
+        for i, widget in enumerate(self.cells):
+            position = divmod(i - shown.start, columns) if i in shown else None
+            if position == self.positions.get(widget):
+                continue
+            if position is None:
+                widget.grid_remove()
+            else:
+                widget.grid(row=position[0], column=position[1])
+            self.positions[widget] = position
+        
+        if pages > 1:
+            self.page_label["text"] = f"{self.page + 1}/{pages}"
+            self.pager.place(relx=1, rely=1, anchor="se")
+            self.pager.lift()
+        else:
+            self.pager.place_forget()
+
+class DiagnosticsDialog(tk.Toplevel):
+    """Latencies recorded by instrument, opened with Ctrl+Shift+D when diagnostics are on in the config"""
+    REFRESH_INTERVAL = 1000
+    
+    def __init__(self, root):
+        tk.Toplevel.__init__(self, root)
+        self.title("Diagnostika")
+        self.transient(root)
+        
+        text = self.text = tk.Text(self, font=("Courier", 12), wrap="none", width=100, height=30)
+        text.pack(fill="both", expand=True)
+        self.refresh_after = None
+        self.bind("<Destroy>", self.destroyed)
+        self.refresh()
+    
+    def refresh(self):
+        self.text["state"] = "normal"
+        self.text.delete("1.0", "end")
+        self.text.insert("end", instrument.report())
+        self.text["state"] = "disabled"
+        self.refresh_after = self.after(self.REFRESH_INTERVAL, self.refresh)
+    
+    def destroyed(self, event):
+        # the text inside gets its own <Destroy> through the bindings of the window
+        if event.widget is self and self.refresh_after is not None:
+            self.after_cancel(self.refresh_after)
+            self.refresh_after = None
 
-    def regrid(self, event=None):
-        width = self.winfo_width()
-        slaves = self.grid_slaves()
-        max_width = max(slave.winfo_width() for slave in slaves)
-        cols = width // max_width
-        if cols == self.columns or cols < 1: # if the column number has not changed, abort
-            return
-        for slave in slaves:
-            slave.grid_forget()
-        for i, slave in enumerate(reversed(slaves)):
-            slave.grid(row=i//cols, column=i%cols)
-        self.columns = cols
-     
+def enable_diagnostics(slow_ms):
+    """Times the dbutils functions and the slow UI paths from now on"""
+    instrument.enable(slow_ms)
+    # transaction and retry_locked make other functions, they aren't calls of their own
+    instrument.install(dbutils, skip={"transaction", "retry_locked", "get_connection"})
+    instrument.install_methods(App, "open_frame")
+    instrument.install_methods(Order, "redraw_orders")
+    instrument.install_methods(EditProfile, "load_old_orders")
+    instrument.install_methods(PaymentHistory, "insert_entries")
+    instrument.install_methods(AutoGrid, "regrid")
 
 def run_app():
     app = App()
     app.mainloop()
+    if app.api is not None:
+        app.api.close()
+    app.db.close()
+    app.backups.close()
+    if instrument.is_enabled():
+        print(instrument.report(), flush=True)
+    recorder.stop()
+    dbutils.close_connections()
     
 if __name__ == "__main__":
     run_app()
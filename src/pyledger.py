@@ -0,0 +1,320 @@
+""" The ledger functions of dbutils on Python dicts instead of SQLite, for tests and for benchmarks that want the cost
+of the logic without the SQL and the disk. Nothing is saved, reset() starts over. See storage.py.
+
+The functions answer the same as the dbutils ones do over a database that was never archived:
+archival, backups and the archives in the history need SQLite. """
+
+import bisect, contextlib, re, threading, time, unicodedata
+from data_classes import *
+from dbutils import InsufficientFunds, DAY, MIN_STAMP, MAX_STAMP, date_stamp
+
+# one writer at a time like SQLite, the reads take it too so they never see half of a transaction
+_lock = threading.RLock()
+_local = threading.local()
+
+class _Payment:
+    __slots__ = ("customer_id", "stamp", "description", "balance_change", "orders")
+
+    def __init__(self, customer_id, stamp, description, balance_change, orders=()):
+        self.customer_id = customer_id
+        self.stamp = stamp
+        self.description = description
+        self.balance_change = balance_change
+        # (item_name, item_cost, count) of every order line
+        self.orders = orders
+
+def reset():
+    """Forgets everything, the ledger is empty again"""
+    global _customers, _balances, _payments, _history, _items, _last_payment
+    with _lock:
+        # customer_id: (first_name, last_name, nickname)
+        _customers = {}
+        # customer_id: balance of the customers with a payment, like customer_balances
+        _balances = {}
+        # payment_id: _Payment
+        _payments = {}
+        # customer_id: sorted [(stamp, payment_id)] of their payments
+        _history = {}
+        # the catalog of item names, in the order they were added
+        _items = {}
+        _last_payment = 0
+
+reset()
+
+def _log(undo, *args):
+    """Remembers how to undo a change, for when the transaction it is in fails"""
+    _local.undo.append((undo, args))
+
+@contextlib.contextmanager
+def transaction():
+    """Like dbutils.transaction, nested blocks are undone on their own when they fail, yields None instead of a cursor"""
+    with _lock:
+        depth = getattr(_local, "depth", 0)
+        if not depth:
+            _local.undo = []
+        mark = len(_local.undo)
+        _local.depth = depth + 1
+        try:
+            yield None
+        except BaseException:
+            while len(_local.undo) > mark:
+                undo, args = _local.undo.pop()
+                undo(*args)
+            raise
+        finally:
+            _local.depth = depth
+
+def retry_locked(func):
+    # nothing else can hold the lock for long
+    return func
+
+def prepare_db():
+    pass
+
+def warm_cache():
+    pass
+
+def clear_cache():
+    pass
+
+def close_connections():
+    pass
+
+def close_thread_connection():
+    pass
+
+def data_changed():
+    # only this process changes it, and always through these functions
+    return False
+
+def change_count():
+    return 0
+
+def _put_payment(payment_id, payment):
+    _payments[payment_id] = payment
+    bisect.insort(_history.setdefault(payment.customer_id, []), (payment.stamp, payment_id))
+    _balances[payment.customer_id] = _balances.get(payment.customer_id, 0) + payment.balance_change
+
+def _pop_payment(payment_id, drop_balance=False):
+    payment = _payments.pop(payment_id)
+    history = _history[payment.customer_id]
+    del history[bisect.bisect_left(history, (payment.stamp, payment_id))]
+    _balances[payment.customer_id] -= payment.balance_change
+    if drop_balance:
+        del _balances[payment.customer_id]
+    return payment
+
+def _insert_payment(customer_id, description, balance_change, orders=(), stamp=None):
+    global _last_payment
+    _last_payment += 1
+    payment_id = _last_payment
+    new_balance = customer_id not in _balances
+    _put_payment(payment_id, _Payment(customer_id, int(time.time()) if stamp is None else stamp, description, balance_change, orders))
+    _log(_pop_payment, payment_id, new_balance)
+    return payment_id
+
+def _set_customer(customer_id, names):
+    _log(_restore_customer, customer_id, _customers.get(customer_id))
+    _customers[customer_id] = names
+
+def _restore_customer(customer_id, names):
+    if names is None:
+        del _customers[customer_id]
+    else:
+        _customers[customer_id] = names
+
+def _add_item(name):
+    if name not in _items:
+        _items[name] = len(_items) + 1
+        _log(_items.pop, name)
+
+def _info(customer_id):
+    names = _customers.get(customer_id, (None, None, None))
+    return CustomerInfo(customer_id, *names, _balances.get(customer_id, 0))
+
+def get_info(customer_id):
+    with _lock:
+        return _info(customer_id)
+
+def get_money(customer_id):
+    return get_info(customer_id).balance
+
+def _words(text):
+    """The words of text the way the customers_search index splits them, lowercase and without diacritics"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return re.findall(r"\w+", "".join(char for char in text if not unicodedata.combining(char)))
+
+def search_customers(text, limit=10):
+    """Customers with a name word starting with every word of text, by customer number"""
+    words = _words(text)
+    if not words:
+        return []
+    found = []
+    with _lock:
+        for customer_id in sorted(_customers):
+            names = [word for name in _customers[customer_id] if name for word in _words(name)]
+            if all(any(name.startswith(word) for name in names) for word in words):
+                found.append(_info(customer_id))
+                if len(found) == limit:
+                    break
+    return found
+
+def save_info(customer_id, first_name, last_name, nickname):
+    with transaction():
+        _set_customer(customer_id, (first_name or None, last_name or None, nickname or None))
+
+def sync_items(names):
+    with transaction():
+        for name in names:
+            _add_item(name)
+
+def save_order(customer_id, order, allow_overdraft=True):
+    """Saves the order {(item_name, item_cost): count}, see dbutils.save_order"""
+    with transaction():
+        total = sum(val * count for (_, val), count in order.items())
+        if not allow_overdraft:
+            balance = _balances.get(customer_id, 0)
+            if total > 0 and total > balance:
+                raise InsufficientFunds(balance, total)
+        for name, _ in order:
+            _add_item(name)
+        _insert_payment(customer_id, "ORDER_PAYMENT", -total, tuple((name, val, count) for (name, val), count in order.items()))
+
+def add_funds(customer_id, amount):
+    with transaction():
+        _insert_payment(customer_id, "ADD_FUNDS", amount)
+
+def remove_funds(customer_id, amount):
+    with transaction():
+        _insert_payment(customer_id, "REMOVE_FUNDS", -amount)
+
+def delete_payment(payment_id):
+    with transaction():
+        if payment_id not in _payments:
+            return
+        payment = _pop_payment(payment_id)
+        _log(_put_payment, payment_id, payment)
+
+def _record(payment_id, balance):
+    payment = _payments[payment_id]
+    # the lines by name descending, like dbutils reads them
+    orders = tuple(sorted(((name, count, cost * count) for name, cost, count in payment.orders), reverse=True))
+    return PaymentRecord(payment_id, payment.description, payment.stamp, payment.balance_change, balance, orders)
+
+def get_payment_list(customer_id, limit=None, before=None, after=None, archived=False):
+    """PaymentRecords of a customer, oldest first, see dbutils.get_payment_list. There are no archives, archived changes nothing"""
+    with _lock:
+        history = _history.get(customer_id, [])
+        if after is not None:
+            start = bisect.bisect_right(history, tuple(after))
+            stop = len(history) if limit is None else min(start + limit, len(history))
+        else:
+            stop = len(history) if before is None else bisect.bisect_left(history, tuple(before))
+            start = 0 if limit is None else max(stop - limit, 0)
+        balance = _balances.get(customer_id, 0) - sum(_payments[payment_id].balance_change for _, payment_id in history[stop:])
+        records = []
+        for _, payment_id in reversed(history[start:stop]):
+            records.append(_record(payment_id, balance))
+            balance -= _payments[payment_id].balance_change
+    records.reverse()
+    return records
+
+def get_order_list(payment_id):
+    with _lock:
+        payment = _payments.get(payment_id)
+        if payment is None:
+            return []
+        return sorted(((name, count, cost * count) for name, cost, count in payment.orders), reverse=True)
+
+def get_payments_between(start, end, customer_id=None):
+    with _lock:
+        rows = [(payment_id, payment.customer_id, payment.stamp, payment.description, payment.balance_change)
+                for payment_id, payment in _payments.items()
+                if start <= payment.stamp < end and (customer_id is None or payment.customer_id == customer_id)]
+    return sorted(rows, key=lambda row: (row[2], row[0]))
+
+def rebuild_rollups():
+    # the report is counted from the payments every time
+    pass
+
+def get_sales_report(since, until):
+    """SalesReport of the days from since to until (YYYY-MM-DD, inclusive), counted from all the payments"""
+    start, end = date_stamp(since), date_stamp(until) + DAY
+    added = removed = spent = orders = 0
+    items = {}
+    with _lock:
+        for payment in _payments.values():
+            if not start <= payment.stamp < end:
+                continue
+            if payment.description == "ADD_FUNDS":
+                added += payment.balance_change
+            elif payment.description == "REMOVE_FUNDS":
+                removed -= payment.balance_change
+            elif payment.description == "ORDER_PAYMENT":
+                spent -= payment.balance_change
+                orders += 1
+                for name, cost, count in payment.orders:
+                    sold = items.setdefault(name, [0, 0])
+                    sold[0] += count
+                    sold[1] += cost * count
+    lines = sorted(((name, count, revenue) for name, (count, revenue) in items.items() if count), key=lambda line: (-line[1], line[0]))
+    return SalesReport(since, until, added, removed, spent, orders, tuple(lines))
+
+def _export_rows(ledger, since, until):
+    if not ledger:
+        for customer_id in sorted(_balances):
+            info = _info(customer_id)
+            if info.balance or info.first_name or info.last_name or info.nickname:
+                yield (customer_id, info.first_name, info.last_name, info.nickname, info.balance)
+        return
+    start = MIN_STAMP if since is None else date_stamp(since)
+    end = MAX_STAMP if until is None else date_stamp(until) + DAY
+    for payment_id, payment in sorted(_payments.items(), key=lambda item: (item[1].stamp, item[0])):
+        if not start <= payment.stamp < end:
+            continue
+        head = (payment_id, payment.customer_id, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(payment.stamp)),
+                payment.description, payment.balance_change)
+        if not payment.orders:
+            yield head + (None, None, None)
+        for line in payment.orders:
+            yield head + line
+
+def count_export(ledger=False, since=None, until=None):
+    with _lock:
+        return sum(1 for _ in _export_rows(ledger, since, until))
+
+def iter_export(ledger=False, since=None, until=None, chunk_size=1000):
+    """The export of dbutils.iter_export in lists of at most chunk_size rows, read all at once"""
+    with _lock:
+        rows = list(_export_rows(ledger, since, until))
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+def get_export():
+    return [row for rows in iter_export() for row in rows]
+
+class _DryRun(Exception):
+    pass
+
+def import_customers(chunks, dry_run=False, chunked=False, progress=None):
+    """See dbutils.import_customers"""
+    stamp = int(time.time())
+    done = 0
+    try:
+        with contextlib.nullcontext() if chunked and not dry_run else transaction():
+            for rows in chunks:
+                with transaction():
+                    for customer_id, first_name, last_name, nickname, amount in rows:
+                        if first_name or last_name or nickname:
+                            names = _customers.get(customer_id, (None, None, None))
+                            _set_customer(customer_id, (first_name or names[0], last_name or names[1], nickname or names[2]))
+                        if amount:
+                            _insert_payment(customer_id, "ADD_FUNDS" if amount > 0 else "REMOVE_FUNDS", amount, stamp=stamp)
+                done += len(rows)
+                if progress:
+                    progress(done)
+            if dry_run:
+                raise _DryRun()
+    except _DryRun:
+        pass
+    return done
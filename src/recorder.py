@@ -0,0 +1,52 @@
+""" Records what the user did at the till to a trace file, bench/replay.py replays it against a copy of the database.
+
+The trace is JSON lines. The first one is a header, each of the others is [ms since the start, action, *arguments]:
+
+    {"trace": 1, "started": "2025-01-01T20:00:00", "db": "prachy.db", "db_version": "6"}
+    [0,"open","Order",[12],{},false]
+    [850,"tap","Pivo",40]
+    [1920,"pay",false]
+
+Actions: open (App.open_frame: frame, args, kwargs, returned_from), tap and untap (basket lines), pay, add_funds, remove_funds, save_info, delete (a payment),
+search (main page). """
+
+import datetime, json, os, os.path, time
+import dbutils
+
+TRACE_VERSION = 1
+
+_file = None
+_start = None
+
+def start(directory="traces"):
+    """Starts recording into a new file in directory, returns its path"""
+    global _file, _start
+    os.makedirs(directory, exist_ok=True)
+    now = datetime.datetime.now()
+    path = os.path.join(directory, f"session-{now:%Y%m%d-%H%M%S}.trace")
+    # line buffered, a crash loses at most the action being written
+    _file = open(path, "w", encoding="utf-8", buffering=1)
+    _start = time.perf_counter()
+    _file.write(json.dumps({"trace": TRACE_VERSION, "started": now.isoformat(timespec="seconds"),
+                            "db": dbutils.DB_PATH, "db_version": dbutils.DB_VERSION}) + "\n")
+    return path
+
+def record(action, *args):
+    if _file is None:
+        return
+    _file.write(json.dumps([round((time.perf_counter() - _start) * 1000), action, *args], ensure_ascii=False, separators=(",", ":")) + "\n")
+
+def stop():
+    global _file
+    if _file is not None:
+        _file.close()
+        _file = None
+
+def read(path):
+    """Returns the header and a list of the actions as (ms, action, args)"""
+    with open(path, encoding="utf-8") as infil:
+        header = json.loads(infil.readline())
+        if header.get("trace") != TRACE_VERSION:
+            raise ValueError(f"{path} is not a trace of version {TRACE_VERSION}")
+        actions = [json.loads(line) for line in infil if line.strip()]
+    return header, [(action[0], action[1], action[2:]) for action in actions]
@@ -0,0 +1,304 @@
+""" What the till does, without Tk: the basket, checking out, topping up and the payment history, on top of dbutils.
+The frames in prachy.py keep their state in the same classes and show the same texts, the command line runs the operations in batch.
+
+    py src/service.py balance 12
+    py src/service.py order 12 Pivo:40x2 "Vrácený kelímek:-50" [--overdraft]    # only the buttons of config.json
+    py src/service.py top-up 12 500
+    py src/service.py withdraw 12 100
+    py src/service.py history 12 [--limit 20]
+    py src/service.py search Honza
+    py src/service.py report 2025-01-01 2025-01-31
+    py src/service.py rebuild-rollups
+    py src/service.py batch commands.txt [--repeat 10]    # one command above per line, timed
+
+All of them take --db, the database to work on, --config, the config.json with the buttons, and --engine, what it runs on
+(see storage.py). Only sqlite keeps what was done, the others start empty, e.g. to time a batch without the disk:
+
+    py src/service.py --engine memory batch commands.txt """
+
+import functools, os.path, sys, time
+import dbutils, storage
+from config import load_config
+
+PAYMENT_TYPES = {
+    "ORDER_PAYMENT": "Objednávka",
+    "ADD_FUNDS": "Nabití kreditu",
+    "REMOVE_FUNDS": "Vybití kreditu",
+    "ARCHIVE_CHECKPOINT": "Starší platby jsou v archivu",
+}
+
+def payment_type(record):
+    return PAYMENT_TYPES.get(record.description, record.description)
+
+def orders_text(record):
+    """The ordered items of a payment, one per line"""
+    return "\n".join("%s\t\t%sx" % (order[0], order[1]) for order in record.orders)
+
+def balance_text(record):
+    if record.description == "ARCHIVE_CHECKPOINT":
+        return "Zůstatek %d\n" % record.balance
+    return "Zůstatek %d (%+d)\n" % (record.balance, record.balance_change)
+
+def menu_items(config):
+    """(item_name, price) of the buttons of the till, the names are the texts on them"""
+    return [(settings.get("text", str(settings["value"])), settings["value"]) for settings in config["buttons"]]
+
+def customer_name(info):
+    """The name shown at the till, the nickname wins over the full name"""
+    if info.nickname:
+        return info.nickname
+    return " ".join(name for name in (info.first_name, info.last_name) if name)
+
+class Basket:
+    """Items being ordered as {(item_name, item_cost): count}, the way dbutils.save_order takes them"""
+
+    def __init__(self):
+        self.lines = {}
+        self.total = 0
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def add(self, name, value, count=1):
+        key = (name, value)
+        self.lines[key] = self.lines.get(key, 0) + count
+        self.total += value * count
+
+    def remove(self, name, value):
+        """Takes one piece of the item away, returns False when there was none"""
+        key = (name, value)
+        count = self.lines.get(key, 0)
+        if not count:
+            return False
+        if count == 1:
+            del self.lines[key]
+        else:
+            self.lines[key] = count - 1
+        self.total -= value
+        return True
+
+    def count(self, name, value):
+        return self.lines.get((name, value), 0)
+
+    def clear(self):
+        self.lines = {}
+        self.total = 0
+
+    def remaining(self, balance):
+        """What the customer has left after paying"""
+        return balance - self.total
+
+    def needs_overdraft(self, balance):
+        """True when the basket costs more than the customer has, a refund never does"""
+        return self.total > 0 and self.total > balance
+
+class Session:
+    """One customer at a till: the basket and the calls of the frames, done right away with ledger,
+    dbutils or another engine of storage.py"""
+
+    def __init__(self, ledger=dbutils):
+        self.ledger = ledger
+        self.customer_id = None
+        self.info = None
+        self.basket = Basket()
+
+    def open(self, customer_id):
+        """Starts serving the customer with an empty basket, returns their CustomerInfo"""
+        self.customer_id = customer_id
+        self.basket.clear()
+        self.info = self.ledger.get_info(customer_id)
+        return self.info
+
+    def close(self):
+        self.customer_id = None
+        self.info = None
+        self.basket.clear()
+
+    def balance(self):
+        return self.ledger.get_money(self.customer_id)
+
+    def add_item(self, name, value, count=1):
+        self.basket.add(name, value, count)
+
+    def remove_item(self, name, value):
+        return self.basket.remove(name, value)
+
+    def checkout(self, allow_overdraft=False):
+        """Pays the basket and empties it, returns the total. Raises dbutils.InsufficientFunds when the customer doesn't have enough
+        and allow_overdraft isn't set, the basket stays then"""
+        if not self.basket:
+            raise ValueError("the basket is empty")
+        total = self.basket.total
+        self.ledger.save_order(self.customer_id, self.basket.lines, allow_overdraft=allow_overdraft)
+        self.basket.clear()
+        return total
+
+    def top_up(self, amount):
+        if amount < 0:
+            raise ValueError(f"can't top up by {amount}")
+        self.ledger.add_funds(self.customer_id, amount)
+
+    def withdraw(self, amount):
+        if amount < 0:
+            raise ValueError(f"can't withdraw {amount}")
+        self.ledger.remove_funds(self.customer_id, amount)
+
+    def save_info(self, first_name, last_name, nickname):
+        self.ledger.save_info(self.customer_id, first_name, last_name, nickname)
+        self.info = self.ledger.get_info(self.customer_id)
+        return self.info
+
+    def history(self, limit=20, before=None, after=None, archived=False):
+        """A page of the payments of the customer, oldest first, see dbutils.get_payment_list"""
+        return self.ledger.get_payment_list(self.customer_id, limit, before=before, after=after, archived=archived)
+
+    def delete_payment(self, payment_id):
+        self.ledger.delete_payment(payment_id)
+
+def parse_item(text, items=None):
+    """Pivo:40x2 -> ("Pivo", 40, 2), the count can be left out. The price can be negative, like a returned cup.
+    With items, the (item_name, price) of menu_items, only those can be ordered; a line break in the name of a button
+    is written as a space"""
+    name, _, price = text.rpartition(":")
+    price, _, count = price.partition("x")
+    try:
+        price = int(price)
+    except ValueError:
+        price = None
+    if not name or price is None or count and not count.isdigit() or count and not int(count):
+        raise ValueError(f"{text!r} isn't name:price or name:pricexcount")
+    if items is not None:
+        names = {(item_name.replace("\n", " "), item_price): item_name for item_name, item_price in items}
+        if (name.replace("\n", " "), price) not in names:
+            raise ValueError(f"{name!r} for {price} isn't a button of the till")
+        name = names[name.replace("\n", " "), price]
+    return name, price, int(count or 1)
+
+@functools.lru_cache
+def menu(config_path):
+    """menu_items of the config, read once for a whole batch"""
+    return menu_items(load_config(config_path, os.path.splitext(config_path)[0] + ".cache"))
+
+def print_history(session, limit):
+    """Prints the newest limit payments of the customer of session"""
+    for record in session.history(limit):
+        print(f"{record.stamp_text}  {payment_type(record)}")
+        if record.orders:
+            print("  " + orders_text(record).replace("\n", "\n  "))
+        print("  " + balance_text(record), end="")
+
+def customer_text(info):
+    name = customer_name(info)
+    return f"{info.customer_id} ({name}): {info.balance}" if name else f"{info.customer_id}: {info.balance}"
+
+def run(args, ledger=dbutils):
+    """Runs one parsed command on ledger"""
+    session = Session(ledger)
+    if args.command == "balance":
+        print(customer_text(session.open(args.customer)))
+    elif args.command == "order":
+        items = menu(args.config)
+        session.open(args.customer)
+        for text in args.items:
+            session.add_item(*parse_item(text, items))
+        total = session.checkout(allow_overdraft=args.overdraft)
+        print(f"{args.customer}: zaplaceno {total}, zůstatek {session.balance()}")
+    elif args.command == "top-up":
+        session.open(args.customer)
+        session.top_up(args.amount)
+        print(f"{args.customer}: zůstatek {session.balance()}")
+    elif args.command == "withdraw":
+        session.open(args.customer)
+        session.withdraw(args.amount)
+        print(f"{args.customer}: zůstatek {session.balance()}")
+    elif args.command == "history":
+        session.open(args.customer)
+        print_history(session, args.limit)
+    elif args.command == "search":
+        for info in ledger.search_customers(args.text):
+            print(customer_text(info))
+    elif args.command == "report":
+        report = ledger.get_sales_report(args.since, args.until)
+        print(f"{report.since} – {report.until}: {report.orders} objednávek za {report.spent}, nabito {report.added}, vybito {report.removed}")
+        for name, count, revenue in report.items:
+            # button texts can have line breaks
+            print(f"  {name.replace(chr(10), ' '):<20}{count:>8}x{revenue:>10}")
+    elif args.command == "rebuild-rollups":
+        ledger.rebuild_rollups()
+    elif args.command == "batch":
+        batch(args.file, args.repeat, ledger)
+
+def batch(path, repeat=1, ledger=dbutils):
+    """Runs the commands in the file, one per line (# starts a comment), and prints how long each kind took"""
+    import shlex
+    parser = make_parser()
+    with open(path, encoding="utf-8") as infil:
+        lines = [(number, shlex.split(line, comments=True)) for number, line in enumerate(infil, 1)]
+    commands = [(number, parser.parse_args(words)) for number, words in lines if words]
+    times = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for number, args in commands:
+            if args.command == "batch":
+                raise ValueError(f"{path}:{number}: batch can't run another batch")
+            command_start = time.perf_counter()
+            try:
+                run(args, ledger)
+            except (dbutils.InsufficientFunds, ValueError) as ex:
+                print(f"{path}:{number}: {ex!r}", file=sys.stderr)
+            times.setdefault(args.command, []).append(time.perf_counter() - command_start)
+    elapsed = time.perf_counter() - start
+    print(f"{sum(len(taken) for taken in times.values())} commands in {elapsed:.2f}s", file=sys.stderr)
+    for command, taken in sorted(times.items()):
+        taken.sort()
+        print(f"{command:<16}{len(taken):>7}{taken[len(taken) // 2] * 1000:>10.2f} ms p50{taken[-1] * 1000:>10.2f} ms max", file=sys.stderr)
+
+def make_parser():
+    """The parser of the command line. The till imports this module too, argparse is only loaded for the command line"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="service.py", description=__doc__.split("\n")[0])
+    parser.add_argument("--db", default=dbutils.DB_PATH)
+    parser.add_argument("--config", default="./config.json", help="the buttons of the till, only those can be ordered")
+    parser.add_argument("--engine", choices=storage.ENGINES, default="sqlite", help="memory and python start empty and keep nothing")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("balance")
+    command.add_argument("customer", type=int)
+    command = commands.add_parser("order")
+    command.add_argument("customer", type=int)
+    command.add_argument("items", nargs="+", help="name:price or name:pricexcount")
+    command.add_argument("--overdraft", action="store_true", help="pay even when the customer doesn't have enough")
+    for name in ("top-up", "withdraw"):
+        command = commands.add_parser(name)
+        command.add_argument("customer", type=int)
+        command.add_argument("amount", type=int)
+    command = commands.add_parser("history")
+    command.add_argument("customer", type=int)
+    command.add_argument("--limit", type=int, default=20)
+    command = commands.add_parser("search")
+    command.add_argument("text")
+    command = commands.add_parser("report")
+    command.add_argument("since", help="first day, YYYY-MM-DD")
+    command.add_argument("until", help="last day, included")
+    commands.add_parser("rebuild-rollups")
+    command = commands.add_parser("batch")
+    command.add_argument("file")
+    command.add_argument("--repeat", type=int, default=1, help="run the file this many times")
+    return parser
+
+def main():
+    args = make_parser().parse_args()
+    ledger = storage.open_engine(args.engine, args.db)
+    try:
+        run(args, ledger)
+    except dbutils.InsufficientFunds as ex:
+        print(f"nedostatek kreditu: {ex}", file=sys.stderr)
+        sys.exit(1)
+    except (ValueError, OSError) as ex:
+        # a wrong item or amount, a missing config.json
+        print(f"chyba: {ex}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        ledger.close_connections()
+
+if __name__ == "__main__":
+    main()
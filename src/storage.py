@@ -0,0 +1,30 @@
+""" The engines the ledger can run on. The app always uses the database file, tests and benchmarks can pick another one
+to leave the real file alone, or to tell the cost of the logic from the cost of the disk:
+
+    sqlite    dbutils on the database file at path
+    memory    dbutils on a new SQLite database in memory, the same SQL without the disk
+    python    pyledger, the same functions on Python dicts, without SQL
+
+    ledger = storage.open_engine("memory")
+    session = service.Session(ledger)
+    worker = DBWorker(ledger=ledger) """
+
+import dbutils
+
+ENGINES = ("sqlite", "memory", "python")
+
+def open_engine(engine, path=None):
+    """Prepares the engine and returns the module with the ledger functions, path is the file of the sqlite engine"""
+    if engine == "sqlite":
+        dbutils.use_database(path or dbutils.DB_PATH)
+    elif engine == "memory":
+        dbutils.use_database(dbutils.MEMORY)
+    elif engine == "python":
+        # only imported when used, nothing else needs it
+        import pyledger
+        pyledger.reset()
+        return pyledger
+    else:
+        raise ValueError(f"unknown engine {engine!r}, one of {', '.join(ENGINES)}")
+    dbutils.prepare_db()
+    return dbutils